@@ -0,0 +1,392 @@
+"""
+Asyncio serving mode for the flask app.
+
+asgi() wraps the WSGI app into an ASGI app. The WSGI routes block,
+on their locks or the journal's writes, so they run in the loop's
+default executor, a pool of threads. Only the routes that wait, the
+async routes, run on the loop itself, so a waiting request holds no
+thread.
+serve() is a small HTTP/1.1 server for that ASGI app. Connections are
+plain asyncio streams, so thousands of idle keep-alive connections
+cost some memory but no threads.
+
+Started by app.py when BWISE_SERVER=async.
+"""
+
+import asyncio
+import contextvars
+import io
+import socket
+import sys
+from http import HTTPStatus
+from typing import AsyncIterator, Awaitable, Callable, Iterable
+from urllib.parse import unquote
+
+ASGIApp = Callable[[dict, Callable, Callable], Awaitable[None]]
+WSGIApp = Callable[[dict, Callable], Iterable[bytes]]
+# a route that runs on the event loop itself, like the long poll of app.py.
+# Gets the request body, returns the status, the content type and
+# the body, or an async iterator of chunks for a stream
+AsyncRoute = Callable[
+    [bytes], Awaitable[tuple[int, str, bytes | AsyncIterator[bytes]]]
+]
+
+# limits of the built-in server
+MAX_HEADERS = 100
+MAX_BODY_SIZE = 16 * 1024 * 1024
+# seconds an idle keep-alive connection is kept open
+KEEP_ALIVE_TIMEOUT = 120
+
+
+def status_line(status: int) -> bytes:
+    try:
+        reason = HTTPStatus(status).phrase
+    except ValueError:
+        reason = ""
+    return f"HTTP/1.1 {status} {reason}\r\n".encode("latin-1")
+
+
+def wsgi_environ(scope: dict, body: bytes) -> dict:
+    """The WSGI environ of an ASGI http scope"""
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "REMOTE_ADDR": client[0],
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": False,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+
+    for name, value in scope["headers"]:
+        key = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if key == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif key != "CONTENT_LENGTH":
+            key = "HTTP_" + key
+            environ[key] = (
+                f"{environ[key]},{value}" if key in environ else value
+            )
+
+    return environ
+
+
+def asgi(
+    wsgi_app: WSGIApp, async_routes: dict[str, AsyncRoute] | None = None
+) -> ASGIApp:
+    """
+    An ASGI app running wsgi_app in the default executor of the loop.
+    Streamed WSGI responses are sent chunk by chunk, every chunk is
+    made in the executor as well.
+    POST requests to the paths in async_routes are awaited instead,
+    so they can wait without blocking the loop
+    """
+    async_routes = async_routes or dict()
+
+    async def app(scope: dict, receive: Callable, send: Callable) -> None:
+        if scope["type"] == "lifespan":
+            # nothing to set up, app.py loads the data before serving
+            while True:
+                message = await receive()
+                await send({"type": message["type"] + ".complete"})
+                if message["type"] == "lifespan.shutdown":
+                    return
+
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        route = async_routes.get(scope["path"])
+        if route is not None and scope["method"] == "POST":
+            await send_async_route(send, *await route(body))
+            return
+
+        response_start: dict = dict()
+
+        def start_response(status: str, headers: list, exc_info=None):
+            response_start["status"] = int(status.split(" ", 1)[0])
+            response_start["headers"] = [
+                (name.lower().encode("latin-1"), value.encode("latin-1"))
+                for name, value in headers
+            ]
+
+        loop = asyncio.get_running_loop()
+        # the context vars flask sets follow the request between threads
+        context = contextvars.copy_context()
+        chunks = await loop.run_in_executor(
+            None,
+            context.run,
+            wsgi_app,
+            wsgi_environ(scope, body),
+            start_response,
+        )
+        try:
+            await send({"type": "http.response.start", **response_start})
+            iterator = iter(chunks)
+            while True:
+                chunk = await loop.run_in_executor(
+                    None, context.run, next, iterator, None
+                )
+                if chunk is None:
+                    break
+                if chunk:
+                    await send(
+                        {
+                            "type": "http.response.body",
+                            "body": chunk,
+                            "more_body": True,
+                        }
+                    )
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            if hasattr(chunks, "close"):
+                await loop.run_in_executor(None, context.run, chunks.close)
+
+    return app
+
+
+async def send_async_route(
+    send: Callable,
+    status: int,
+    content_type: str,
+    body: bytes | AsyncIterator[bytes],
+) -> None:
+    headers = [(b"content-type", content_type.encode("latin-1"))]
+    if isinstance(body, bytes):
+        headers.append((b"content-length", b"%d" % len(body)))
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": headers,
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+        return
+
+    # a stream, sent chunked until it ends or the client goes away
+    headers.append((b"cache-control", b"no-cache"))
+    await send(
+        {"type": "http.response.start", "status": status, "headers": headers}
+    )
+    try:
+        async for chunk in body:
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": chunk,
+                    "more_body": True,
+                }
+            )
+    finally:
+        await body.aclose()  # type: ignore[attr-defined]
+    await send({"type": "http.response.body", "body": b""})
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int):
+        super().__init__(status)
+        self.status = status
+
+
+async def read_request(reader: asyncio.StreamReader) -> dict | None:
+    """
+    Reads the head of one request and returns its ASGI scope,
+    with the length of the body that still has to be read added.
+    Returns None when the client closed the connection
+    """
+    line = await reader.readline()
+    if not line:
+        return None
+
+    try:
+        method, target, version = line.decode("latin-1").split()
+    except ValueError:
+        raise HTTPError(400)
+    if not version.startswith("HTTP/1."):
+        raise HTTPError(400)
+
+    headers: list[tuple[bytes, bytes]] = []
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        if len(headers) >= MAX_HEADERS or b":" not in line:
+            raise HTTPError(400)
+        name, value = line.split(b":", 1)
+        headers.append((name.strip().lower(), value.strip()))
+
+    header_values = dict(headers)
+    if b"chunked" in header_values.get(b"transfer-encoding", b""):
+        raise HTTPError(501)
+    try:
+        content_length = int(header_values.get(b"content-length", b"0"))
+    except ValueError:
+        raise HTTPError(400)
+    if content_length > MAX_BODY_SIZE:
+        raise HTTPError(413)
+
+    path, _, query = target.partition("?")
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": version[len("HTTP/") :],
+        "method": method.upper(),
+        "scheme": "http",
+        "path": unquote(path),
+        "raw_path": path.encode("latin-1"),
+        "query_string": query.encode("latin-1"),
+        "root_path": "",
+        "headers": headers,
+        "content_length": content_length,
+        "expects_continue": header_values.get(b"expect", b"").lower()
+        == b"100-continue",
+    }
+
+
+def keeps_alive(scope: dict) -> bool:
+    connection = dict(scope["headers"]).get(b"connection", b"").lower()
+    if scope["http_version"] == "1.0":
+        return connection == b"keep-alive"
+    return connection != b"close"
+
+
+async def send_error(writer: asyncio.StreamWriter, status: int) -> None:
+    writer.write(
+        status_line(status) + b"Content-Length: 0\r\nConnection: close\r\n\r\n"
+    )
+    await writer.drain()
+
+
+async def handle_request(
+    app: ASGIApp,
+    scope: dict,
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    keep_alive: bool,
+) -> None:
+    if scope.pop("expects_continue"):
+        writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+    body = await reader.readexactly(scope.pop("content_length"))
+    body_sent = False
+    chunked = False
+
+    async def receive() -> dict:
+        nonlocal body_sent
+        if body_sent:
+            # the request is complete, nothing else will ever arrive
+            await asyncio.Future()
+        body_sent = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message: dict) -> None:
+        nonlocal chunked
+        if message["type"] == "http.response.start":
+            status = message["status"]
+            headers = list(message.get("headers", []))
+            names = {name.lower() for name, _ in headers}
+            if b"content-length" not in names:
+                chunked = True
+                headers.append((b"transfer-encoding", b"chunked"))
+            headers.append(
+                (b"connection", b"keep-alive" if keep_alive else b"close")
+            )
+            writer.write(
+                status_line(status)
+                + b"".join(
+                    name + b": " + value + b"\r\n" for name, value in headers
+                )
+                + b"\r\n"
+            )
+            return
+
+        chunk = message.get("body", b"")
+        if chunked:
+            if chunk:
+                writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            if not message.get("more_body", False):
+                writer.write(b"0\r\n\r\n")
+        elif chunk:
+            writer.write(chunk)
+
+        # only wait for slow clients once their buffer is full
+        await writer.drain()
+
+    await app(scope, receive, send)
+
+
+def connection_handler(app: ASGIApp) -> Callable:
+    async def handle_connection(
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        server = writer.get_extra_info("sockname")
+        client = writer.get_extra_info("peername")
+        try:
+            while True:
+                try:
+                    scope = await asyncio.wait_for(
+                        read_request(reader), KEEP_ALIVE_TIMEOUT
+                    )
+                except asyncio.TimeoutError:
+                    return
+                except HTTPError as e:
+                    await send_error(writer, e.status)
+                    return
+                if scope is None:
+                    return
+
+                scope["server"] = server[:2] if server else None
+                scope["client"] = client[:2] if client else None
+                keep_alive = keeps_alive(scope)
+                await handle_request(app, scope, reader, writer, keep_alive)
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return handle_connection
+
+
+async def serve_forever(
+    app: ASGIApp, host: str, port: int, sock: socket.socket | None = None
+) -> None:
+    handler = connection_handler(app)
+    if sock is None:
+        server = await asyncio.start_server(handler, host, port, backlog=2048)
+    else:
+        server = await asyncio.start_server(handler, sock=sock, backlog=2048)
+    async with server:
+        await server.serve_forever()
+
+
+def serve(
+    wsgi_app: WSGIApp,
+    host: str,
+    port: int,
+    sock: socket.socket | None = None,
+    async_routes: dict[str, AsyncRoute] | None = None,
+) -> None:
+    """
+    Serves wsgi_app on the event loop until the process is stopped.
+    Listens on sock instead of host:port if it is given
+    """
+    print(f"Serving on http://{host}:{port} with asyncio")
+    asyncio.run(serve_forever(asgi(wsgi_app, async_routes), host, port, sock))
@@ -1,17 +1,213 @@
+import array
+import asyncio
+import bisect
+import collections
+import copy
+import dataclasses
+import fcntl
+import functools
+import gc
+import itertools
 import json
+import mmap
 import os
 import queue
 import signal  # for gracefull shutdowns
+import socket
+import struct
+import sys
 import threading
-from dataclasses import dataclass
+import time
+import traceback
+import tracemalloc
+import zlib
+from contextlib import ExitStack, contextmanager, nullcontext
+from dataclasses import dataclass, field
+from typing import (
+    AsyncIterator,
+    Callable,
+    Iterable,
+    Iterator,
+    Mapping,
+    MutableMapping,
+    Sequence,
+    TypeVar,
+)
 
 import flask
 import waitress
 from flask.wrappers import Response
 
+try:
+    import zstandard
+except ImportError:  # optional, only needed for "compression": "zstd"
+    zstandard = None  # type: ignore[assignment]
+
 app = flask.Flask(__name__)
 DEBUG: bool = False
-LOG: bool = True
+
+# Every setting can be given in the json file CONFIG_FILE
+# and overridden by the environment variable BWISE_<SETTING>
+CONFIG_FILE: str = os.environ.get("BWISE_CONFIG", "config.json")
+DEFAULT_CONFIG: dict[str, bool | int | float | str] = {
+    "host": "0.0.0.0",
+    "port": 5000,
+    "log": True,
+    # "waitress" for the threaded WSGI server, "async" for aioserver.py
+    "server": "waitress",
+    # waitress tuning, see waitress.adjustments.Adjustments.
+    # threads can also be "auto", see autotune_threads()
+    "threads": 4,
+    "connection_limit": 100,
+    "backlog": 1024,
+    "recv_bytes": 8192,
+    "send_bytes": 1,
+    "channel_timeout": 120,
+    "cleanup_interval": 30,
+    # append every change to JOURNAL_FILE, see Journal
+    "journal": False,
+    # worker processes serving the same port, more than 1 needs the journal
+    # and is turned on with it, see run_workers()
+    "workers": 1,
+    # seconds between the snapshots the parent of the workers writes
+    "snapshot_interval": 1.0,
+    # directory of a primary with the journal turned on. Serves its data
+    # read only and follows its journal, see run_replica()
+    "replica_of": "",
+    # seconds between two looks at the journal by replicas and workers
+    "journal_interval": 0.05,
+    # longest time a /wait_for_changes request is held open
+    "long_poll_timeout": 30.0,
+    # waitress threads /wait_for_changes and /events may hold at once, so
+    # the other routes keep their threads. The async server holds none
+    "waiting_threads": 2,
+    # events buffered for a /events subscriber before it counts as too slow
+    # and is dropped, and seconds between the keep alive comments
+    "event_buffer": 256,
+    "event_heartbeat": 15.0,
+    # most operations a /batch request can run
+    "batch_limit": 1000,
+    # transactions /get_transactions returns when no limit is given,
+    # and the most it returns at once
+    "page_size": 100,
+    "max_page_size": 1000,
+    # records /import and bulk_import.py apply and persist at once
+    "import_batch": 10000,
+    # "json" for users.json and groups.json,
+    # "binary" for SNAPSHOT_FILE, see write_binary_snapshot()
+    "snapshot_format": "json",
+    # only read the transactions of a group from the binary snapshot
+    # when it is first used, so startup doesn't depend on their number
+    "lazy_load": False,
+    # codec of the json snapshots, "none", "gzip", "zlib" or "zstd" (needs
+    # the zstandard package). The loader recognizes every one of them,
+    # see read_file(). Binary snapshots are mapped and stay uncompressed
+    "compression": "none",
+    # most transactions kept in memory, 0 for no limit. The groups used
+    # least recently are evicted to the binary snapshot, see GroupCache.
+    # Needs snapshot_format "binary", groups are then loaded lazily
+    "resident_transactions": 0,
+    # Idempotency-Key responses kept, and for how many seconds
+    "idempotency_keys": 10000,
+    "idempotency_ttl": 86400.0,
+}
+# settings that also accept "auto" instead of a value
+AUTO_SETTINGS = {"threads"}
+# the compression codecs, by the bytes their output starts with
+COMPRESSION_MAGIC: dict[str, tuple[bytes, ...]] = {
+    "none": (),
+    "gzip": (b"\x1f\x8b",),
+    "zlib": (b"\x78\x01", b"\x78\x5e", b"\x78\x9c", b"\x78\xda"),
+    "zstd": (b"\x28\xb5\x2f\xfd",),
+}
+
+
+def parse_setting(name: str, value: str) -> bool | int | float | str:
+    """Converts a setting from the environment to the type of its default"""
+    default = DEFAULT_CONFIG[name]
+    if name in AUTO_SETTINGS and value == "auto":
+        return value
+    if isinstance(default, bool):
+        return value.lower() not in ("", "0", "false", "no", "off")
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, float):
+        return float(value)
+    return value
+
+
+def load_config(
+    config_file: str = CONFIG_FILE, environ: Mapping[str, str] = os.environ
+) -> dict[str, bool | int | float | str]:
+    """
+    The settings from DEFAULT_CONFIG, overridden by config_file
+    if it exists and then by the environment.
+    Raises ValueError for unknown settings and invalid values
+    """
+    config = dict(DEFAULT_CONFIG)
+
+    if os.path.exists(config_file):
+        with open(config_file, "r") as f:
+            file_config = json.load(f)
+        unknown = set(file_config) - set(DEFAULT_CONFIG)
+        if unknown:
+            raise ValueError(f"Unknown settings in {config_file}: {unknown}")
+        config.update(file_config)
+
+    for name in DEFAULT_CONFIG:
+        value = environ.get(f"BWISE_{name.upper()}")
+        if value is not None:
+            config[name] = parse_setting(name, value)
+
+    for name, value in config.items():
+        if name in AUTO_SETTINGS and value == "auto":
+            continue
+        if isinstance(DEFAULT_CONFIG[name], float) and type(value) is int:
+            config[name] = value = float(value)
+        if type(value) is not type(DEFAULT_CONFIG[name]):
+            raise ValueError(f"Invalid value for {name}: {value!r}")
+
+    if config["waiting_threads"] < 0 or (
+        config["threads"] != "auto"
+        and config["waiting_threads"] >= config["threads"]
+    ):
+        raise ValueError(
+            "Invalid value for waiting_threads: "
+            f"{config['waiting_threads']!r}, it has to leave threads "
+            "for the other routes"
+        )
+    if config["idempotency_keys"] < 1:
+        raise ValueError(
+            "Invalid value for idempotency_keys: "
+            f"{config['idempotency_keys']!r}, at least 1 key is kept"
+        )
+    if (
+        config["resident_transactions"] > 0
+        and config["snapshot_format"] != "binary"
+    ):
+        raise ValueError(
+            "resident_transactions needs snapshot_format binary, "
+            "json snapshots load every group at startup"
+        )
+    if config["compression"] not in COMPRESSION_MAGIC:
+        raise ValueError(
+            f"Invalid value for compression: {config['compression']!r}"
+        )
+    if config["compression"] == "zstd" and zstandard is None:
+        raise ValueError("compression zstd needs the zstandard package")
+
+    return config
+
+
+CONFIG = load_config()
+LOG: bool = bool(CONFIG["log"])
+HOST: str = str(CONFIG["host"])
+PORT: int = int(CONFIG["port"])
+SERVER: str = str(CONFIG["server"])
+WORKERS: int = int(CONFIG["workers"])
+
+# Runtime information for /metrics, each part of the server adds a section
+METRICS: dict[str, dict] = dict()
 
 
 def jsonify(*args, **kwargs) -> Response:
@@ -26,6 +222,9 @@ def jsonify(*args, **kwargs) -> Response:
 
 
 # Data models
+# Names are interned with sys.intern() where they enter the state,
+# so every User, Group and Transaction that refers to one user or group
+# shares a single string instead of holding a copy of its own
 @dataclass
 class User:
     username: str
@@ -34,30 +233,206 @@ class User:
         return {"username": self.username}
 
 
-@dataclass
+@dataclass(slots=True)
 class Transaction:
     from_user: str  # User who owes money
     to_user: str  # User who is owed money
     amount: float
+    # increases with every transaction added to the group, 0 until
+    # the group numbers it, see Group.transaction_count
+    id: int = 0
 
     def to_dict(self) -> dict[str, str | float]:
         return {
+            "id": self.id,
             "from_user": self.from_user,
             "to_user": self.to_user,
             "amount": self.amount,
         }
 
 
+class TransactionSegment:
+    """
+    The transactions of a group as columns of a binary snapshot,
+    see read_binary_snapshot(). Transactions are made when iterated
+    """
+
+    def __init__(
+        self,
+        name: Callable[[int], str],
+        from_users: Sequence[int],
+        to_users: Sequence[int],
+        amounts: Sequence[float],
+        ids: Sequence[int],
+    ):
+        # name turns the indexes in from_users and to_users into names
+        self.name = name
+        self.from_users = from_users
+        self.to_users = to_users
+        self.amounts = amounts
+        self.ids = ids
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self) -> Iterator[Transaction]:
+        return map(
+            Transaction,
+            map(self.name, self.from_users),
+            map(self.name, self.to_users),
+            self.amounts,
+            self.ids,
+        )
+
+
 class Group:
-    def __init__(self, name, creator):
-        self.name = str(name)
-        self.creator = str(creator)
-        self.members: list[str] = [str(creator)]
-        self.transactions: list[Transaction] = []
+    """
+    A group is never changed after it was put into GROUPS.
+    Writers publish a changed copy made with replace() instead,
+    so anyone holding a group or a State keeps a consistent view of it.
+    A group loaded lazily gets a segment instead of its transactions,
+    they are read from it the first time they are used.
+    GROUP_CACHE can drop them again, see GroupCache
+    """
+
+    def __init__(
+        self,
+        name,
+        creator,
+        members: Iterable[str] | None = None,
+        transactions: Iterable[Transaction] | None = (),
+        version: int = 1,
+        transaction_count: int = 0,
+        segment: TransactionSegment | None = None,
+    ):
+        self.name = sys.intern(str(name))
+        self.creator = sys.intern(str(creator))
+        self.members: tuple[str, ...] = (
+            (self.creator,)
+            if members is None
+            else tuple(map(sys.intern, members))
+        )
+        # increases with every change, clients send it to /wait_for_changes
+        self.version = version
+        # serializes the writers of this group, see the locking notes below.
+        # Every version of the group made with replace() shares it
+        self.lock = threading.Lock()
+        # the transactions on disk, in a binary snapshot
+        self.segment = segment
+        self._transactions: tuple[Transaction, ...] | None
+        if transactions is None:
+            # read from the segment, which has the ids already
+            self._transactions = None
+            self.transaction_count = transaction_count
+            return
+
+        self._transactions = tuple(transactions)
+        # transactions without an id, from before they had one, are
+        # numbered in the order they are in. Ids are given in order,
+        # so it's enough to look at both ends
+        if self._transactions and (
+            self._transactions[0].id == 0 or self._transactions[-1].id == 0
+        ):
+            self._transactions = tuple(
+                dataclasses.replace(transaction, id=number)
+                for number, transaction in enumerate(self._transactions, 1)
+            )
+        # the transactions ever added, the id of the last one.
+        # Settled transactions are gone, so it's kept separately
+        self.transaction_count = max(
+            transaction_count,
+            self._transactions[-1].id if self._transactions else 0,
+        )
+
+    @property
+    def transactions(self) -> tuple[Transaction, ...]:
+        transactions = self._transactions
+        loaded = transactions is not None
+        if transactions is None:
+            assert self.segment is not None
+            transactions = self._transactions = tuple(self.segment)
+        GROUP_CACHE.used(self, transactions, loaded)
+        return transactions
+
+    @transactions.setter
+    def transactions(self, transactions: Iterable[Transaction]) -> None:
+        self._transactions = tuple(transactions)
+        # the segment has the transactions before the change
+        self.segment = None
+
+    @property
+    def transactions_loaded(self) -> bool:
+        """False while the transactions are only in the segment"""
+        return self._transactions is not None
+
+    def stored_transactions(
+        self,
+    ) -> tuple[Transaction, ...] | TransactionSegment:
+        """
+        The transactions, or the segment while they are not loaded.
+        For going through all groups without loading them, or counting
+        it as a use by GROUP_CACHE
+        """
+        transactions = self._transactions
+        if transactions is None:
+            assert self.segment is not None
+            return self.segment
+        return transactions
+
+    def evict(self) -> None:
+        """Drops the transactions, they are read from the segment again"""
+        assert self.segment is not None
+        self._transactions = None
+        self.__dict__.pop("member_transactions", None)
+
+    def replace(self, **changes) -> "Group":
+        """A copy of the group with the given attributes changed"""
+        group = copy.copy(self)
+        # the index belongs to the transactions of self
+        group.__dict__.pop("member_transactions", None)
+        for attribute, value in changes.items():
+            setattr(group, attribute, tuple(value))
+        if "transactions" in changes and group.transactions:
+            group.transaction_count = max(
+                self.transaction_count, group.transactions[-1].id
+            )
+        group.version = self.version + 1
+        return group
+
+    @functools.cached_property
+    def member_transactions(self) -> dict[str, tuple[Transaction, ...]]:
+        """
+        The transactions of every member, in the order of transactions.
+        Built on first use, a group never changes
+        """
+        index: dict[str, list[Transaction]] = dict()
+        for transaction in self.transactions:
+            index.setdefault(transaction.from_user, []).append(transaction)
+            if transaction.to_user != transaction.from_user:
+                index.setdefault(transaction.to_user, []).append(transaction)
+        return {member: tuple(found) for member, found in index.items()}
+
+    def transactions_page(
+        self, cursor: int, limit: int, member: str | None = None
+    ) -> list[Transaction]:
+        """
+        The first limit transactions with an id above cursor,
+        only the ones of member if it is given.
+        The ids are sorted, so this is a binary search and not a scan
+        """
+        if member is None:
+            transactions = self.transactions
+        else:
+            transactions = self.member_transactions.get(member, ())
+        start = bisect.bisect_right(
+            transactions, cursor, key=lambda transaction: transaction.id
+        )
+        return list(transactions[start : start + limit])
 
     def to_dict(self):
         result = self.to_dict_no_transactions()
         result["transactions"] = [t.to_dict() for t in self.transactions]
+        result["transaction_count"] = self.transaction_count
         return result
 
     def to_dict_no_transactions(self):
@@ -65,323 +440,2140 @@ class Group:
         return {
             "name": self.name,
             "creator": self.creator,
-            "members": self.members,
+            "members": list(self.members),
+            "version": self.version,
         }
 
+    @classmethod
+    def from_dict(cls, group_dict: dict) -> "Group":
+        # Reconstruct transactions
+        transactions = [
+            Transaction(
+                sys.intern(t_dict["from_user"]),
+                sys.intern(t_dict["to_user"]),
+                t_dict["amount"],
+                t_dict.get("id", 0),
+            )
+            for t_dict in group_dict.get("transactions", dict())
+        ]
+        return cls(
+            group_dict["name"],
+            group_dict["creator"],
+            group_dict["members"],
+            transactions,
+            group_dict.get("version", 1),
+            group_dict.get("transaction_count", 0),
+        )
 
-write_queue: queue.Queue[tuple[str, str] | None] = queue.Queue()
-# In-memory storage
-USERS: dict[str, User] = dict()
-GROUPS: dict[str, Group] = dict()
 
-# File paths
-USERS_FILE = "users.json"
-GROUPS_FILE = "groups.json"
+class GroupCache:
+    """
+    Keeps the transactions of the groups used most recently in memory,
+    at most budget of them. The groups used least recently are evicted,
+    they drop their transactions and read them from their segment of
+    the binary snapshot again on their next use.
+    A group changed since the last snapshot has no segment yet,
+    it stays in memory until the next snapshot gives it one
+    """
 
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.lock = threading.Lock()
+        # name: the group used last and how many transactions it holds,
+        # least recently used first
+        self.groups: collections.OrderedDict[str, tuple[Group, int]] = (
+            collections.OrderedDict()
+        )
+        self.stats = {
+            "budget": budget,
+            "groups": 0,
+            "transactions": 0,
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+        }
+        METRICS["group_cache"] = self.stats
 
-def load_data(
-    load_users_dict: dict[str, User], load_groups_dict: dict[str, Group]
-) -> None:
+    def used(
+        self, group: Group, transactions: Sequence[Transaction], hit: bool
+    ) -> None:
+        """Called with the transactions of group whenever they are used"""
+        if not self.budget:
+            return
+
+        with self.lock:
+            self.stats["hits" if hit else "misses"] += 1
+            previous = self.groups.pop(group.name, None)
+            if previous is not None:
+                self.stats["transactions"] -= previous[1]
+            self.groups[group.name] = (group, len(transactions))
+            self.stats["transactions"] += len(transactions)
+            if self.stats["transactions"] > self.budget:
+                self.evict(group.name)
+            self.stats["groups"] = len(self.groups)
+
+    def evict(self, used: str) -> None:
+        """
+        Evicts the least recently used groups until under the budget,
+        never the group that is being used
+        """
+        excess = self.stats["transactions"] - self.budget
+        evicted: list[str] = []
+        for name, (group, count) in self.groups.items():
+            if excess <= 0 or name == used:
+                break
+            # a group deleted or replaced since is only forgotten
+            if (
+                group.segment is not None
+                or STATE.groups.get(name) is not group
+            ):
+                evicted.append(name)
+                excess -= count
+
+        for name in evicted:
+            group, count = self.groups.pop(name)
+            self.stats["transactions"] -= count
+            if group.segment is not None:
+                group.evict()
+                self.stats["evictions"] += 1
+
+
+V = TypeVar("V")
+
+# how many dicts a Snapshot spreads its keys over
+SNAPSHOT_BUCKETS = 256
+
+
+class Snapshot(Mapping[str, V]):
     """
-    Loads the list of Groups and Users from json file
-    when the server starts
+    An immutable mapping, changing it returns a new Snapshot.
+    The keys are spread over SNAPSHOT_BUCKETS small dicts by their hash,
+    a change only copies the buckets it touches
+    and shares all the other ones with the previous version
     """
-    load_users(load_users_dict)
-    load_groups(load_groups_dict)
 
+    def __init__(self, buckets: tuple[dict[str, V], ...] = (), length=0):
+        self._buckets = buckets or ({},) * SNAPSHOT_BUCKETS
+        self._length = length
 
-def load_users(load_users_dict: dict[str, User]) -> None:
-    if not os.path.exists(USERS_FILE):
-        return
+    def __getitem__(self, key: str) -> V:
+        return self._buckets[hash(key) % SNAPSHOT_BUCKETS][key]
 
-    with open(USERS_FILE, "r") as f:
-        try:
-            users_data = json.load(f)
-        except Exception:
-            return
+    def __contains__(self, key: object) -> bool:
+        return key in self._buckets[hash(key) % SNAPSHOT_BUCKETS]
 
-        load_users_dict.update(
-            {username: User(username) for username in users_data}
-        )
+    def get(self, key: str, default=None):
+        return self._buckets[hash(key) % SNAPSHOT_BUCKETS].get(key, default)
 
+    def __iter__(self) -> Iterator[str]:
+        for bucket in self._buckets:
+            yield from bucket
 
-def load_groups(load_groups_dict: dict[str, Group]) -> None:
-    if not os.path.exists(GROUPS_FILE):
-        return
+    def __len__(self) -> int:
+        return self._length
 
-    with open(GROUPS_FILE, "r") as f:
-        try:
-            groups_data = json.load(f)
-        except Exception:
-            return
+    def values(self) -> list[V]:  # type: ignore[override]
+        return [value for bucket in self._buckets for value in bucket.values()]
 
-        for group_dict in groups_data:
-            group = Group(group_dict["name"], group_dict["creator"])
-            group.members = group_dict["members"]
+    def items(self) -> list[tuple[str, V]]:  # type: ignore[override]
+        return [item for bucket in self._buckets for item in bucket.items()]
 
-            # Reconstruct transactions
-            for t_dict in group_dict.get("transactions", dict()):
-                transaction = Transaction(
-                    t_dict["from_user"],
-                    t_dict["to_user"],
-                    t_dict["amount"],
-                )
-                group.transactions.append(transaction)
+    def merge(self, changes: Mapping[str, V]) -> "Snapshot[V]":
+        """A new snapshot with the keys of changes added or replaced"""
+        buckets = list(self._buckets)
+        copied: set[int] = set()
+        length = self._length
 
-            load_groups_dict[group.name] = group
+        for key, value in changes.items():
+            index = hash(key) % SNAPSHOT_BUCKETS
+            if index not in copied:
+                buckets[index] = dict(buckets[index])
+                copied.add(index)
+            if key not in buckets[index]:
+                length += 1
+            buckets[index][key] = value
 
+        return Snapshot(tuple(buckets), length)
 
-def save_data() -> None:
+    def remove(self, key: str) -> "Snapshot[V]":
+        """A new snapshot without key, raises KeyError if it is missing"""
+        index = hash(key) % SNAPSHOT_BUCKETS
+        bucket = dict(self._buckets[index])
+        del bucket[key]
+
+        buckets = list(self._buckets)
+        buckets[index] = bucket
+        return Snapshot(tuple(buckets), self._length - 1)
+
+
+@dataclass(frozen=True)
+class State:
     """
-    Saves the current in-memory representation of GROUPS and USERS
-    into a json file.
-    For a faster response time, the strings to write
-    are first put into a queue and the  writing is done after responding
+    Everything the server knows at one point in time.
+    Every change publishes a new State, so whoever holds one
+    can read it without locking while writers carry on
     """
-    users_json: str = json.dumps([username for username in USERS.keys()])
 
-    groups_json: str = json.dumps(
-        [group.to_dict() for group in GROUPS.values()]
-    )
+    users: Snapshot[User]
+    groups: Snapshot[Group]
+    # increases with every published change
+    version: int = 0
+    # the last operation applied by commit() or replayed from the journal
+    seq: int = 0
+    # username: names of the groups the user is a member of.
+    # Built from groups when not given, then kept up to date by the changes
+    user_groups: Snapshot[frozenset[str]] = None  # type: ignore[assignment]
+    # Idempotency-Key: the response of the request that used it,
+    # see apply_remember_response()
+    responses: Snapshot[dict] = field(default_factory=Snapshot)
+
+    def __post_init__(self):
+        if self.user_groups is None:
+            index: dict[str, set[str]] = dict()
+            for group in self.groups.values():
+                for member in group.members:
+                    index.setdefault(member, set()).add(group.name)
+            object.__setattr__(
+                self,
+                "user_groups",
+                Snapshot().merge(
+                    {user: frozenset(names) for user, names in index.items()}
+                ),
+            )
 
-    # with open(USERS_FILE, "w")as f:
-    #     f.write(users_json)
-    # with open(GROUPS_FILE, "w") as f:
-    #     f.write(groups_json)
+    def merged(self, field: str, changes: Mapping) -> "State":
+        """A new State with the entries of changes added to field"""
+        if field == "users":
+            return dataclasses.replace(self, users=self.users.merge(changes))
+
+        # only the members that joined or left change the index
+        memberships: dict[str, set[str]] = dict()
+        for name, group in changes.items():
+            old = self.groups.get(name)
+            if old is not None and old.members is group.members:
+                continue
+            old_members = set(old.members) if old is not None else set()
+            new_members = set(group.members)
+            for member in old_members ^ new_members:
+                if member not in memberships:
+                    memberships[member] = set(self.user_groups.get(member, ()))
+                if member in new_members:
+                    memberships[member].add(name)
+                else:
+                    memberships[member].discard(name)
+
+        user_groups = self.user_groups
+        if memberships:
+            user_groups = user_groups.merge(
+                {user: frozenset(names) for user, names in memberships.items()}
+            )
+        return dataclasses.replace(
+            self, groups=self.groups.merge(changes), user_groups=user_groups
+        )
 
-    write_queue.put((USERS_FILE, users_json))
-    write_queue.put((GROUPS_FILE, groups_json))
+    def removed(self, field: str, key: str) -> "State":
+        """A new State without key in field, KeyError if it is missing"""
+        if field == "users":
+            return dataclasses.replace(self, users=self.users.remove(key))
+
+        group = self.groups[key]
+        return dataclasses.replace(
+            self,
+            groups=self.groups.remove(key),
+            user_groups=self.user_groups.merge(
+                {
+                    member: self.user_groups[member] - {key}
+                    for member in group.members
+                }
+            ),
+        )
 
+    def cleared(self, field: str) -> "State":
+        if field == "users":
+            return dataclasses.replace(self, users=Snapshot())
+        return dataclasses.replace(
+            self, groups=Snapshot(), user_groups=Snapshot()
+        )
 
-def writer_thread() -> None:
-    while True:  # not a busy wait
-        # this blocks and sleeps the thread
-        item: tuple[str, str] | None = write_queue.get()
-        if item is None:
-            break
+    def with_user(self, user: User) -> "State":
+        return self.merged("users", {user.username: user})
 
-        filename, json_data = item
-        with open(filename, "w") as f:
-            f.write(json_data)
+    def with_group(self, group: Group) -> "State":
+        return self.merged("groups", {group.name: group})
 
-        write_queue.task_done()
+    def without_group(self, group_name: str) -> "State":
+        return self.removed("groups", group_name)
 
 
-@app.route("/login", methods=["POST"])
-def login() -> tuple[Response, int]:
-    data: dict = flask.request.get_json()
-    username = data.get("username")
+class Registry(MutableMapping[str, V]):
+    """
+    Dict like view of one field of the current STATE.
+    Reads go to the State that is current when they happen,
+    writes publish a new State while holding REGISTRY_LOCK
+    """
 
-    if not username:
-        return jsonify({"message": "Username is required to Login"}), 400
+    def __init__(self, field: str):
+        self.field = field
 
-    # If user exists, return success
-    if username in USERS:
-        return (
-            jsonify({"message": "Login successful", "username": username}),
-            200,
-        )
+    def snapshot(self) -> Snapshot[V]:
+        # a batch running on this thread reads its own changes
+        state = STATE if BATCH.state is None else BATCH.state
+        return getattr(state, self.field)
 
-    # If user doesn't exist, create a new one
-    USERS[username] = User(username)
-    save_data()
-    return (
-        jsonify(
-            {
-                "message": f"User {username} registered successfully",
-                "username": username,
-            }
-        ),
-        201,
-    )
+    def publish(self, change: Callable[[State], State]) -> None:
+        """Publishes the State change makes of the current one"""
+        global STATE
+        with REGISTRY_LOCK:
+            STATE = dataclasses.replace(
+                change(STATE), version=STATE.version + 1
+            )
 
+    def __getitem__(self, key: str) -> V:
+        return self.snapshot()[key]
 
-def validate_request(request: flask.Request, *keys: str):
-    """
-    A helper function that extracts values for each key
-    from a flask request.
-    It returns the values in the same order as the keys.
-    It is designed to be used with tuple unpacking.
+    def __contains__(self, key: object) -> bool:
+        return key in self.snapshot()
 
-    Raises KeyError if a key is not found in the request.
-    The propper response is included in the exeption
-    including a json payload and a http error code
-    """
-    data: dict = flask.request.get_json()
-    missing_keys = [key for key in keys if data.get(key) is None]
+    def get(self, key: str, default=None):
+        return self.snapshot().get(key, default)
 
-    if missing_keys:
-        # Return the first missing key in the error
-        raise KeyError(
-            (jsonify({"message": f"{missing_keys[0]} is required"}), 400)
-        )
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.snapshot())
 
-    values = [str(data.get(key)) for key in keys]
-    return values[0] if len(values) == 1 else tuple(values)
+    def __len__(self) -> int:
+        return len(self.snapshot())
 
+    def keys(self) -> list[str]:  # type: ignore[override]
+        return list(self.snapshot())
 
-@app.route("/create_group", methods=["POST"])
-def create_group() -> tuple[Response, int]:
-    try:
-        username, group_name = validate_request(
-            flask.request, "username", "group_name"
-        )
-    except KeyError as e:
-        return e.args[0]
+    def values(self) -> list[V]:  # type: ignore[override]
+        return self.snapshot().values()
 
-    if username not in USERS:
-        return jsonify({"message": f"User {username} does not exist"}), 404
+    def items(self) -> list[tuple[str, V]]:  # type: ignore[override]
+        return self.snapshot().items()
 
-    if group_name in GROUPS:
-        return jsonify({"message": f"Group {group_name} already exists"}), 409
+    def __setitem__(self, key: str, value: V) -> None:
+        self.publish(lambda state: state.merged(self.field, {key: value}))
 
-    group = Group(group_name, username)
-    GROUPS[group_name] = group
-    save_data()
+    def __delitem__(self, key: str) -> None:
+        self.publish(lambda state: state.removed(self.field, key))
 
-    return (
-        jsonify(
-            {
-                "message": f"Group {group_name} created successfully",
-                "group": group.to_dict(),
-            }
-        ),
-        201,
-    )
+    def update(self, other=(), /, **kwargs) -> None:
+        # one new version for all the changes instead of one per key
+        changes = dict(other, **kwargs)
+        self.publish(lambda state: state.merged(self.field, changes))
 
+    def clear(self) -> None:
+        self.publish(lambda state: state.cleared(self.field))
 
-@app.route("/join_group", methods=["POST"])
-def join_group() -> tuple[Response, int]:
-    try:
-        username, group_name = validate_request(
-            flask.request, "username", "group_name"
-        )
-    except KeyError as e:
-        return e.args[0]
 
-    if username not in USERS:
-        return jsonify({"message": f"User {username} does not exist"}), 404
+write_queue: queue.Queue[State | None] = queue.Queue()
+# In-memory storage
+STATE = State(Snapshot(), Snapshot())
+USERS: Registry[User] = Registry("users")
+GROUPS: Registry[Group] = Registry("groups")
+
+# Locking
+# waitress handles requests on several threads, so the state is guarded by:
+# - REGISTRY_LOCK for publishing a new STATE, and in the routes
+#   for checking that a user or group doesn't exist yet and adding it.
+#   It is reentrant, so the routes can hold it while adding the entry.
+#   commit() also appends to the journal while holding it
+# - Group.lock for replacing one group, deleting it included
+# Readers never lock, they read from the State that is current when they
+# start, or from one group they looked up, and neither is ever modified.
+# Group.lock is always taken before REGISTRY_LOCK, never the other way around.
+# With worker processes every route that changes the state first takes
+# the journal's flock (see mutating()), before any of the two locks
+REGISTRY_LOCK = threading.RLock()
 
-    if group_name not in GROUPS:
-        return jsonify({"message": f"Group {group_name} does not exist"}), 404
+# File paths
+USERS_FILE = "users.json"
+GROUPS_FILE = "groups.json"
+SNAPSHOT_FILE = "snapshot.bin"
+JOURNAL_FILE = "journal.ndjson"
 
-    group = GROUPS[group_name]
 
-    if username in group.members:
-        return (
-            jsonify(
-                {"message": f"{username} is already member of {group.name}"}
+@contextmanager
+def gc_paused() -> Iterator[None]:
+    """Runs the block without the cyclic garbage collector"""
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def load_data(
+    load_users_dict: dict[str, User],
+    load_groups_dict: dict[str, Group],
+    load_responses_dict: dict[str, dict] | None = None,
+) -> int:
+    """
+    Loads the list of Groups and Users from the snapshot
+    when the server starts, then replays the journal on top of it.
+    The responses of the Idempotency-Keys go into load_responses_dict.
+    Returns the seq of the last operation the loaded data contains
+    """
+    if load_responses_dict is None:
+        load_responses_dict = dict()
+    # none of the loaded objects can be garbage yet, but creating that
+    # many of them would run the cyclic garbage collector again and again
+    with gc_paused():
+        seq = load_snapshot(
+            load_users_dict, load_groups_dict, load_responses_dict
+        )
+        if not os.path.exists(JOURNAL_FILE):
+            return seq
+
+        state = replay(
+            State(
+                Snapshot().merge(load_users_dict),
+                Snapshot().merge(load_groups_dict),
+                seq=seq,
+                responses=Snapshot().merge(load_responses_dict),
             ),
-            200,
+            read_journal(JOURNAL_FILE),
         )
+    for group_name in list(load_groups_dict):
+        if group_name not in state.groups:
+            del load_groups_dict[group_name]
+    load_users_dict.update(state.users)
+    load_groups_dict.update(state.groups)
+    load_responses_dict.clear()
+    load_responses_dict.update(state.responses)
+    return state.seq
+
+
+def load_state() -> None:
+    """Loads the snapshot and the journal after it into STATE"""
+    global STATE
+    responses: dict[str, dict] = dict()
+    seq = load_data(USERS, GROUPS, responses)
+    STATE = dataclasses.replace(
+        STATE, seq=seq, responses=Snapshot().merge(responses)
+    )
 
-    group.members.append(username)
-    save_data()
 
-    return (
-        jsonify(
-            {
-                "message": f"User {username} joined successfully",
-                "group": group.to_dict_no_transactions(),
-            }
-        ),
-        200,
+def load_snapshot(
+    load_users_dict: dict[str, User],
+    load_groups_dict: dict[str, Group],
+    load_responses_dict: dict[str, dict],
+) -> int:
+    """
+    Loads the binary snapshot if there is one, the json files otherwise.
+    Returns the seq of the snapshot
+    """
+    if os.path.exists(SNAPSHOT_FILE):
+        return load_binary_snapshot(
+            SNAPSHOT_FILE,
+            load_users_dict,
+            load_groups_dict,
+            load_responses_dict,
+            bool(CONFIG["lazy_load"] or GROUP_CACHE.budget),
+        )
+    load_users(load_users_dict)
+    return load_groups(load_groups_dict, load_responses_dict)
+
+
+def load_users(load_users_dict: dict[str, User]) -> None:
+    if not os.path.exists(USERS_FILE):
+        return
+
+    try:
+        users_data = json.loads(read_file(USERS_FILE))
+    except RuntimeError:
+        raise
+    except Exception:
+        return
+
+    load_users_dict.update(
+        {username: User(username) for username in map(sys.intern, users_data)}
     )
 
 
-@app.route("/delete_group", methods=["POST"])
-def delete_group() -> tuple[Response, int]:
+def load_groups(
+    load_groups_dict: dict[str, Group],
+    load_responses_dict: dict[str, dict] | None = None,
+) -> int:
+    """Returns the seq the snapshot was written at, 0 if it has none"""
+    if not os.path.exists(GROUPS_FILE):
+        return 0
+
+    groups: dict[str, Group] = dict()
+    # closed even when not read to the end, it holds the file open
+    lines = read_file_lines(GROUPS_FILE)
     try:
-        username, group_name = validate_request(
-            flask.request, "username", "group_name"
-        )
-    except KeyError as e:
-        return e.args[0]
+        first_line = next(lines, b"")
+        if first_line.endswith(GROUPS_FILE_HEADER_END):
+            # one group at a time, the text of all of them and the dicts
+            # of all of them are never in memory together
+            groups_data = json.loads(first_line + b"]}")
+            for line in lines:
+                if line.startswith(b"]"):
+                    break
+                # written by versions that left an empty line without groups
+                if not line.strip():
+                    continue
+                group = Group.from_dict(json.loads(line.rstrip(b",\n")))
+                groups[group.name] = group
+        else:
+            groups_data = json.loads(first_line + b"".join(lines))
+    except RuntimeError:
+        raise
+    except Exception:
+        return 0
+    finally:
+        lines.close()
+
+    seq = 0
+    # older snapshots are a plain list of groups
+    if isinstance(groups_data, dict):
+        seq = groups_data["seq"]
+        if load_responses_dict is not None:
+            load_responses_dict.update(groups_data.get("responses", {}))
+        groups_data = groups_data["groups"]
+
+    for group_dict in groups_data:
+        group = Group.from_dict(group_dict)
+        groups[group.name] = group
+
+    # all at once, so loading into GROUPS publishes a single State
+    load_groups_dict.update(groups)
+    return seq
 
-    if username not in USERS:
-        return jsonify({"message": f"User {username} does not exist"}), 404
 
-    if group_name not in GROUPS:
-        return jsonify({"message": f"Group {group_name} does not exist"}), 404
+def save_data() -> None:
+    """
+    Saves the current in-memory representation of GROUPS and USERS
+    into a json file.
+    For a faster response time, the current State is put into a queue
+    and both the serialization and the writing is done after responding
+    """
+    # with worker processes the parent writes the snapshots
+    if JOURNAL is not None and JOURNAL.shared:
+        return
+    # a batch saves once, after it was published
+    if BATCH.state is not None:
+        return
+    write_queue.put(STATE)
 
-    if not username.startswith("admin"):
-        group = GROUPS[group_name]
-        if group.creator != username:
-            return (
-                jsonify(
-                    {"message": f"Only {group.creator} can delete groups"}
-                ),
-                403,
-            )
 
-    GROUPS.pop(group_name)
-    save_data()
+# bytes write_file() compresses at once and read_file() reads at once.
+# Compressed json is about a tenth of its size, so less of it is read
+FILE_CHUNK_SIZE = 1024 * 1024
+COMPRESSED_CHUNK_SIZE = 64 * 1024
 
-    return (
-        jsonify({"message": f"Group {group_name} deleted succesfuly"}),
-        200,
-    )
 
+def compressor(codec: str):
+    """A compressobj of codec, with compress() and flush()"""
+    if codec == "gzip":
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    if codec == "zlib":
+        return zlib.compressobj(6)
+    return zstandard.ZstdCompressor(level=3).compressobj()
 
-def settle_up_internal(username1: str, group: Group, username2: str) -> None:
-    # Remove all transactions between the two members
-    updated_transactions: list[Transaction] = []
 
-    for trn in group.transactions:
-        if trn.from_user == username1 and trn.to_user == username2:
-            continue
-        if trn.from_user == username2 and trn.to_user == username1:
-            continue
+def decompressor(codec: str):
+    """A decompressobj of codec, with decompress() and flush()"""
+    if codec == "gzip":
+        return zlib.decompressobj(31)
+    if codec == "zlib":
+        return zlib.decompressobj()
+    if zstandard is None:
+        # unlike a broken file, not a reason to start without the data
+        raise RuntimeError("Reading zstd needs the zstandard package")
+    return zstandard.ZstdDecompressor().decompressobj()
 
-        updated_transactions.append(trn)
 
-    group.transactions = updated_transactions
+def write_file(filename: str, data: str | Iterable[str]) -> None:
+    """
+    Writes data, a string or the parts of one, into a temporary file
+    and renames it over filename, so the file is never seen half written.
+    Compressed with CONFIG["compression"], chunk by chunk
+    """
+    if isinstance(data, str):
+        data = (data,)
+    codec = CONFIG["compression"]
+    compress = None if codec == "none" else compressor(str(codec))
+    temporary_filename = filename + ".tmp"
+    with open(temporary_filename, "wb") as f:
+
+        def write(text: str) -> None:
+            for start in range(0, len(text), FILE_CHUNK_SIZE):
+                chunk = text[start : start + FILE_CHUNK_SIZE].encode()
+                f.write(
+                    chunk if compress is None else compress.compress(chunk)
+                )
 
+        # small parts are collected into chunks first
+        parts: list[str] = []
+        size = 0
+        for part in data:
+            parts.append(part)
+            size += len(part)
+            if size >= FILE_CHUNK_SIZE:
+                write("".join(parts))
+                parts.clear()
+                size = 0
+        write("".join(parts))
+        if compress is not None:
+            f.write(compress.flush())
+    os.replace(temporary_filename, filename)
+
+
+def file_codec(head: bytes) -> str | None:
+    """The codec of a file starting with head, None if uncompressed"""
+    for codec, magics in COMPRESSION_MAGIC.items():
+        if head.startswith(magics):
+            return codec
+    return None
+
+
+def read_file(filename: str) -> bytes:
+    """
+    The contents of a file write_file() wrote, decompressed chunk by
+    chunk with the codec its first bytes belong to
+    """
+    return b"".join(read_chunks(filename))
 
-@app.route("/settle_up", methods=["POST"])
-def settle_up() -> tuple[Response, int]:
-    try:
-        username, to_user, group_name = validate_request(
-            flask.request, "username", "to_user", "group_name"
-        )
-    except KeyError as e:
-        return e.args[0]
 
-    if username not in USERS or to_user not in USERS:
-        return jsonify({"message": f"User {username} does not exist"}), 404
+def read_chunks(filename: str) -> Iterator[bytes]:
+    with open(filename, "rb") as f:
+        head = f.read(4)
+        codec = file_codec(head)
+        if codec is None:
+            yield head
+            while chunk := f.read(FILE_CHUNK_SIZE):
+                yield chunk
+            return
 
-    if group_name not in GROUPS:
-        return jsonify({"message": f"Group {group_name} does not exist"}), 404
+        decompress = decompressor(codec)
+        yield decompress.decompress(head)
+        while chunk := f.read(COMPRESSED_CHUNK_SIZE):
+            yield decompress.decompress(chunk)
+        yield decompress.flush()
 
-    group = GROUPS[group_name]
 
-    if username not in group.members or to_user not in group.members:
-        return (
-            jsonify(
-                {"message": f"User {username} is not a member of {group.name}"}
-            ),
-            403,
-        )
+def read_file_lines(filename: str) -> Iterator[bytes]:
+    """
+    The lines of a file write_file() wrote, one at a time,
+    so the whole file is never in memory at once.
+    An uncompressed file is mapped and its lines sliced out of the mapping
+    """
+    with open(filename, "rb") as f:
+        compressed = file_codec(f.read(4)) is not None
+        if not compressed and os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                start = 0
+                while start < len(data):
+                    end = data.find(b"\n", start) + 1 or len(data)
+                    yield data[start:end]
+                    start = end
+            return
 
-    original_transaction_count = len(group.transactions)
-    settle_up_internal(username, group, to_user)
-    save_data()
-    settled_transaction_count = original_transaction_count - len(
-        group.transactions
-    )
-    return (
-        jsonify(
-            {
-                "message": "Settled up successfully",
-                "transactions_settled": settled_transaction_count,
-                "group": group.to_dict_no_transactions(),
-            }
-        ),
-        200,
+    # the parts of the line that isn't complete yet
+    parts: list[bytes] = []
+    for chunk in read_chunks(filename):
+        start = 0
+        while (end := chunk.find(b"\n", start) + 1) > 0:
+            parts.append(chunk[start:end])
+            yield b"".join(parts)
+            parts.clear()
+            start = end
+        parts.append(chunk[start:])
+    if any(parts):
+        yield b"".join(parts)
+
+
+# groups.json is one json object, laid out so it can be read line by line:
+#   {"seq": 1, "responses": {...}, "groups": [
+#   {the first group},
+#   {the second group}
+#   ]}
+# Older snapshots are the same object on a single line, or only the list
+GROUPS_FILE_HEADER_END = b'"groups": [\n'
+
+
+def groups_file_lines(state: State) -> Iterator[str]:
+    header = json.dumps(
+        {"seq": state.seq, "responses": dict(state.responses.items())}
+    )
+    yield header[:-1] + ', "groups": [\n'
+    separator = ""
+    for group in state.groups.values():
+        yield separator + json.dumps(group.to_dict())
+        separator = ",\n"
+    # the closing bracket on a line of its own, also without groups
+    yield ("\n" if separator else "") + "]}"
+
+
+def write_state(state: State) -> None:
+    if CONFIG["snapshot_format"] == "binary":
+        write_binary_snapshot(state, SNAPSHOT_FILE)
+        if GROUP_CACHE.budget:
+            attach_segments(state, SNAPSHOT_FILE)
+        return
+
+    write_file(USERS_FILE, json.dumps(list(state.users)))
+    write_file(GROUPS_FILE, groups_file_lines(state))
+    # it would be loaded instead of the json files
+    if os.path.exists(SNAPSHOT_FILE):
+        os.remove(SNAPSHOT_FILE)
+
+
+# Binary snapshots
+# SNAPSHOT_MAGIC, then sections of a 4 byte tag, the length of the
+# payload (Q) and the payload. Every name is stored once, in STRS,
+# and everything else refers to it by its index in there:
+#   HEAD  the seq (Q)
+#   STRS  the number of strings (I), where every string ends (I each)
+#         and all strings one after the other, utf-8
+#   USER  the users (I each)
+#   GRPS  a SNAPSHOT_GROUP for every group
+#   MEMB  the members of all groups, one group after the other (I each)
+#   TXFR  from_user of all transactions, group after group (I each)
+#   TXTO  to_user (I each)
+#   TXID  id (Q each)
+#   TXAM  amount (d each)
+#   RESP  State.responses as json
+# All numbers are little endian, the arrays load without being parsed.
+SNAPSHOT_MAGIC = b"BWSNAP1\n"
+# name, creator, version, transaction_count,
+# number of members, number of transactions
+SNAPSHOT_GROUP = struct.Struct("<IIQQIQ")
+
+
+def snapshot_array(typecode: str, values: Iterable) -> array.array:
+    """An array of values swapped from or into the byte order of snapshots"""
+    values = array.array(typecode, values)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
+def write_binary_snapshot(state: State, filename: str) -> None:
+    strings: dict[str, int] = dict()
+
+    def index(name: str) -> int:
+        return strings.setdefault(name, len(strings))
+
+    users = array.array("I", map(index, state.users))
+    groups = bytearray()
+    members = array.array("I")
+    from_users = array.array("I")
+    to_users = array.array("I")
+    ids = array.array("Q")
+    amounts = array.array("d")
+    # by the strings of the snapshots segments were read from,
+    # the index here of their indexes in there
+    segment_indexes: dict[int, dict[int, int]] = dict()
+    for group in state.groups.values():
+        transactions = group.stored_transactions()
+        groups += SNAPSHOT_GROUP.pack(
+            index(group.name),
+            index(group.creator),
+            group.version,
+            group.transaction_count,
+            len(group.members),
+            len(transactions),
+        )
+        members.extend(map(index, group.members))
+        if isinstance(transactions, TransactionSegment):
+            segment = transactions
+            # copied column by column, without making the transactions
+            indexes = segment_indexes.setdefault(id(segment.name), dict())
+            for old_index in {*segment.from_users, *segment.to_users}:
+                indexes[old_index] = index(segment.name(old_index))
+            from_users.extend(map(indexes.__getitem__, segment.from_users))
+            to_users.extend(map(indexes.__getitem__, segment.to_users))
+            ids.extend(segment.ids)
+            amounts.extend(segment.amounts)
+            continue
+        for transaction in transactions:
+            from_users.append(index(transaction.from_user))
+            to_users.append(index(transaction.to_user))
+            ids.append(transaction.id)
+            amounts.append(transaction.amount)
+
+    ends = array.array("I", itertools.accumulate(map(len, strings)))
+    if sys.byteorder != "little":
+        for values in (
+            ends,
+            users,
+            members,
+            from_users,
+            to_users,
+            ids,
+            amounts,
+        ):
+            values.byteswap()
+    sections = {
+        b"HEAD": struct.pack("<Q", state.seq),
+        # names are stored as they come, lone surrogates included
+        b"STRS": struct.pack("<I", len(strings))
+        + ends.tobytes()
+        + "".join(strings).encode(errors="surrogatepass"),
+        b"USER": users.tobytes(),
+        b"GRPS": bytes(groups),
+        b"MEMB": members.tobytes(),
+        b"TXFR": from_users.tobytes(),
+        b"TXTO": to_users.tobytes(),
+        b"TXID": ids.tobytes(),
+        b"TXAM": amounts.tobytes(),
+        b"RESP": json.dumps(dict(state.responses.items())).encode(),
+    }
+
+    temporary_filename = filename + ".tmp"
+    with open(temporary_filename, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        for tag, payload in sections.items():
+            f.write(tag + struct.pack("<Q", len(payload)))
+            f.write(payload)
+    os.replace(temporary_filename, filename)
+
+
+def load_binary_snapshot(
+    filename: str,
+    load_users_dict: dict[str, User],
+    load_groups_dict: dict[str, Group],
+    load_responses_dict: dict[str, dict],
+    lazy: bool = False,
+) -> int:
+    """
+    Loads a snapshot of write_binary_snapshot(), mapped into memory.
+    With lazy, the groups get TransactionSegments of the mapping
+    instead of their transactions. Returns the seq of the snapshot
+    """
+    with open(filename, "rb") as f:
+        # skipped like unreadable json files
+        if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            return 0
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    seq = read_binary_snapshot(
+        data, load_users_dict, load_groups_dict, load_responses_dict, lazy
+    )
+    if not lazy:
+        # the views read_binary_snapshot() used are gone with its frame.
+        # The segments of lazy groups keep the mapping open instead,
+        # a new snapshot replaces the file but not the mapped one
+        data.close()
+    return seq
+
+
+def snapshot_sections(data: mmap.mmap) -> dict[bytes, memoryview]:
+    """The payloads of the sections of a binary snapshot by their tag"""
+    view = memoryview(data)
+    sections: dict[bytes, memoryview] = dict()
+    offset = len(SNAPSHOT_MAGIC)
+    while offset < len(data):
+        tag = bytes(view[offset : offset + 4])
+        (length,) = struct.unpack_from("<Q", data, offset + 4)
+        sections[tag] = view[offset + 12 : offset + 12 + length]
+        offset += 12 + length
+    return sections
+
+
+def snapshot_numbers(
+    sections: dict[bytes, memoryview], tag: bytes, typecode: str = "I"
+) -> Sequence:
+    if sys.byteorder == "little":
+        return sections[tag].cast(typecode)
+    return snapshot_array(typecode, sections[tag].cast(typecode))
+
+
+def snapshot_strings(sections: dict[bytes, memoryview]) -> list[str]:
+    (count,) = struct.unpack_from("<I", sections[b"STRS"])
+    ends = struct.unpack_from(f"<{count}I", sections[b"STRS"], 4)
+    text = bytes(sections[b"STRS"][4 + 4 * count :]).decode(
+        errors="surrogatepass"
+    )
+    return [
+        sys.intern(text[start:end])
+        for start, end in zip(itertools.chain((0,), ends), ends)
+    ]
+
+
+def snapshot_groups(
+    sections: dict[bytes, memoryview], name: Callable[[int], str]
+) -> Iterator[tuple[tuple[int, ...], Sequence[int], TransactionSegment]]:
+    """
+    The groups of a binary snapshot, in the order they were written in.
+    For every group the first 4 fields of its SNAPSHOT_GROUP,
+    the indexes of its members and its transactions
+    """
+    members = snapshot_numbers(sections, b"MEMB")
+    from_users = snapshot_numbers(sections, b"TXFR")
+    to_users = snapshot_numbers(sections, b"TXTO")
+    ids = snapshot_numbers(sections, b"TXID", "Q")
+    amounts = snapshot_numbers(sections, b"TXAM", "d")
+    member_offset = transaction_offset = 0
+    for header in SNAPSHOT_GROUP.iter_unpack(sections[b"GRPS"]):
+        member_end = member_offset + header[4]
+        transaction_end = transaction_offset + header[5]
+        yield header[:4], members[member_offset:member_end], (
+            TransactionSegment(
+                name,
+                from_users[transaction_offset:transaction_end],
+                to_users[transaction_offset:transaction_end],
+                amounts[transaction_offset:transaction_end],
+                ids[transaction_offset:transaction_end],
+            )
+        )
+        member_offset = member_end
+        transaction_offset = transaction_end
+
+
+def attach_segments(state: State, filename: str) -> None:
+    """
+    Gives the groups of state their segments in filename,
+    a binary snapshot just written of state, so they can be evicted
+    """
+    with open(filename, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    sections = snapshot_sections(data)
+    name = snapshot_strings(sections).__getitem__
+    for group, (_, _, segment) in zip(
+        state.groups.values(), snapshot_groups(sections, name)
+    ):
+        group.segment = segment
+
+
+def read_binary_snapshot(
+    data: mmap.mmap,
+    load_users_dict: dict[str, User],
+    load_groups_dict: dict[str, Group],
+    load_responses_dict: dict[str, dict],
+    lazy: bool = False,
+) -> int:
+    """
+    The arrays are read where they are in data, the only objects made
+    are one string per name and the Users, Groups and Transactions
+    """
+    sections = snapshot_sections(data)
+    (seq,) = struct.unpack("<Q", sections[b"HEAD"])
+    name = snapshot_strings(sections).__getitem__
+
+    load_users_dict.update(
+        {
+            username: User(username)
+            for username in map(name, snapshot_numbers(sections, b"USER"))
+        }
+    )
+
+    groups: dict[str, Group] = dict()
+    for header, members, segment in snapshot_groups(sections, name):
+        group_name, creator, version, transaction_count = header
+        group = Group(
+            name(group_name),
+            name(creator),
+            map(name, members),
+            None if lazy else segment,
+            version,
+            transaction_count,
+            segment if lazy else None,
+        )
+        groups[group.name] = group
+
+    load_groups_dict.update(groups)
+    load_responses_dict.update(json.loads(bytes(sections[b"RESP"])))
+    return seq
+
+
+def writer_thread() -> None:
+    written_version = -1
+    write_errors = {"count": 0, "last": None}
+    METRICS["writer"] = write_errors
+    stop = False
+
+    while not stop:  # not a busy wait
+        # this blocks and sleeps the thread
+        states: list[State | None] = [write_queue.get()]
+
+        # when saves pile up only the newest state needs to be written
+        while not write_queue.empty():
+            states.append(write_queue.get_nowait())
+
+        stop = None in states
+        newest = max(
+            (state for state in states if state is not None),
+            key=lambda state: state.version,
+            default=None,
+        )
+
+        # states can be queued out of order, never go back to an older one
+        if newest is not None and newest.version > written_version:
+            try:
+                write_state(newest)
+                written_version = newest.version
+            except Exception as e:
+                # the next save tries again, the journal has the changes
+                write_errors["count"] += 1
+                write_errors["last"] = repr(e)
+                traceback.print_exc()
+
+        # so write_queue.join() also waits for the write
+        for _ in states:
+            write_queue.task_done()
+
+
+# Operations
+# Every change of the state is one of these functions. They get the
+# current State and the arguments the route validated, and return the new
+# State without looking at anything else, so replaying the journal
+# reproduces exactly what the routes did
+def apply_login(state: State, username: str) -> State:
+    return state.with_user(User(sys.intern(username)))
+
+
+def apply_create_group(state: State, username: str, group_name: str) -> State:
+    return state.with_group(Group(group_name, username))
+
+
+def apply_join_group(state: State, username: str, group_name: str) -> State:
+    group = state.groups[group_name]
+    return state.with_group(
+        group.replace(members=(*group.members, sys.intern(username)))
+    )
+
+
+def apply_delete_group(state: State, group_name: str) -> State:
+    return state.without_group(group_name)
+
+
+def apply_settle_up(
+    state: State, username: str, to_user: str, group_name: str
+) -> State:
+    group = state.groups[group_name]
+    return state.with_group(settle_up_internal(username, group, to_user))
+
+
+def apply_kick_user(
+    state: State, username: str, target_username: str, group_name: str
+) -> State:
+    group = state.groups[group_name]
+
+    # kicked user settles all of his debts
+    for member_name in group.members:
+        group = settle_up_internal(username, group, member_name)
+
+    return state.with_group(
+        group.replace(
+            members=[
+                member for member in group.members if member != target_username
+            ]
+        )
+    )
+
+
+def apply_add_expense(
+    state: State, username: str, group_name: str, amount: float
+) -> State:
+    group = state.groups[group_name]
+    return state.with_group(
+        group.replace(
+            transactions=[
+                *group.transactions,
+                *expense_transactions(
+                    group, username, amount, group.transaction_count
+                ),
+            ]
+        )
+    )
+
+
+def expense_transactions(
+    group: Group, username: str, amount: float, transaction_count: int
+) -> list[Transaction]:
+    """
+    The transactions an expense of username adds to group,
+    numbered after transaction_count
+    """
+    # the payer of all the transactions
+    username = sys.intern(username)
+
+    # Calculate equal share for each member
+    share_per_member = amount / len(group.members)
+
+    # Create transactions for each member (except the payer)
+    debtors = [member for member in group.members if member != username]
+    return [
+        Transaction(
+            member, username, share_per_member, transaction_count + number
+        )
+        for number, member in enumerate(debtors, 1)
+    ]
+
+
+def apply_put_group(state: State, group: dict) -> State:
+    return state.with_group(Group.from_dict(group))
+
+
+def apply_import(
+    state: State,
+    users: list[str],
+    groups: list[dict],
+    transactions: list[list],
+) -> State:
+    """
+    Adds the users, the groups and the transactions, given as
+    [group_name, from_user, to_user, amount], that Importer checked
+    """
+    state = state.merged(
+        "users", {user: User(user) for user in map(sys.intern, users)}
+    )
+
+    changes = {
+        group["name"]: Group(group["name"], group["creator"], group["members"])
+        for group in groups
+    }
+    added: dict[str, list[list]] = dict()
+    for transaction in transactions:
+        added.setdefault(transaction[0], []).append(transaction)
+    for group_name, group_transactions in added.items():
+        group = changes.get(group_name) or state.groups[group_name]
+        changes[group_name] = group.replace(
+            transactions=[
+                *group.transactions,
+                *(
+                    Transaction(
+                        sys.intern(from_user),
+                        sys.intern(to_user),
+                        amount,
+                        group.transaction_count + number,
+                    )
+                    for number, (_, from_user, to_user, amount) in enumerate(
+                        group_transactions, 1
+                    )
+                ),
+            ]
+        )
+
+    return state.merged("groups", changes)
+
+
+def apply_remember_response(
+    state: State, key: str, ts: float, request: str, status: int, response
+) -> State:
+    responses = state.responses.merge(
+        {
+            key: {
+                "ts": ts,
+                "request": request,
+                "status": status,
+                "response": response,
+            }
+        }
+    )
+
+    limit = int(CONFIG["idempotency_keys"])
+    if len(responses) > limit:
+        # drops the expired and the oldest quarter at once, so the sort
+        # only happens every limit / 4 requests
+        newest = sorted(
+            (
+                item
+                for item in responses.items()
+                if item[1]["ts"] > ts - float(CONFIG["idempotency_ttl"])
+            ),
+            key=lambda item: item[1]["ts"],
+        )[-max(1, limit * 3 // 4) :]
+        responses = Snapshot().merge(dict(newest))
+
+    return dataclasses.replace(state, responses=responses)
+
+
+OPERATIONS: dict[str, Callable[..., State]] = {
+    "login": apply_login,
+    "create_group": apply_create_group,
+    "join_group": apply_join_group,
+    "delete_group": apply_delete_group,
+    "settle_up": apply_settle_up,
+    "kick_user": apply_kick_user,
+    "add_expense": apply_add_expense,
+    "put_group": apply_put_group,
+    "import": apply_import,
+    "remember_response": apply_remember_response,
+}
+
+
+def commit(operation: str, **args) -> None:
+    """
+    Applies one of the OPERATIONS to STATE and publishes the result.
+    When journaling, the operation is appended to the journal first,
+    under REGISTRY_LOCK so the journal has the order of the changes
+    """
+    global STATE
+    if BATCH.state is not None:
+        old_state = BATCH.state
+        BATCH.state = OPERATIONS[operation](old_state, **args)
+        BATCH.entries.append((operation, args, old_state, BATCH.state))
+        return
+
+    with REGISTRY_LOCK:
+        old_state = STATE
+        state = OPERATIONS[operation](STATE, **args)
+        seq = STATE.seq + 1
+        if JOURNAL is not None:
+            JOURNAL.append(seq, operation, args)
+        STATE = new_state = dataclasses.replace(
+            state, version=STATE.version + 1, seq=seq
+        )
+
+    CHANGES.notify(changed_keys(old_state, new_state, [args]))
+    EVENTS.publish(seq, operation, args, old_state, new_state)
+
+
+class BatchState(threading.local):
+    """
+    The batch running on this thread, see batched().
+    While state is not None commit() applies the operations to it
+    instead of STATE, and USERS and GROUPS read from it
+    """
+
+    state: State | None = None
+
+    def __init__(self):
+        # operation, args, the state before and after it
+        self.entries: list[tuple[str, dict, State, State]] = []
+
+
+BATCH = BatchState()
+
+
+class BatchRollback(Exception):
+    """Raised in batched() to drop the operations of the batch"""
+
+
+@contextmanager
+def batched() -> Iterator[None]:
+    """
+    Collects the operations commit()-ed in the with block and publishes
+    them as one change at the end, journaled in a single write.
+    Holds REGISTRY_LOCK for the whole block, so nothing else changes
+    the state in between. Publishes nothing when the block raises.
+    Inside another batch it drops only its own operations when it raises
+    """
+    global STATE
+    if BATCH.state is not None:
+        # inside another batch, its operations join that batch
+        state, count = BATCH.state, len(BATCH.entries)
+        try:
+            yield
+        except BaseException:
+            BATCH.state = state
+            del BATCH.entries[count:]
+            raise
+        return
+
+    with REGISTRY_LOCK:
+        old_state = BATCH.state = STATE
+        BATCH.entries = []
+        try:
+            yield
+            entries = BATCH.entries
+        finally:
+            BATCH.state = None
+            BATCH.entries = []
+
+        if not entries:
+            return
+        seq = STATE.seq
+        if JOURNAL is not None:
+            JOURNAL.append_all(
+                [
+                    (seq + number, operation, args)
+                    for number, (operation, args, _, _) in enumerate(
+                        entries, 1
+                    )
+                ]
+            )
+        STATE = new_state = dataclasses.replace(
+            entries[-1][3], version=STATE.version + 1, seq=seq + len(entries)
+        )
+
+    CHANGES.notify(
+        changed_keys(old_state, new_state, [entry[1] for entry in entries])
+    )
+    for number, (operation, args, before, after) in enumerate(entries, 1):
+        EVENTS.publish(seq + number, operation, args, before, after)
+
+
+# operations that don't touch any group
+GROUPLESS_OPERATIONS = {"login", "remember_response"}
+
+
+def replay(
+    state: State, entries: Iterable[dict], until: int | None = None
+) -> State:
+    """
+    Applies the journal entries newer than state.seq to state,
+    up to and including the one with seq until if it is given.
+    The expenses of a group are collected until something else uses
+    the group and then added at once, so its transactions are copied
+    once instead of for every expense. Same result as one at a time
+    """
+    seq = state.seq
+    if until is not None and until <= seq:
+        return state
+    # group name: the transactions of the expenses collected for it
+    # and how many expenses they are
+    expenses: dict[str, tuple[list[Transaction], int]] = dict()
+
+    def add_expenses(group_names: Iterable[str]) -> None:
+        nonlocal state
+        changes: dict[str, Group] = dict()
+        for group_name in group_names:
+            transactions, count = expenses.pop(group_name)
+            group = state.groups[group_name]
+            changed = group.replace(
+                transactions=[*group.transactions, *transactions]
+            )
+            changed.version = group.version + count
+            changes[group_name] = changed
+        state = state.merged("groups", changes)
+
+    for entry in entries:
+        if entry["seq"] <= seq:
+            continue
+        operation = entry["op"]
+        args = entry["args"]
+        group_name = args.get("group_name")
+        if operation == "add_expense":
+            group = state.groups.get(group_name)
+            # a journal left over from a different snapshot
+            # can refer to groups that don't exist
+            if group is not None:
+                transactions, count = expenses.get(group_name, ([], 0))
+                transactions.extend(
+                    expense_transactions(
+                        group,
+                        args["username"],
+                        args["amount"],
+                        group.transaction_count + len(transactions),
+                    )
+                )
+                expenses[group_name] = (transactions, count + 1)
+        else:
+            if operation in GROUPLESS_OPERATIONS:
+                pass
+            elif group_name is None:
+                add_expenses(list(expenses))
+            elif group_name in expenses:
+                add_expenses([group_name])
+            try:
+                state = OPERATIONS[operation](state, **args)
+            except KeyError:
+                pass
+        seq = entry["seq"]
+        if seq == until:
+            break
+
+    if expenses:
+        add_expenses(list(expenses))
+    return dataclasses.replace(state, seq=seq)
+
+
+def read_journal(filename: str) -> Iterator[dict]:
+    with open(filename, "rb") as f:
+        for line in f:
+            # a crash can cut off the last line
+            if not line.endswith(b"\n"):
+                return
+            yield json.loads(line)
+
+
+class Journal:
+    """
+    JOURNAL_FILE, one json line for every operation commit() applied:
+    {"seq": 1, "ts": 1700000000.0, "op": "login", "args": {...}}.
+    The last snapshot and the lines after its seq are the whole state.
+
+    With worker processes the journal is shared: routes that change the
+    state hold its flock, so one process at a time changes it, and every
+    process applies what the others appended (catch_up()) before it
+    reads or changes the state.
+
+    A read only journal is the journal of the primary a replica follows,
+    from the start, replay() skips what the replica's snapshot contains
+    """
+
+    def __init__(
+        self, filename: str, shared: bool = False, read_only: bool = False
+    ):
+        self.filename = filename
+        self.shared = shared
+        self.read_only = read_only
+        # seconds the last changes catch_up() applied were behind
+        self.lag = 0.0
+        # operations catch_up() applied
+        self.applied = 0
+
+        if read_only:
+            self.fd = os.open(filename, os.O_RDONLY)
+            self.offset = 0
+        else:
+            self.fd = os.open(
+                filename, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644
+            )
+            # drop a last line that a crash cut off
+            size = os.fstat(self.fd).st_size
+            self.offset = complete_length(self.fd, size)
+            if self.offset < size:
+                os.ftruncate(self.fd, self.offset)
+
+        # one thread of this process at a time holds the flock
+        self.lock = threading.Lock()
+
+    def reopen(self) -> None:
+        """
+        Opens the file again after a fork,
+        the flock is only exclusive between different open files
+        """
+        os.close(self.fd)
+        self.fd = os.open(self.filename, os.O_RDWR | os.O_APPEND)
+        self.lock = threading.Lock()
+
+    def append(self, seq: int, operation: str, args: dict) -> None:
+        self.append_all([(seq, operation, args)])
+
+    def append_all(self, entries: list[tuple[int, str, dict]]) -> None:
+        """Appends the (seq, operation, args) entries"""
+        ts = time.time()
+        data = "".join(
+            json.dumps({"seq": seq, "ts": ts, "op": operation, "args": args})
+            + "\n"
+            for seq, operation, args in entries
+        ).encode()
+        # a single write, so other processes never see half a line
+        # followed by the line of someone else
+        os.write(self.fd, data)
+        self.offset += len(data)
+
+    def read_new(self) -> list[dict]:
+        """The complete lines appended since the last call"""
+        size = os.fstat(self.fd).st_size
+        if size <= self.offset:
+            return []
+
+        data = os.pread(self.fd, size - self.offset, self.offset)
+        data = data[: data.rfind(b"\n") + 1]
+        self.offset += len(data)
+        return [json.loads(line) for line in data.splitlines()]
+
+    def catch_up(self) -> None:
+        """Applies the operations other processes appended to STATE"""
+        global STATE
+        # cheap enough for every request, usually nothing is new
+        if os.fstat(self.fd).st_size <= self.offset:
+            self.lag = 0.0
+            return
+
+        with REGISTRY_LOCK:
+            old_state = STATE
+            entries = self.read_new()
+            if not entries:
+                return
+            self.lag = time.time() - entries[0]["ts"]
+            self.applied += len(entries)
+            state = replay(STATE, entries)
+            STATE = new_state = dataclasses.replace(
+                state, version=STATE.version + 1
+            )
+
+        CHANGES.notify(
+            changed_keys(
+                old_state, new_state, [entry["args"] for entry in entries]
+            )
+        )
+        for entry in entries:
+            EVENTS.publish(
+                entry["seq"], entry["op"], entry["args"], old_state, new_state
+            )
+
+    @contextmanager
+    def exclusive(self) -> Iterator[None]:
+        """Holds the flock, with the state caught up to the journal"""
+        if not self.shared:
+            yield
+            return
+
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                self.catch_up()
+                yield
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+def complete_length(fd: int, size: int) -> int:
+    """The length of the file up to and including its last newline"""
+    end = size
+    while end > 0:
+        start = max(0, end - 65536)
+        newline = os.pread(fd, end - start, start).rfind(b"\n")
+        if newline != -1:
+            return start + newline + 1
+        end = start
+    return 0
+
+
+class ChangeNotifier:
+    """
+    Wakes the requests waiting in /wait_for_changes.
+    Waiters subscribe to keys, ("group", name) for a group they watch
+    and ("user", name) for the groups of a user, with a function
+    that wakes them. It is called from the thread of the change,
+    so waiters on an event loop pass one that wakes them thread safely
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters: dict[tuple[str, str], set[Callable[[], None]]] = dict()
+
+    def subscribe(
+        self, keys: Iterable[tuple[str, str]], wake: Callable[[], None]
+    ) -> None:
+        with self.lock:
+            for key in keys:
+                self.waiters.setdefault(key, set()).add(wake)
+
+    def unsubscribe(
+        self, keys: Iterable[tuple[str, str]], wake: Callable[[], None]
+    ) -> None:
+        with self.lock:
+            for key in keys:
+                waiters = self.waiters.get(key)
+                if waiters is not None:
+                    waiters.discard(wake)
+                    if not waiters:
+                        del self.waiters[key]
+
+    def notify(self, keys: Iterable[tuple[str, str]]) -> None:
+        with self.lock:
+            woken = {
+                wake for key in keys for wake in self.waiters.get(key, ())
+            }
+        for wake in woken:
+            wake()
+
+
+class WaitingThreads:
+    """
+    Counts the waitress threads held by requests that wait for changes,
+    at most CONFIG["waiting_threads"] of them
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {"waiting": 0, "refused": 0}
+        METRICS["waiting_threads"] = self.stats
+
+    def acquire(self) -> bool:
+        """False when the threads are all taken"""
+        with self.lock:
+            if self.stats["waiting"] >= int(CONFIG["waiting_threads"]):
+                self.stats["refused"] += 1
+                return False
+            self.stats["waiting"] += 1
+            return True
+
+    def release(self) -> None:
+        with self.lock:
+            self.stats["waiting"] -= 1
+
+
+def waiting_refused() -> tuple[Response, int]:
+    message = (
+        "Too many requests are waiting, try again later. "
+        "The async server (BWISE_SERVER=async) has no such limit"
+    )
+    return jsonify({"message": message}), 503
+
+
+CHANGES = ChangeNotifier()
+WAITING_THREADS = WaitingThreads()
+GROUP_CACHE = GroupCache(int(CONFIG["resident_transactions"]))
+
+
+def changed_keys(
+    old: State, new: State, args: Iterable[dict]
+) -> set[tuple[str, str]]:
+    """
+    The ChangeNotifier keys of the groups the operations with args
+    changed, with the members the groups had before and after
+    """
+    keys: set[tuple[str, str]] = set()
+    for operation_args in args:
+        group_name = operation_args.get("group_name")
+        if "group" in operation_args:
+            group_name = operation_args["group"]["name"]
+        if group_name is None:
+            continue
+
+        keys.add(("group", group_name))
+        for state in (old, new):
+            group = state.groups.get(group_name)
+            if group is not None:
+                keys.update(("user", member) for member in group.members)
+
+    return keys
+
+
+class Subscriber:
+    """A /events stream, with the frames it still has to send"""
+
+    def __init__(self, username: str, wake: Callable[[], None]):
+        self.username = username
+        self.wake = wake
+        self.frames: collections.deque[bytes] = collections.deque()
+        # set when it fell behind by more than the buffer
+        self.dropped = False
+
+
+class EventHub:
+    """
+    Publishes the changes of groups to the /events streams of their
+    members. Every change is serialized into a server-sent events frame
+    once and appended to the buffers of the subscribers it concerns.
+    A subscriber whose buffer is full is dropped instead of buffering
+    without limit, its stream then ends and the client reconnects
+    """
+
+    # the operations members are told about
+    OPERATIONS = {
+        "add_expense",
+        "settle_up",
+        "join_group",
+        "kick_user",
+        "delete_group",
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers: dict[str, set[Subscriber]] = dict()
+        self.stats = {"subscribers": 0, "published": 0, "dropped": 0}
+        METRICS["events"] = self.stats
+
+    def subscribe(self, username: str, wake: Callable[[], None]) -> Subscriber:
+        subscriber = Subscriber(username, wake)
+        with self.lock:
+            self.subscribers.setdefault(username, set()).add(subscriber)
+            self.stats["subscribers"] += 1
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        with self.lock:
+            subscribers = self.subscribers.get(subscriber.username, set())
+            if subscriber in subscribers:
+                subscribers.remove(subscriber)
+                self.stats["subscribers"] -= 1
+                if not subscribers:
+                    del self.subscribers[subscriber.username]
+
+    def publish(
+        self, seq: int, operation: str, args: dict, old: State, new: State
+    ) -> None:
+        if operation not in self.OPERATIONS or not self.subscribers:
+            return
+
+        group_name = args["group_name"]
+        group = new.groups.get(group_name)
+        members: set[str] = set()
+        for state in (old, new):
+            if group_name in state.groups:
+                members.update(state.groups[group_name].members)
+
+        data = {
+            "seq": seq,
+            "op": operation,
+            "group_name": group_name,
+            "version": group.version if group is not None else None,
+            "args": args,
+        }
+        frame = (
+            f"id: {seq}\nevent: {operation}\ndata: {json.dumps(data)}\n\n"
+        ).encode()
+        limit = int(CONFIG["event_buffer"])
+
+        woken: list[Subscriber] = []
+        with self.lock:
+            self.stats["published"] += 1
+            for member in members:
+                for subscriber in list(self.subscribers.get(member, ())):
+                    if len(subscriber.frames) >= limit:
+                        subscriber.dropped = True
+                        self.subscribers[member].discard(subscriber)
+                        self.stats["subscribers"] -= 1
+                        self.stats["dropped"] += 1
+                    else:
+                        subscriber.frames.append(frame)
+                    woken.append(subscriber)
+                if not self.subscribers.get(member, True):
+                    del self.subscribers[member]
+
+        for subscriber in woken:
+            subscriber.wake()
+
+
+EVENTS = EventHub()
+# the last frame of a stream that was dropped for being too slow
+DROPPED_FRAME = b'event: dropped\ndata: {"message": "Too slow"}\n\n'
+
+
+# None unless the journal or the workers are turned on
+JOURNAL: Journal | None = None
+
+
+class ClaimedKeys:
+    """The Idempotency-Keys of the requests running in this process"""
+
+    def __init__(self):
+        self.keys: set[str] = set()
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def claim(self, key: str | None) -> Iterator[None]:
+        """Waits until no other request with key runs, then runs"""
+        if key is None:
+            yield
+            return
+
+        with self.condition:
+            while key in self.keys:
+                self.condition.wait()
+            self.keys.add(key)
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.keys.discard(key)
+                self.condition.notify_all()
+
+
+CLAIMED_KEYS = ClaimedKeys()
+# the longest Idempotency-Key accepted
+MAX_IDEMPOTENCY_KEY = 255
+# routes that stream their body and commit as they read it. idempotent()
+# would read the body first and they can't be replayed as one response
+UNKEYED_ROUTES = {"/import"}
+
+
+def mutating(route: Callable) -> Callable:
+    """
+    Marks a route that changes the state.
+    With worker processes it runs while holding the journal's flock,
+    replicas refuse it.
+    Requests with an Idempotency-Key header run through idempotent()
+    """
+
+    @functools.wraps(route)
+    def wrapper(*args, **kwargs):
+        if JOURNAL is not None and JOURNAL.read_only:
+            return (
+                jsonify({"message": "This server is a read-only replica"}),
+                403,
+            )
+
+        key = flask.request.headers.get("Idempotency-Key")
+        if key is not None and len(key) > MAX_IDEMPOTENCY_KEY:
+            return (
+                jsonify(
+                    {
+                        "message": "Idempotency-Key has at most "
+                        f"{MAX_IDEMPOTENCY_KEY} characters"
+                    }
+                ),
+                400,
+            )
+        if key is not None and flask.request.path in UNKEYED_ROUTES:
+            return (
+                jsonify(
+                    {
+                        "message": f"{flask.request.path} does not take "
+                        "an Idempotency-Key"
+                    }
+                ),
+                400,
+            )
+
+        # the key first, a retry waits for the request it repeats
+        # without holding the journal
+        with CLAIMED_KEYS.claim(key), (
+            JOURNAL.exclusive() if JOURNAL is not None else nullcontext()
+        ):
+            if key is None:
+                return route(*args, **kwargs)
+            return idempotent(key, route, *args, **kwargs)
+
+    return wrapper
+
+
+def idempotent(key: str, route: Callable, *args, **kwargs):
+    """
+    Runs route for the first request with the Idempotency-Key key and
+    remembers its response. Later requests with the key get that
+    response back without running the route again.
+    Failed requests changed nothing, so they are not remembered
+    and a retry runs again
+    """
+    request = f"{flask.request.path} {zlib.crc32(flask.request.get_data())}"
+    stored = STATE.responses.get(key)
+    ttl = float(CONFIG["idempotency_ttl"])
+    if stored is not None and stored["ts"] > time.time() - ttl:
+        if stored["request"] != request:
+            return (
+                jsonify(
+                    {"message": "Idempotency-Key was used for another request"}
+                ),
+                422,
+            )
+        response = jsonify(stored["response"])
+        response.headers["Idempotent-Replayed"] = "true"
+        return response, stored["status"]
+
+    with ExitStack() as stack:
+        # like /batch, the groups first and REGISTRY_LOCK after them
+        for group_name in sorted(request_group_names()):
+            stack.enter_context(locked_group(group_name))
+        try:
+            # the change and its response are published and saved together
+            with batched():
+                response, status = route(*args, **kwargs)
+                if status >= 400:
+                    raise BatchRollback()
+                commit(
+                    "remember_response",
+                    key=key,
+                    ts=time.time(),
+                    request=request,
+                    status=status,
+                    response=response.get_json(),
+                )
+        except BatchRollback:
+            return response, status
+
+    save_data()
+    return response, status
+
+
+def request_group_names() -> set[str]:
+    """The names of the groups the request may change"""
+    data = flask.request.get_json(silent=True)
+    if flask.request.path == "/batch":
+        try:
+            operations, _ = read_batch_request(data)
+        except ValueError:
+            return set()
+        return {
+            str(args["group_name"])
+            for _, args in operations
+            if args.get("group_name") is not None
+        }
+    if isinstance(data, dict) and data.get("group_name") is not None:
+        return {str(data["group_name"])}
+    return set()
+
+
+@app.before_request
+def catch_up_with_journal() -> None:
+    # other worker processes or the primary of a replica
+    # may have changed the state since the last request
+    if JOURNAL is not None and (JOURNAL.shared or JOURNAL.read_only):
+        JOURNAL.catch_up()
+
+
+@app.route("/login", methods=["POST"])
+@mutating
+def login() -> tuple[Response, int]:
+    data: dict = flask.request.get_json()
+    username = data.get("username")
+
+    if not username:
+        return jsonify({"message": "Username is required to Login"}), 400
+
+    with REGISTRY_LOCK:
+        # If user exists, return success
+        if username in USERS:
+            return (
+                jsonify({"message": "Login successful", "username": username}),
+                200,
+            )
+
+        # If user doesn't exist, create a new one
+        commit("login", username=username)
+
+    save_data()
+    return (
+        jsonify(
+            {
+                "message": f"User {username} registered successfully",
+                "username": username,
+            }
+        ),
+        201,
+    )
+
+
+def validate_request(request: flask.Request, *keys: str):
+    """
+    A helper function that extracts values for each key
+    from a flask request.
+    It returns the values in the same order as the keys.
+    It is designed to be used with tuple unpacking.
+
+    Raises KeyError if a key is not found in the request.
+    The propper response is included in the exeption
+    including a json payload and a http error code
+    """
+    data: dict = flask.request.get_json()
+    missing_keys = [key for key in keys if data.get(key) is None]
+
+    if missing_keys:
+        # Return the first missing key in the error
+        raise KeyError(
+            (jsonify({"message": f"{missing_keys[0]} is required"}), 400)
+        )
+
+    values = [str(data.get(key)) for key in keys]
+    return values[0] if len(values) == 1 else tuple(values)
+
+
+@contextmanager
+def locked_group(group_name: str) -> Iterator[Group | None]:
+    """
+    Holds the lock of the group called group_name for the with block
+    and gives its current version.
+    Gives None when the group does not exist
+    or was deleted while waiting for its lock
+    """
+    # /batch locked the groups of its operations already
+    if BATCH.state is not None:
+        yield GROUPS.get(group_name)
+        return
+
+    while True:
+        group = GROUPS.get(group_name)
+        if group is None:
+            yield None
+            return
+
+        with group.lock:
+            current = GROUPS.get(group_name)
+            # a group with the same name was created while waiting
+            if current is not None and current.lock is not group.lock:
+                continue
+
+            yield current
+            return
+
+
+@app.route("/create_group", methods=["POST"])
+@mutating
+def create_group() -> tuple[Response, int]:
+    try:
+        username, group_name = validate_request(
+            flask.request, "username", "group_name"
+        )
+    except KeyError as e:
+        return e.args[0]
+
+    if username not in USERS:
+        return jsonify({"message": f"User {username} does not exist"}), 404
+
+    with REGISTRY_LOCK:
+        if group_name in GROUPS:
+            return (
+                jsonify({"message": f"Group {group_name} already exists"}),
+                409,
+            )
+
+        commit("create_group", username=username, group_name=group_name)
+        group = GROUPS[group_name]
+
+    save_data()
+
+    # the history is paged by /get_transactions, only sent when asked for
+    if flask.request.get_json().get("transactions", False):
+        group_dict = group.to_dict()
+    else:
+        group_dict = group.to_dict_no_transactions()
+    return (
+        jsonify(
+            {
+                "message": f"Group {group_name} created successfully",
+                "group": group_dict,
+            }
+        ),
+        201,
+    )
+
+
+@app.route("/join_group", methods=["POST"])
+@mutating
+def join_group() -> tuple[Response, int]:
+    try:
+        username, group_name = validate_request(
+            flask.request, "username", "group_name"
+        )
+    except KeyError as e:
+        return e.args[0]
+
+    if username not in USERS:
+        return jsonify({"message": f"User {username} does not exist"}), 404
+
+    with locked_group(group_name) as group:
+        if group is None:
+            return (
+                jsonify({"message": f"Group {group_name} does not exist"}),
+                404,
+            )
+
+        if username in group.members:
+            return (
+                jsonify(
+                    {
+                        "message": (
+                            f"{username} is already member of {group.name}"
+                        )
+                    }
+                ),
+                200,
+            )
+
+        commit("join_group", username=username, group_name=group_name)
+        group_dict = GROUPS[group_name].to_dict_no_transactions()
+
+    save_data()
+
+    return (
+        jsonify(
+            {
+                "message": f"User {username} joined successfully",
+                "group": group_dict,
+            }
+        ),
+        200,
+    )
+
+
+@app.route("/delete_group", methods=["POST"])
+@mutating
+def delete_group() -> tuple[Response, int]:
+    try:
+        username, group_name = validate_request(
+            flask.request, "username", "group_name"
+        )
+    except KeyError as e:
+        return e.args[0]
+
+    if username not in USERS:
+        return jsonify({"message": f"User {username} does not exist"}), 404
+
+    with locked_group(group_name) as group:
+        if group is None:
+            return (
+                jsonify({"message": f"Group {group_name} does not exist"}),
+                404,
+            )
+
+        if not username.startswith("admin"):
+            if group.creator != username:
+                return (
+                    jsonify(
+                        {"message": f"Only {group.creator} can delete groups"}
+                    ),
+                    403,
+                )
+
+        commit("delete_group", group_name=group_name)
+
+    save_data()
+
+    return (
+        jsonify({"message": f"Group {group_name} deleted succesfuly"}),
+        200,
+    )
+
+
+def settle_up_internal(username1: str, group: Group, username2: str) -> Group:
+    # Remove all transactions between the two members
+    updated_transactions: list[Transaction] = []
+
+    for trn in group.transactions:
+        if trn.from_user == username1 and trn.to_user == username2:
+            continue
+        if trn.from_user == username2 and trn.to_user == username1:
+            continue
+
+        updated_transactions.append(trn)
+
+    return group.replace(transactions=updated_transactions)
+
+
+@app.route("/settle_up", methods=["POST"])
+@mutating
+def settle_up() -> tuple[Response, int]:
+    try:
+        username, to_user, group_name = validate_request(
+            flask.request, "username", "to_user", "group_name"
+        )
+    except KeyError as e:
+        return e.args[0]
+
+    if username not in USERS or to_user not in USERS:
+        return jsonify({"message": f"User {username} does not exist"}), 404
+
+    with locked_group(group_name) as group:
+        if group is None:
+            return (
+                jsonify({"message": f"Group {group_name} does not exist"}),
+                404,
+            )
+
+        if username not in group.members or to_user not in group.members:
+            return (
+                jsonify(
+                    {
+                        "message": (
+                            f"User {username} is not a member of {group.name}"
+                        )
+                    }
+                ),
+                403,
+            )
+
+        original_transaction_count = len(group.transactions)
+        commit(
+            "settle_up",
+            username=username,
+            to_user=to_user,
+            group_name=group_name,
+        )
+        group = GROUPS[group_name]
+        settled_transaction_count = original_transaction_count - len(
+            group.transactions
+        )
+        group_dict = group.to_dict_no_transactions()
+
+    save_data()
+    return (
+        jsonify(
+            {
+                "message": "Settled up successfully",
+                "transactions_settled": settled_transaction_count,
+                "group": group_dict,
+            }
+        ),
+        200,
     )
 
 
 @app.route("/kick_user", methods=["POST"])
+@mutating
 def kick_user() -> tuple[Response, int]:
     try:
         username, target_username, group_name = validate_request(
@@ -393,38 +2585,48 @@ def kick_user() -> tuple[Response, int]:
     if username not in USERS or target_username not in USERS:
         return jsonify({"message": f"User {username} does not exist"}), 404
 
-    if group_name not in GROUPS:
-        return jsonify({"message": f"Group {group_name} does not exist"}), 404
-
-    group = GROUPS[group_name]
-
-    if target_username not in group.members:
-        return (
-            jsonify({"message": f"{username} is not a member of this group"}),
-            404,
-        )
+    with locked_group(group_name) as group:
+        if group is None:
+            return (
+                jsonify({"message": f"Group {group_name} does not exist"}),
+                404,
+            )
 
-    if not username.startswith("admin"):
-        if username != group.creator and username != target_username:
+        if target_username not in group.members:
             return (
                 jsonify(
-                    {"message": f"Only {group.creator} can kick other users"}
+                    {"message": f"{username} is not a member of this group"}
                 ),
-                403,
+                404,
             )
 
-    # kicked user settles all of his debts
-    for member_name in group.members:
-        settle_up_internal(username, group, member_name)
+        if not username.startswith("admin"):
+            if username != group.creator and username != target_username:
+                return (
+                    jsonify(
+                        {
+                            "message": (
+                                f"Only {group.creator} can kick other users"
+                            )
+                        }
+                    ),
+                    403,
+                )
 
-    group.members.remove(target_username)
+        commit(
+            "kick_user",
+            username=username,
+            target_username=target_username,
+            group_name=group_name,
+        )
+        group_dict = GROUPS[group_name].to_dict_no_transactions()
 
     save_data()
     return (
         jsonify(
             {
                 "message": f"User {username} kicked successfully",
-                "group": group.to_dict_no_transactions(),
+                "group": group_dict,
             }
         ),
         200,
@@ -442,16 +2644,267 @@ def get_user_groups() -> tuple[Response, int]:
     if username not in USERS:
         return jsonify({"message": f"User {username} does not exist"}), 404
 
+    state = STATE
     user_groups = [
-        group.to_dict_no_transactions()
-        for group in GROUPS.values()
-        if username in group.members
+        state.groups[group_name].to_dict_no_transactions()
+        for group_name in sorted(state.user_groups.get(username, ()))
     ]
 
     return jsonify({"message": "Groups retrieved", "groups": user_groups}), 200
 
 
+def read_wait_request(data: dict) -> tuple[str, dict[str, int], float]:
+    """
+    The username, the group versions and the timeout of a
+    /wait_for_changes request.
+    Raises ValueError with the error message and status
+    """
+    if not isinstance(data, dict) or data.get("username") is None:
+        raise ValueError("username is required", 400)
+
+    username = str(data["username"])
+    if username not in USERS:
+        raise ValueError(f"User {username} does not exist", 404)
+
+    versions = data.get("groups", dict())
+    if not isinstance(versions, dict):
+        raise ValueError("groups must map group names to versions", 400)
+
+    timeout = data.get("timeout", CONFIG["long_poll_timeout"])
+    if not isinstance(timeout, (int, float)) or timeout < 0:
+        raise ValueError("timeout must be a positive number", 400)
+
+    return username, versions, min(timeout, CONFIG["long_poll_timeout"])
+
+
+def changed_groups(
+    state: State, username: str, versions: dict[str, int]
+) -> dict[str, int | None]:
+    """
+    The groups of the user and the groups in versions whose version is
+    not the one in versions, with their current version.
+    None for groups that are deleted or the user is not a member of
+    """
+    changed: dict[str, int | None] = dict()
+
+    for group_name in set(versions) | state.user_groups.get(username, set()):
+        group = state.groups.get(group_name)
+        version = None
+        if group is not None and username in group.members:
+            version = group.version
+        if version != versions.get(group_name):
+            changed[group_name] = version
+
+    return changed
+
+
+def wait_keys(username: str, versions: dict) -> list[tuple[str, str]]:
+    return [("user", username), *(("group", name) for name in versions)]
+
+
+def wait_result(changed: dict[str, int | None]) -> dict:
+    return {
+        "message": "Groups changed" if changed else "No changes",
+        "changed": sorted(changed),
+        "versions": changed,
+    }
+
+
+@app.route("/wait_for_changes", methods=["POST"])
+def wait_for_changes() -> tuple[Response, int]:
+    """
+    Long poll: "groups" has the version of every group the client
+    last saw. Answers as soon as one of them or a group of the user
+    changed, or with no changes after "timeout" seconds.
+    This waits on a waitress thread, see WaitingThreads, the async server
+    answers it with wait_for_changes_async() on its event loop instead
+    """
+    try:
+        username, versions, timeout = read_wait_request(
+            flask.request.get_json()
+        )
+    except ValueError as e:
+        message, status = e.args
+        return jsonify({"message": message}), status
+
+    if not WAITING_THREADS.acquire():
+        return waiting_refused()
+    event = threading.Event()
+    wake = event.set
+    keys = wait_keys(username, versions)
+    # subscribed before looking, so no change can slip through
+    CHANGES.subscribe(keys, wake)
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            changed = changed_groups(STATE, username, versions)
+            remaining = deadline - time.monotonic()
+            if changed or remaining <= 0:
+                break
+            event.wait(remaining)
+            event.clear()
+    finally:
+        CHANGES.unsubscribe(keys, wake)
+        WAITING_THREADS.release()
+
+    return jsonify(wait_result(changed)), 200
+
+
+async def wait_for_changes_async(body: bytes) -> tuple[int, str, bytes]:
+    """
+    /wait_for_changes for the async server.
+    A waiting request only costs an asyncio.Event, no thread
+    """
+    catch_up_with_journal()
+    try:
+        username, versions, timeout = read_wait_request(json.loads(body))
+    except json.JSONDecodeError:
+        return json_error("Invalid json", 400)
+    except ValueError as e:
+        return json_error(*e.args)
+
+    loop = asyncio.get_running_loop()
+    event = asyncio.Event()
+
+    def wake() -> None:
+        try:
+            loop.call_soon_threadsafe(event.set)
+        except RuntimeError:
+            pass  # the loop was closed while shutting down
+
+    keys = wait_keys(username, versions)
+    CHANGES.subscribe(keys, wake)
+    try:
+        deadline = loop.time() + timeout
+        while True:
+            changed = changed_groups(STATE, username, versions)
+            remaining = deadline - loop.time()
+            if changed or remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+            event.clear()
+    finally:
+        CHANGES.unsubscribe(keys, wake)
+
+    return 200, "application/json", json.dumps(wait_result(changed)).encode()
+
+
+def json_error(message: str, status: int) -> tuple[int, str, bytes]:
+    """An error response of an async route"""
+    body = json.dumps({"message": message}).encode()
+    return status, "application/json", body
+
+
+def read_events_request(data: dict) -> str:
+    """
+    The username of an /events request.
+    Raises ValueError with the error message and status
+    """
+    if not isinstance(data, dict) or data.get("username") is None:
+        raise ValueError("username is required", 400)
+
+    username = str(data["username"])
+    if username not in USERS:
+        raise ValueError(f"User {username} does not exist", 404)
+    return username
+
+
+@app.route("/events", methods=["POST"])
+def events() -> tuple[Response, int]:
+    """
+    Server-sent events stream of the changes to the groups of the user:
+    add_expense, settle_up, join_group, kick_user and delete_group.
+    Every event has the seq of the change as its id and as data
+    {"seq", "op", "group_name", "version", "args"}.
+    This holds a waitress thread for as long as the stream is open, see
+    WaitingThreads, the async server streams it with events_async()
+    on its event loop
+    """
+    try:
+        username = read_events_request(flask.request.get_json())
+    except ValueError as e:
+        message, status = e.args
+        return jsonify({"message": message}), status
+
+    if not WAITING_THREADS.acquire():
+        return waiting_refused()
+    event = threading.Event()
+    subscriber = EVENTS.subscribe(username, event.set)
+    heartbeat = float(CONFIG["event_heartbeat"])
+
+    def stream() -> Iterator[bytes]:
+        try:
+            yield b": connected\n\n"
+            while True:
+                while subscriber.frames:
+                    yield subscriber.frames.popleft()
+                if subscriber.dropped:
+                    yield DROPPED_FRAME
+                    return
+                # a comment now and then notices clients that went away
+                if not event.wait(heartbeat):
+                    yield b": heartbeat\n\n"
+                event.clear()
+        finally:
+            EVENTS.unsubscribe(subscriber)
+
+    response = Response(stream(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    # also when the stream is closed before it started
+    response.call_on_close(WAITING_THREADS.release)
+    return response, 200
+
+
+async def events_async(body: bytes) -> tuple[int, str, bytes | AsyncIterator]:
+    """
+    /events for the async server.
+    An open stream only costs its buffer and an asyncio.Event, no thread
+    """
+    catch_up_with_journal()
+    try:
+        username = read_events_request(json.loads(body))
+    except json.JSONDecodeError:
+        return json_error("Invalid json", 400)
+    except ValueError as e:
+        return json_error(*e.args)
+
+    loop = asyncio.get_running_loop()
+    event = asyncio.Event()
+
+    def wake() -> None:
+        try:
+            loop.call_soon_threadsafe(event.set)
+        except RuntimeError:
+            pass  # the loop was closed while shutting down
+
+    subscriber = EVENTS.subscribe(username, wake)
+    heartbeat = float(CONFIG["event_heartbeat"])
+
+    async def stream() -> AsyncIterator[bytes]:
+        try:
+            yield b": connected\n\n"
+            while True:
+                while subscriber.frames:
+                    yield subscriber.frames.popleft()
+                if subscriber.dropped:
+                    yield DROPPED_FRAME
+                    return
+                try:
+                    await asyncio.wait_for(event.wait(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield b": heartbeat\n\n"
+                event.clear()
+        finally:
+            EVENTS.unsubscribe(subscriber)
+
+    return 200, "text/event-stream", stream()
+
+
 @app.route("/add_expense", methods=["POST"])
+@mutating
 def add_expense() -> tuple[Response, int]:
     try:
         username, group_name, amount = validate_request(
@@ -460,19 +2913,243 @@ def add_expense() -> tuple[Response, int]:
     except KeyError as e:
         return e.args[0]
 
-    try:
-        amount = float(amount)
-    except ValueError:
-        return jsonify({"message": "Amount must be a number"}), 400
-
+    try:
+        amount = float(amount)
+    except ValueError:
+        return jsonify({"message": "Amount must be a number"}), 400
+
+    if username not in USERS:
+        return jsonify({"message": f"User {username} does not exist"}), 404
+
+    with locked_group(group_name) as group:
+        if group is None:
+            return (
+                jsonify({"message": f"Group {group_name} does not exist"}),
+                404,
+            )
+
+        if username not in group.members:
+            return (
+                jsonify(
+                    {
+                        "message": (
+                            f"User {username} is not a member of {group.name}"
+                        )
+                    }
+                ),
+                403,
+            )
+
+        # the same share apply_add_expense() splits the amount into
+        share_per_member = amount / len(group.members)
+        commit(
+            "add_expense",
+            username=username,
+            group_name=group_name,
+            amount=amount,
+        )
+        group_dict = GROUPS[group_name].to_dict_no_transactions()
+
+    save_data()
+
+    return (
+        jsonify(
+            {
+                "message": "Expense added successfully",
+                "amount": amount,
+                "share_per_member": share_per_member,
+                "group": group_dict,
+            }
+        ),
+        201,
+    )
+
+
+# the routes /batch can run
+BATCH_ROUTES: dict[str, Callable] = {
+    "login": login,
+    "create_group": create_group,
+    "join_group": join_group,
+    "delete_group": delete_group,
+    "settle_up": settle_up,
+    "kick_user": kick_user,
+    "add_expense": add_expense,
+}
+
+
+def read_batch_request(data: dict) -> tuple[list[tuple[str, dict]], bool]:
+    """
+    The operations and atomic of a /batch request.
+    Raises ValueError with the error message and status
+    """
+    if not isinstance(data, dict) or not data.get("operations"):
+        raise ValueError("operations is required", 400)
+    if not isinstance(data["operations"], list):
+        raise ValueError("operations must be a list", 400)
+    if len(data["operations"]) > int(CONFIG["batch_limit"]):
+        raise ValueError(
+            f"A batch has at most {CONFIG['batch_limit']} operations", 413
+        )
+
+    operations: list[tuple[str, dict]] = []
+    for operation in data["operations"]:
+        if not isinstance(operation, dict):
+            raise ValueError("Every operation must be an object", 400)
+        name = operation.get("op")
+        args = operation.get("args", dict())
+        if name not in BATCH_ROUTES:
+            raise ValueError(f"Unknown operation {name}", 400)
+        if not isinstance(args, dict):
+            raise ValueError("args must be an object", 400)
+        operations.append((name, args))
+
+    return operations, bool(data.get("atomic", False))
+
+
+@app.route("/batch", methods=["POST"])
+@mutating
+def batch() -> tuple[Response, int]:
+    """
+    Runs "operations", a list of {"op": "add_expense", "args": {...}},
+    in order. Every operation is the route of the same name with args as
+    its request, and sees the changes of the ones before it.
+    Answers with the status and the response of every operation.
+    All the groups of the batch are locked for the whole batch, its
+    changes are published and saved together at the end.
+    With "atomic": true the first failed operation ends the batch,
+    nothing is changed and its status is the status of the answer
+    """
+    try:
+        operations, atomic = read_batch_request(flask.request.get_json())
+    except ValueError as e:
+        message, status = e.args
+        return jsonify({"message": message}), status
+
+    group_names = request_group_names()
+    results: list[dict] = []
+    failed: dict | None = None
+    try:
+        with ExitStack() as stack:
+            # always in the same order, so two batches can't deadlock
+            for group_name in sorted(group_names):
+                stack.enter_context(locked_group(group_name))
+
+            with batched():
+                for name, args in operations:
+                    with app.test_request_context(
+                        f"/{name}", method="POST", json=args
+                    ):
+                        # without @mutating, /batch holds the journal
+                        response, status = BATCH_ROUTES[name].__wrapped__()
+                    results.append(
+                        {"op": name, "status": status, **response.get_json()}
+                    )
+                    if atomic and status >= 400:
+                        failed = results[-1]
+                        raise BatchRollback()
+    except BatchRollback:
+        pass
+
+    if failed is not None:
+        return (
+            jsonify(
+                {
+                    "message": f"Operation {len(results)} failed, "
+                    "nothing was changed",
+                    "results": results,
+                }
+            ),
+            failed["status"],
+        )
+
+    save_data()
+    return (
+        jsonify(
+            {
+                "message": "Batch applied",
+                "succeeded": sum(result["status"] < 400 for result in results),
+                "results": results,
+            }
+        ),
+        200,
+    )
+
+
+@app.route("/get_debts", methods=["POST"])
+def get_debts() -> tuple[Response, int]:
+    try:
+        username, group_name = validate_request(
+            flask.request, "username", "group_name"
+        )
+    except KeyError as e:
+        return e.args[0]
+
+    if username not in USERS:
+        return jsonify({"message": f"User {username} does not exist"}), 404
+
+    group = GROUPS.get(group_name)
+    if group is None:
+        return jsonify({"message": f"Group {group_name} does not exist"}), 404
+
+    if username not in group.members:
+        return (
+            jsonify(
+                {"message": f"User {username} is not a member of {group.name}"}
+            ),
+            403,
+        )
+
+    debts = calculate_relative_debt(group, username)
+    # Format the result
+    result: list[dict[str, str | float]] = []
+    for user in group.members:
+        amount = debts.get(user, 0.0)
+        if amount > 0:
+            result.append(
+                {"username": user, "amount": amount, "status": "you owe"}
+            )
+        elif amount < 0:
+            result.append(
+                {"username": user, "amount": abs(amount), "status": "owes you"}
+            )
+        else:
+            result.append(
+                {"username": user, "amount": amount, "status": "settled up"}
+            )
+
+    return (
+        jsonify(
+            {
+                "message": "Got debts",
+                "username": username,
+                "group_name": group_name,
+                "debts": result,
+            }
+        ),
+        200,
+    )
+
+
+@app.route("/get_group_balances", methods=["POST"])
+def get_group_balances() -> tuple[Response, int]:
+    """
+    The balance of every member of the group: positive when the others
+    owe the member money, negative when the member owes them
+    """
+    try:
+        username, group_name = validate_request(
+            flask.request, "username", "group_name"
+        )
+    except KeyError as e:
+        return e.args[0]
+
     if username not in USERS:
         return jsonify({"message": f"User {username} does not exist"}), 404
 
-    if group_name not in GROUPS:
+    group = GROUPS.get(group_name)
+    if group is None:
         return jsonify({"message": f"Group {group_name} does not exist"}), 404
 
-    group = GROUPS[group_name]
-
     if username not in group.members:
         return (
             jsonify(
@@ -481,33 +3158,30 @@ def add_expense() -> tuple[Response, int]:
             403,
         )
 
-    # Calculate equal share for each member
-    num_members = len(group.members)
-    share_per_member = amount / num_members
-
-    # Create transactions for each member (except the payer)
-    for member in group.members:
-        if member != username:
-            transaction = Transaction(member, username, share_per_member)
-            group.transactions.append(transaction)
-
-    save_data()
-
+    balances = calculate_balances(group)
     return (
         jsonify(
             {
-                "message": "Expense added successfully",
-                "amount": amount,
-                "share_per_member": share_per_member,
-                "group": group.to_dict_no_transactions(),
+                "message": "Got balances",
+                "group_name": group_name,
+                "balances": [
+                    {"username": member, "balance": balances.get(member, 0.0)}
+                    for member in group.members
+                ],
             }
         ),
-        201,
+        200,
     )
 
 
-@app.route("/get_debts", methods=["POST"])
-def get_debts() -> tuple[Response, int]:
+@app.route("/get_transactions", methods=["POST"])
+def get_transactions() -> tuple[Response, int]:
+    """
+    One page of the transactions of the group, oldest first.
+    "cursor" is the "next_cursor" of the previous page, "limit" the size
+    of the page and "member" only lists the transactions of that member.
+    "next_cursor" is null on the last page
+    """
     try:
         username, group_name = validate_request(
             flask.request, "username", "group_name"
@@ -515,14 +3189,31 @@ def get_debts() -> tuple[Response, int]:
     except KeyError as e:
         return e.args[0]
 
+    data: dict = flask.request.get_json()
+    try:
+        cursor = int(data.get("cursor") or 0)
+        limit = int(data.get("limit", CONFIG["page_size"]))
+    except (TypeError, ValueError):
+        return jsonify({"message": "cursor and limit must be numbers"}), 400
+    if not 0 < limit <= int(CONFIG["max_page_size"]):
+        return (
+            jsonify(
+                {
+                    "message": "limit must be between 1 and "
+                    f"{CONFIG['max_page_size']}"
+                }
+            ),
+            400,
+        )
+    member = data.get("member")
+
     if username not in USERS:
         return jsonify({"message": f"User {username} does not exist"}), 404
 
-    if group_name not in GROUPS:
+    group = GROUPS.get(group_name)
+    if group is None:
         return jsonify({"message": f"Group {group_name} does not exist"}), 404
 
-    group = GROUPS[group_name]
-
     if username not in group.members:
         return (
             jsonify(
@@ -531,37 +3222,39 @@ def get_debts() -> tuple[Response, int]:
             403,
         )
 
-    debts = calculate_relative_debt(group, username)
-    # Format the result
-    result: list[dict[str, str | float]] = []
-    for user in group.members:
-        amount = debts.get(user, 0.0)
-        if amount > 0:
-            result.append(
-                {"username": user, "amount": amount, "status": "you owe"}
-            )
-        elif amount < 0:
-            result.append(
-                {"username": user, "amount": abs(amount), "status": "owes you"}
-            )
-        else:
-            result.append(
-                {"username": user, "amount": amount, "status": "settled up"}
-            )
-
+    # one more than the page, to know whether there is a next one
+    page = group.transactions_page(
+        cursor, limit + 1, None if member is None else str(member)
+    )
     return (
         jsonify(
             {
-                "message": "Got debts",
-                "username": username,
+                "message": "Got transactions",
                 "group_name": group_name,
-                "debts": result,
+                "transactions": [t.to_dict() for t in page[:limit]],
+                "next_cursor": (
+                    page[limit - 1].id if len(page) > limit else None
+                ),
             }
         ),
         200,
     )
 
 
+def calculate_balances(group: Group) -> dict[str, float]:
+    balances: dict[str, float] = dict()
+
+    for transaction in group.transactions:
+        balances[transaction.to_user] = (
+            balances.get(transaction.to_user, 0.0) + transaction.amount
+        )
+        balances[transaction.from_user] = (
+            balances.get(transaction.from_user, 0.0) - transaction.amount
+        )
+
+    return balances
+
+
 def calculate_relative_debt(group: Group, username: str) -> dict[str, float]:
     debts: dict[str, float] = dict()
 
@@ -580,6 +3273,863 @@ def calculate_relative_debt(group: Group, username: str) -> dict[str, float]:
     return debts
 
 
+def deep_sizeof(obj: object, seen: set[int]) -> int:
+    """
+    Approximates the memory used by obj and everything it references.
+    Objects whose id is already in seen are not counted again,
+    so shared strings are only attributed to the first structure
+    that references them
+    """
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += deep_sizeof(key, seen) + deep_sizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deep_sizeof(item, seen)
+    elif hasattr(obj, "__dict__"):
+        size += deep_sizeof(vars(obj), seen)
+    elif hasattr(obj, "__slots__"):
+        for name in obj.__slots__:
+            size += deep_sizeof(getattr(obj, name, None), seen)
+
+    return size
+
+
+# the snapshot /memory_stats diffs against, None until one is taken
+TRACEMALLOC_SNAPSHOT: tracemalloc.Snapshot | None = None
+
+
+def take_tracemalloc_snapshot() -> tracemalloc.Snapshot:
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    # ignore the memory used by tracemalloc itself
+    return tracemalloc.take_snapshot().filter_traces(
+        (tracemalloc.Filter(False, tracemalloc.__file__),)
+    )
+
+
+def memory_stats() -> dict[str, dict[str, int]]:
+    """
+    Counts the objects held by USERS, GROUPS, Group.members
+    and Group.transactions together with their approximate size in bytes.
+    Transactions of lazily loaded groups only count once they are read
+    """
+    seen: set[int] = set()
+    state = STATE
+    groups = state.groups.values()
+
+    users_bytes = deep_sizeof(state.users, seen)
+
+    # only the snapshot and the group objects themselves,
+    # members and transactions are counted separately below
+    for group in groups:
+        seen.add(id(group.members))
+        seen.add(id(group.stored_transactions()))
+    groups_bytes = deep_sizeof(state.groups, seen)
+
+    members_count = 0
+    members_bytes = 0
+    transactions_count = 0
+    transactions_bytes = 0
+    # lazily loaded groups that have not read their transactions yet,
+    # and the transactions they still have in the snapshot
+    unloaded_groups = 0
+    unloaded_transactions = 0
+    for group in groups:
+        members_count += len(group.members)
+        members_bytes += sys.getsizeof(group.members)
+        for member in group.members:
+            members_bytes += deep_sizeof(member, seen)
+
+        transactions = group.stored_transactions()
+        if isinstance(transactions, TransactionSegment):
+            unloaded_groups += 1
+            unloaded_transactions += len(transactions)
+            continue
+        transactions_count += len(transactions)
+        transactions_bytes += sys.getsizeof(transactions)
+        for transaction in transactions:
+            transactions_bytes += deep_sizeof(transaction, seen)
+
+    return {
+        "users": {"count": len(state.users), "bytes": users_bytes},
+        "groups": {
+            "count": len(groups),
+            "bytes": groups_bytes,
+            "unloaded": unloaded_groups,
+        },
+        "members": {"count": members_count, "bytes": members_bytes},
+        "transactions": {
+            "count": transactions_count,
+            "bytes": transactions_bytes,
+            "unloaded": unloaded_transactions,
+        },
+    }
+
+
+@app.route("/memory_stats", methods=["POST"])
+def get_memory_stats() -> tuple[Response, int]:
+    """
+    Admin only endpoint reporting what the in-memory state consists of.
+    The optional "action" key controls tracemalloc:
+    "snapshot" takes a new baseline snapshot,
+    "diff" compares a new snapshot against the baseline
+    and then makes it the new baseline,
+    "stop" stops tracing and forgets the baseline
+    """
+    global TRACEMALLOC_SNAPSHOT
+
+    try:
+        username = validate_request(flask.request, "username")
+    except KeyError as e:
+        return e.args[0]
+
+    if username not in USERS:
+        return jsonify({"message": f"User {username} does not exist"}), 404
+
+    if not username.startswith("admin"):
+        return (
+            jsonify({"message": "Only admins can view memory stats"}),
+            403,
+        )
+
+    data: dict = flask.request.get_json()
+    action = data.get("action", "stats")
+    limit = data.get("limit", 10)
+    if not isinstance(limit, int) or limit < 1:
+        return jsonify({"message": "limit must be a positive integer"}), 400
+
+    result: dict = {"message": "Memory stats", "stats": memory_stats()}
+
+    if action == "snapshot":
+        TRACEMALLOC_SNAPSHOT = take_tracemalloc_snapshot()
+        result["snapshot_traces"] = len(TRACEMALLOC_SNAPSHOT.traces)
+    elif action == "diff":
+        if TRACEMALLOC_SNAPSHOT is None:
+            return (
+                jsonify({"message": "Take a snapshot before diffing"}),
+                409,
+            )
+        snapshot = take_tracemalloc_snapshot()
+        top_stats = snapshot.compare_to(TRACEMALLOC_SNAPSHOT, "lineno")
+        TRACEMALLOC_SNAPSHOT = snapshot
+        result["diff"] = [
+            {
+                "location": str(stat.traceback),
+                "size": stat.size,
+                "size_diff": stat.size_diff,
+                "count": stat.count,
+                "count_diff": stat.count_diff,
+            }
+            for stat in top_stats[:limit]
+        ]
+    elif action == "stop":
+        tracemalloc.stop()
+        TRACEMALLOC_SNAPSHOT = None
+    elif action != "stats":
+        return jsonify({"message": f"Unknown action {action}"}), 400
+
+    result["tracing"] = tracemalloc.is_tracing()
+    return jsonify(result), 200
+
+
+@app.route("/metrics", methods=["POST"])
+def get_metrics() -> tuple[Response, int]:
+    """Admin only endpoint reporting the runtime information in METRICS"""
+    try:
+        username = validate_request(flask.request, "username")
+    except KeyError as e:
+        return e.args[0]
+
+    if username not in USERS:
+        return jsonify({"message": f"User {username} does not exist"}), 404
+
+    if not username.startswith("admin"):
+        return jsonify({"message": "Only admins can view metrics"}), 403
+
+    return jsonify({"message": "Metrics", "metrics": METRICS}), 200
+
+
+@app.route("/export_groups", methods=["POST"])
+def export_groups() -> tuple[Response, int]:
+    """
+    Admin only endpoint returning the groups called "group_names",
+    or all of them if it is missing.
+    "transactions": false leaves out the transactions,
+    "users": true adds the names of all users.
+    Used by cluster.py to move groups between shards
+    """
+    try:
+        username = validate_request(flask.request, "username")
+    except KeyError as e:
+        return e.args[0]
+
+    if username not in USERS:
+        return jsonify({"message": f"User {username} does not exist"}), 404
+
+    if not username.startswith("admin"):
+        return jsonify({"message": "Only admins can export groups"}), 403
+
+    data: dict = flask.request.get_json()
+    state = STATE
+    group_names = data.get("group_names")
+    if group_names is None:
+        groups = state.groups.values()
+    else:
+        groups = [
+            state.groups[name] for name in group_names if name in state.groups
+        ]
+
+    result: dict = {
+        "message": "Groups exported",
+        "groups": [
+            (
+                group.to_dict()
+                if data.get("transactions", True)
+                else group.to_dict_no_transactions()
+            )
+            for group in groups
+        ],
+    }
+    if data.get("users", False):
+        result["users"] = list(state.users)
+    return jsonify(result), 200
+
+
+# bytes of lines /export collects before it sends them on
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+
+def export_lines(state: State) -> Iterator[str]:
+    """
+    The lines of /export: a header with the seq of state, then every
+    user, and every group followed by its transactions
+    """
+    yield json.dumps(
+        {
+            "type": "export",
+            "seq": state.seq,
+            "users": len(state.users),
+            "groups": len(state.groups),
+        }
+    ) + "\n"
+    for username in state.users:
+        yield json.dumps({"type": "user", "username": username}) + "\n"
+    # one group at a time, never a list of all of them
+    for group_name in state.groups:
+        group = state.groups[group_name]
+        yield json.dumps(
+            {
+                "type": "group",
+                **group.to_dict_no_transactions(),
+                "transaction_count": group.transaction_count,
+            }
+        ) + "\n"
+        # the segment of a group that isn't loaded, it stays unloaded
+        for transaction in group.stored_transactions():
+            yield json.dumps(
+                {
+                    "type": "transaction",
+                    "group_name": group.name,
+                    **transaction.to_dict(),
+                }
+            ) + "\n"
+
+
+def export_chunks(lines: Iterable[str], compress: bool) -> Iterator[bytes]:
+    """lines in chunks of about EXPORT_CHUNK_SIZE, gzipped if compress"""
+    # wbits 31 writes the gzip header and trailer
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    chunk: list[bytes] = []
+    size = 0
+
+    def flush() -> bytes:
+        nonlocal size
+        data = b"".join(chunk)
+        chunk.clear()
+        size = 0
+        return data if compressor is None else compressor.compress(data)
+
+    for line in lines:
+        data = line.encode()
+        chunk.append(data)
+        size += len(data)
+        if size >= EXPORT_CHUNK_SIZE:
+            # the compressor can keep everything buffered for a while
+            if data := flush():
+                yield data
+
+    data = flush()
+    if compressor is not None:
+        data += compressor.flush()
+    if data:
+        yield data
+
+
+@app.route("/export", methods=["POST"])
+def export() -> tuple[Response, int]:
+    """
+    Admin only endpoint streaming all users, groups and transactions as
+    NDJSON, see export_lines(). They are read from the State that is
+    current when the request starts, so the export is consistent
+    however long it takes, and only one chunk is in memory at a time.
+    Gzipped on the fly when the client accepts gzip
+    """
+    try:
+        username = validate_request(flask.request, "username")
+    except KeyError as e:
+        return e.args[0]
+
+    if username not in USERS:
+        return jsonify({"message": f"User {username} does not exist"}), 404
+
+    if not username.startswith("admin"):
+        return jsonify({"message": "Only admins can export"}), 403
+
+    compress = "gzip" in flask.request.headers.get("Accept-Encoding", "")
+    response = Response(
+        export_chunks(export_lines(STATE), compress),
+        mimetype="application/x-ndjson",
+    )
+    if compress:
+        response.headers["Content-Encoding"] = "gzip"
+    response.headers["Vary"] = "Accept-Encoding"
+    return response, 200
+
+
+class Importer:
+    """
+    Imports records in the format of /export: user, group and
+    transaction lines. They are checked with the rules of the routes
+    and applied every batch_size records, each batch as one "import"
+    operation that is journaled and saved once.
+    Imported groups start anew, their transactions get new ids.
+    A record that breaks a rule is reported in errors and skipped,
+    the rest of the import goes on
+    """
+
+    # errors kept for the report, the rest is only counted
+    MAX_ERRORS = 100
+
+    def __init__(
+        self,
+        batch_size: int,
+        progress: Callable[[dict], None] | None = None,
+        save: Callable[[], None] | None = save_data,
+    ):
+        self.batch_size = batch_size
+        self.progress = progress
+        self.save = save
+        # line number and record
+        self.pending: list[tuple[int, dict]] = []
+        self.stats = {
+            "lines": 0,
+            "users": 0,
+            "groups": 0,
+            "transactions": 0,
+            "batches": 0,
+            "errors": 0,
+        }
+        self.errors: list[dict] = []
+
+    def error(self, line: int, message: str) -> None:
+        self.stats["errors"] += 1
+        if len(self.errors) < self.MAX_ERRORS:
+            self.errors.append({"line": line, "message": message})
+
+    def feed(self, line: bytes | str) -> None:
+        self.stats["lines"] += 1
+        number = self.stats["lines"]
+        if not line.strip():
+            return
+        try:
+            record = json.loads(line)
+        except ValueError:
+            self.error(number, "Invalid json")
+            return
+        if not isinstance(record, dict) or record.get("type") not in (
+            "export",
+            "user",
+            "group",
+            "transaction",
+        ):
+            self.error(number, "Unknown record")
+            return
+        if record["type"] == "export":
+            return
+
+        self.pending.append((number, record))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Checks and applies the pending records"""
+        records, self.pending = self.pending, []
+        if not records:
+            return
+
+        group_names = {
+            str(record.get("group_name") or record.get("name"))
+            for _, record in records
+            if record["type"] != "user"
+        }
+        with ExitStack() as stack:
+            # like /batch, so the groups can't change while checking
+            for group_name in sorted(group_names):
+                stack.enter_context(locked_group(group_name))
+            with REGISTRY_LOCK:
+                users, groups, transactions = self.check(STATE, records)
+                if users or groups or transactions:
+                    commit(
+                        "import",
+                        users=users,
+                        groups=groups,
+                        transactions=transactions,
+                    )
+
+        if self.save is not None:
+            self.save()
+        self.stats["users"] += len(users)
+        self.stats["groups"] += len(groups)
+        self.stats["transactions"] += len(transactions)
+        self.stats["batches"] += 1
+        if self.progress is not None:
+            self.progress(self.stats)
+
+    def check(
+        self, state: State, records: list[tuple[int, dict]]
+    ) -> tuple[list[str], list[dict], list[list]]:
+        """The users, groups and transactions of records that are valid"""
+        users: dict[str, None] = dict()
+        groups: dict[str, dict] = dict()
+        transactions: list[list] = []
+
+        def required(record: dict, *keys: str) -> list[str]:
+            for key in keys:
+                if record.get(key) is None:
+                    raise ValueError(f"{key} is required")
+            return [str(record[key]) for key in keys]
+
+        def check_user(username: str) -> None:
+            if username not in users and username not in state.users:
+                raise ValueError(f"User {username} does not exist")
+
+        for number, record in records:
+            try:
+                if record["type"] == "user":
+                    (username,) = required(record, "username")
+                    if username not in state.users:
+                        users[username] = None
+
+                elif record["type"] == "group":
+                    name, creator = required(record, "name", "creator")
+                    if name in groups or name in state.groups:
+                        raise ValueError(f"Group {name} already exists")
+                    if not isinstance(record.get("members", []), list):
+                        raise ValueError("members must be a list")
+                    # the creator is always a member, and every member once
+                    members = list(
+                        dict.fromkeys(
+                            str(member) for member in record.get("members", [])
+                        )
+                    )
+                    if creator not in members:
+                        members.insert(0, creator)
+                    for member in members:
+                        check_user(member)
+                    groups[name] = {
+                        "name": name,
+                        "creator": creator,
+                        "members": members,
+                    }
+
+                else:
+                    group_name, from_user, to_user = required(
+                        record, "group_name", "from_user", "to_user"
+                    )
+                    try:
+                        amount = float(record.get("amount"))  # type: ignore
+                    except (TypeError, ValueError):
+                        raise ValueError("Amount must be a number")
+                    if group_name in groups:
+                        group_members = groups[group_name]["members"]
+                    elif group_name in state.groups:
+                        group_members = state.groups[group_name].members
+                    else:
+                        raise ValueError(f"Group {group_name} does not exist")
+                    for user in (from_user, to_user):
+                        if user not in group_members:
+                            raise ValueError(
+                                f"User {user} is not a member of {group_name}"
+                            )
+                    transactions.append(
+                        [group_name, from_user, to_user, amount]
+                    )
+            except ValueError as e:
+                self.error(number, str(e))
+
+        return list(users), list(groups.values()), transactions
+
+    def report(self) -> dict:
+        # a line that is no record is reported before its batch is checked
+        errors = sorted(self.errors, key=lambda error: error["line"])
+        return {**self.stats, "error_list": errors}
+
+
+def read_lines(stream, compressed: bool = False) -> Iterator[bytes]:
+    """The lines of a binary stream, gunzipped on the fly if compressed"""
+    decompressor = zlib.decompressobj(wbits=31) if compressed else None
+    rest = b""
+    while chunk := stream.read(EXPORT_CHUNK_SIZE):
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        lines = (rest + chunk).split(b"\n")
+        rest = lines.pop()
+        yield from lines
+    if decompressor is not None:
+        rest += decompressor.flush()
+    if rest:
+        yield rest
+
+
+@app.route("/import", methods=["POST"])
+@mutating
+def import_data() -> tuple[Response, int]:
+    """
+    Admin only endpoint importing the NDJSON body, in the format of
+    /export, with Importer. The body is read a chunk at a time and may
+    be gzipped (Content-Encoding: gzip). As it isn't json the username
+    is the query parameter "username".
+    Progress is in /metrics "import" while it runs, the answer has the
+    counts and the first errors with their line numbers
+    """
+    username = flask.request.args.get("username")
+    if username is None:
+        return jsonify({"message": "username is required"}), 400
+
+    if username not in USERS:
+        return jsonify({"message": f"User {username} does not exist"}), 404
+
+    if not username.startswith("admin"):
+        return jsonify({"message": "Only admins can import"}), 403
+
+    importer = Importer(int(CONFIG["import_batch"]))
+    METRICS["import"] = importer.stats
+    compressed = flask.request.headers.get("Content-Encoding") == "gzip"
+    try:
+        for line in read_lines(flask.request.stream, compressed):
+            importer.feed(line)
+    except zlib.error:
+        importer.error(importer.stats["lines"] + 1, "Invalid gzip")
+    importer.flush()
+
+    return (
+        jsonify({"message": "Import finished", **importer.report()}),
+        200,
+    )
+
+
+@app.route("/import_groups", methods=["POST"])
+@mutating
+def import_groups() -> tuple[Response, int]:
+    """
+    Admin only endpoint adding the users in "users"
+    and adding or replacing the groups in "groups",
+    in the format of /export_groups
+    """
+    try:
+        username = validate_request(flask.request, "username")
+    except KeyError as e:
+        return e.args[0]
+
+    if username not in USERS:
+        return jsonify({"message": f"User {username} does not exist"}), 404
+
+    if not username.startswith("admin"):
+        return jsonify({"message": "Only admins can import groups"}), 403
+
+    data: dict = flask.request.get_json()
+    usernames = data.get("users", [])
+    groups = data.get("groups", [])
+    try:
+        # check everything before changing anything
+        for group_dict in groups:
+            Group.from_dict(group_dict)
+    except (KeyError, TypeError):
+        return jsonify({"message": "Invalid group"}), 400
+
+    with REGISTRY_LOCK:
+        for new_username in usernames:
+            if new_username not in USERS:
+                commit("login", username=str(new_username))
+
+    for group_dict in groups:
+        with locked_group(group_dict["name"]):
+            commit("put_group", group=group_dict)
+
+    save_data()
+    return (
+        jsonify(
+            {
+                "message": "Groups imported",
+                "users": len(usernames),
+                "groups": len(groups),
+            }
+        ),
+        200,
+    )
+
+
+def autotune_threads(samples: int = 50) -> dict[str, float | int]:
+    """
+    Picks the number of waitress threads from the number of CPUs
+    and the handler latency measured on the loaded data.
+    Only the time a handler spends waiting (not on the CPU) can be
+    overlapped by more threads, so the CPU count is scaled by
+    1 + waiting time / CPU time
+    """
+    global LOG
+
+    cpus = os.cpu_count() or 1
+    client = app.test_client()
+    users = USERS.keys()[:samples] or ["autotune"]
+
+    old_log = LOG
+    LOG = False
+    wall_time = 0.0
+    cpu_time = 0.0
+    try:
+        for i in range(samples):
+            wall_start = time.perf_counter()
+            cpu_start = time.thread_time()
+            client.post(
+                "/get_user_groups", json={"username": users[i % len(users)]}
+            )
+            cpu_time += time.thread_time() - cpu_start
+            wall_time += time.perf_counter() - wall_start
+    finally:
+        LOG = old_log
+
+    waiting_ratio = max(0.0, wall_time - cpu_time) / max(cpu_time, 1e-9)
+    threads = round(cpus * (1 + waiting_ratio))
+
+    return {
+        "cpus": cpus,
+        "handler_latency": wall_time / samples,
+        "handler_cpu_time": cpu_time / samples,
+        "threads": min(max(threads, 2), 64),
+    }
+
+
+def waitress_settings() -> dict[str, int]:
+    """
+    The waitress tuning settings from CONFIG,
+    running the auto-tune for the ones set to "auto".
+    The chosen values are reported in METRICS["server"]
+    """
+    settings = {
+        name: CONFIG[name]
+        for name in [
+            "threads",
+            "connection_limit",
+            "backlog",
+            "recv_bytes",
+            "send_bytes",
+            "channel_timeout",
+            "cleanup_interval",
+        ]
+    }
+
+    if settings["threads"] == "auto":
+        autotune = autotune_threads()
+        settings["threads"] = autotune["threads"]
+        METRICS["autotune"] = autotune
+
+    METRICS["server"] = {"server": SERVER, **settings}
+    return settings
+
+
+def serve(sock: socket.socket | None = None) -> None:
+    """Serves the app with SERVER, on sock instead of HOST:PORT if given"""
+    if SERVER == "async":
+        import aioserver
+
+        METRICS["server"] = {"server": SERVER}
+        aioserver.serve(
+            app,
+            host=HOST,
+            port=PORT,
+            sock=sock,
+            async_routes={
+                "/wait_for_changes": wait_for_changes_async,
+                "/events": events_async,
+            },
+        )
+    elif sock is None:
+        waitress.serve(app, host=HOST, port=PORT, **waitress_settings())
+    else:
+        waitress.serve(app, sockets=[sock], **waitress_settings())
+
+
+def run_worker(worker: int, sock: socket.socket | None) -> None:
+    """Serves the app in a forked worker process until it is terminated"""
+    # the parent stops the workers, Ctrl+C reaches the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    assert JOURNAL is not None
+    JOURNAL.reopen()
+
+    if sock is None:
+        sock = socket.create_server(
+            (HOST, PORT), backlog=int(CONFIG["backlog"]), reuse_port=True
+        )
+
+    METRICS["worker"] = {
+        "worker": worker,
+        "workers": WORKERS,
+        "pid": os.getpid(),
+    }
+    threading.Thread(
+        target=follow_journal,
+        args=(float(CONFIG["journal_interval"]),),
+        daemon=True,
+    ).start()
+    serve(sock)
+
+
+def run_workers() -> None:
+    """
+    Pre-forks WORKERS processes that serve the app on the same port.
+    With SO_REUSEPORT every worker listens on its own socket and the
+    kernel spreads the connections over them, otherwise they share
+    one socket created here.
+    The workers only append to the shared journal, this process follows
+    it and is the only one writing the snapshots.
+    A worker that dies is replaced
+    """
+    assert JOURNAL is not None and JOURNAL.shared
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        print(f"Received signal {signum}, stopping the workers...")
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    sock = None
+    if not hasattr(socket, "SO_REUSEPORT"):
+        sock = socket.create_server(
+            (HOST, PORT), backlog=int(CONFIG["backlog"])
+        )
+
+    workers: dict[int, int] = dict()  # pid: worker
+
+    def start_worker(worker: int) -> None:
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(worker, sock)
+            except BaseException:
+                sys.excepthook(*sys.exc_info())
+            finally:
+                # never return into the loop of the parent
+                os._exit(1)
+        workers[pid] = worker
+
+    for worker in range(WORKERS):
+        start_worker(worker)
+
+    written_seq = -1
+    while not stopping:
+        time.sleep(float(CONFIG["snapshot_interval"]))
+
+        while workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            worker = workers.pop(pid)
+            if not stopping:
+                print(f"Worker {worker} exited with {status}, restarting")
+                start_worker(worker)
+
+        JOURNAL.catch_up()
+        if STATE.seq != written_seq:
+            write_state(STATE)
+            written_seq = STATE.seq
+
+    for pid in workers:
+        os.kill(pid, signal.SIGTERM)
+    for pid in workers:
+        os.waitpid(pid, 0)
+
+    # what the workers appended since the last snapshot
+    JOURNAL.catch_up()
+    write_state(STATE)
+    print("Workers stopped. Exiting.")
+
+
+def follow_journal(interval: float) -> None:
+    """
+    Keeps a replica or worker up to date, also while no requests arrive,
+    so the waiters of /wait_for_changes learn about changes.
+    Replicas report their lag in METRICS
+    """
+    assert JOURNAL is not None
+    while True:
+        JOURNAL.catch_up()
+        if not JOURNAL.read_only:
+            time.sleep(interval)
+            continue
+
+        METRICS["replica"] = {
+            "primary": CONFIG["replica_of"],
+            "seq": STATE.seq,
+            "applied": JOURNAL.applied,
+            "lag_seconds": JOURNAL.lag,
+            # what the primary appended but the replica didn't apply yet
+            "behind_bytes": os.fstat(JOURNAL.fd).st_size - JOURNAL.offset,
+        }
+        time.sleep(interval)
+
+
+def run_replica(directory: str) -> None:
+    """
+    Serves the data of the primary in directory read only.
+    Starts from its last snapshot and then follows its journal,
+    routes that change the state are refused
+    """
+    global USERS_FILE, GROUPS_FILE, SNAPSHOT_FILE, STATE, JOURNAL
+
+    USERS_FILE = os.path.join(directory, USERS_FILE)
+    GROUPS_FILE = os.path.join(directory, GROUPS_FILE)
+    SNAPSHOT_FILE = os.path.join(directory, SNAPSHOT_FILE)
+    responses: dict[str, dict] = dict()
+    seq = load_snapshot(USERS, GROUPS, responses)
+    STATE = dataclasses.replace(
+        STATE, seq=seq, responses=Snapshot().merge(responses)
+    )
+
+    JOURNAL = Journal(os.path.join(directory, JOURNAL_FILE), read_only=True)
+    JOURNAL.catch_up()
+    threading.Thread(
+        target=follow_journal,
+        args=(float(CONFIG["journal_interval"]),),
+        daemon=True,
+    ).start()
+
+    serve()
+
+
 def shutdown_handler(signum, frame):
     print(f"Received signal {signum}, shutting down gracefully...")
 
@@ -594,16 +4144,28 @@ def shutdown_handler(signum, frame):
 
 
 if __name__ == "__main__":
+    if CONFIG["replica_of"]:
+        run_replica(str(CONFIG["replica_of"]))
+        sys.exit(0)
+
+    load_state()
+
+    if WORKERS > 1:
+        JOURNAL = Journal(JOURNAL_FILE, shared=True)
+        run_workers()
+        sys.exit(0)
+
+    if CONFIG["journal"]:
+        JOURNAL = Journal(JOURNAL_FILE)
+
     # Register handlers for SIGINT (Ctrl+C) and SIGTERM (e.g., pkill)
     signal.signal(signal.SIGINT, shutdown_handler)
     signal.signal(signal.SIGTERM, shutdown_handler)
 
-    load_data(USERS, GROUPS)
-
     thread = threading.Thread(target=writer_thread)
     thread.start()
 
     if DEBUG:
-        app.run(host="0.0.0.0", port=5000, debug=True)
+        app.run(host=HOST, port=PORT, debug=True)
     else:
-        waitress.serve(app, host="0.0.0.0", port=5000)
+        serve()
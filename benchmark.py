@@ -0,0 +1,628 @@
+"""
+Microbenchmarks for the bwise backend.
+
+Generates synthetic datasets, times every route through the flask
+test client and times the persistence and balance helpers in isolation.
+The results are printed (or written with --output) as json.
+
+Usage:
+    python benchmark.py --scale 1k --scale 10k --output bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import tempfile
+import threading
+import time
+from typing import Callable
+
+import app as bwise
+
+# name: (number of users, number of groups)
+SCALES: dict[str, tuple[int, int]] = {
+    "1k": (1_000, 100),
+    "10k": (10_000, 1_000),
+    "100k": (100_000, 10_000),
+    "1m": (1_000_000, 100_000),
+}
+
+
+def generate_dataset(
+    users_count: int,
+    groups_count: int,
+    members_per_group: int = 8,
+    transactions_per_group: int = 20,
+    heavy_group_ratio: float = 0.01,
+    heavy_transactions: int = 10_000,
+    seed: int = 56,
+) -> tuple[dict[str, bwise.User], dict[str, bwise.Group]]:
+    """
+    Builds USERS and GROUPS like dicts without going through the routes.
+    Every group gets random members and transactions between them,
+    a small share of the groups are "heavy" and get many more transactions.
+    The first group is always heavy
+    """
+    rng = random.Random(seed)
+    usernames = [f"user{i}" for i in range(users_count)]
+    users = {username: bwise.User(username) for username in usernames}
+    groups: dict[str, bwise.Group] = dict()
+    heavy_groups = max(1, int(groups_count * heavy_group_ratio))
+
+    for i in range(groups_count):
+        members = rng.sample(usernames, min(members_per_group, users_count))
+
+        if i < heavy_groups:
+            count = heavy_transactions
+        else:
+            count = transactions_per_group
+
+        transactions = []
+        for _ in range(count):
+            from_user, to_user = rng.sample(members, 2)
+            transactions.append(
+                bwise.Transaction(
+                    from_user, to_user, round(rng.uniform(1, 100), 2)
+                )
+            )
+
+        group = bwise.Group(f"group{i}", members[0], members, transactions)
+        groups[group.name] = group
+
+    return users, groups
+
+
+def generate_journal(
+    filename: str,
+    operations: int,
+    users_count: int = 10_000,
+    groups_count: int = 1_000,
+    members_per_group: int = 8,
+    seed: int = 56,
+) -> None:
+    """
+    Writes a journal of operations entries, one second apart: logins,
+    groups with their members, then expenses with a settle up now and
+    then, like the routes would have journaled them
+    """
+    rng = random.Random(seed)
+    usernames = [f"user{i}" for i in range(users_count)]
+    members: dict[str, list[str]] = dict()
+    entries: list[tuple[str, dict]] = [
+        ("login", {"username": username}) for username in usernames
+    ]
+    for i in range(groups_count):
+        group_name = f"group{i}"
+        members[group_name] = rng.sample(usernames, members_per_group)
+        entries.append(
+            (
+                "create_group",
+                {"username": members[group_name][0], "group_name": group_name},
+            )
+        )
+        entries.extend(
+            ("join_group", {"username": member, "group_name": group_name})
+            for member in members[group_name][1:]
+        )
+    group_names = list(members)
+
+    with open(filename, "w") as f:
+        for seq in range(1, operations + 1):
+            if seq <= len(entries):
+                operation, args = entries[seq - 1]
+            else:
+                group_name = rng.choice(group_names)
+                username, to_user = rng.sample(members[group_name], 2)
+                if rng.random() < 0.01:
+                    operation = "settle_up"
+                    args = {
+                        "username": username,
+                        "to_user": to_user,
+                        "group_name": group_name,
+                    }
+                else:
+                    operation = "add_expense"
+                    args = {
+                        "username": username,
+                        "group_name": group_name,
+                        "amount": round(rng.uniform(1, 100), 2),
+                    }
+            f.write(
+                json.dumps(
+                    {
+                        "seq": seq,
+                        "ts": 1_700_000_000.0 + seq,
+                        "op": operation,
+                        "args": args,
+                    }
+                )
+                + "\n"
+            )
+
+
+def summarize(durations: list[float]) -> dict[str, float]:
+    return {
+        "runs": len(durations),
+        "min": min(durations),
+        "median": statistics.median(durations),
+        "mean": statistics.fmean(durations),
+        "max": max(durations),
+    }
+
+
+def measure(function: Callable[[], object], repeat: int) -> dict[str, float]:
+    """Calls function repeat times and summarizes the durations in seconds"""
+    durations: list[float] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+
+    return summarize(durations)
+
+
+def install_dataset(
+    users: dict[str, bwise.User], groups: dict[str, bwise.Group]
+) -> None:
+    """Replaces the in-memory state of the app with the dataset"""
+    bwise.USERS.clear()
+    bwise.USERS.update(users)
+    bwise.GROUPS.clear()
+    bwise.GROUPS.update(groups)
+
+
+def bench_routes(repeat: int, seed: int) -> dict[str, dict[str, float]]:
+    """
+    Times every route through the flask test client
+    against whatever dataset is currently installed.
+    Mutating routes really mutate the state, like in production
+    """
+    rng = random.Random(seed)
+    client = bwise.app.test_client()
+    groups = list(bwise.GROUPS.values())
+    heavy_group = groups[0]
+    usernames = list(bwise.USERS.keys())
+    results: dict[str, dict[str, float]] = dict()
+
+    def post(route: str, payload: dict) -> None:
+        response = client.post(route, json=payload)
+        assert response.status_code < 400, (route, response.get_json())
+
+    def member_request(group: bwise.Group) -> dict[str, str]:
+        return {"username": group.members[0], "group_name": group.name}
+
+    results["/login"] = measure(
+        lambda: post("/login", {"username": rng.choice(usernames)}), repeat
+    )
+    results["/get_user_groups"] = measure(
+        lambda: post(
+            "/get_user_groups", {"username": rng.choice(groups).members[0]}
+        ),
+        repeat,
+    )
+    results["/get_debts"] = measure(
+        lambda: post("/get_debts", member_request(rng.choice(groups))),
+        repeat,
+    )
+    results["/get_debts heavy group"] = measure(
+        lambda: post("/get_debts", member_request(heavy_group)), repeat
+    )
+    results["/add_expense"] = measure(
+        lambda: post(
+            "/add_expense",
+            {**member_request(rng.choice(groups)), "amount": 30},
+        ),
+        repeat,
+    )
+
+    def settle_up() -> None:
+        group = rng.choice(groups)
+        post(
+            "/settle_up",
+            {**member_request(group), "to_user": group.members[1]},
+        )
+
+    results["/settle_up"] = measure(settle_up, repeat)
+
+    # new users and groups so that the routes below always succeed
+    new_users = [f"bench_user{i}" for i in range(repeat)]
+    results["/login new user"] = measure(
+        lambda: post("/login", {"username": new_users.pop()}), repeat
+    )
+
+    creators = iter(usernames)
+    new_groups = [f"bench_group{i}" for i in range(repeat)]
+    results["/create_group"] = measure(
+        lambda: post(
+            "/create_group",
+            {"username": next(creators), "group_name": new_groups.pop()},
+        ),
+        repeat,
+    )
+
+    joiners = [f"bench_joiner{i}" for i in range(repeat)]
+    for joiner in joiners:
+        bwise.USERS[joiner] = bwise.User(joiner)
+    joined = list(joiners)
+    results["/join_group"] = measure(
+        lambda: post(
+            "/join_group",
+            {"username": joined.pop(), "group_name": heavy_group.name},
+        ),
+        repeat,
+    )
+    results["/kick_user"] = measure(
+        lambda: post(
+            "/kick_user",
+            {
+                "username": heavy_group.creator,
+                "target_username": joiners.pop(),
+                "group_name": heavy_group.name,
+            },
+        ),
+        repeat,
+    )
+
+    creators = iter(usernames)
+    deleted_groups = [f"bench_group{i}" for i in range(repeat)]
+    results["/delete_group"] = measure(
+        lambda: post(
+            "/delete_group",
+            {"username": next(creators), "group_name": deleted_groups.pop()},
+        ),
+        repeat,
+    )
+
+    return results
+
+
+def bench_functions(repeat: int) -> dict[str, dict[str, float]]:
+    """
+    Times the persistence and balance helpers in isolation
+    against whatever dataset is currently installed.
+    Expects the writer thread to be running in the current directory
+    """
+    results: dict[str, dict[str, float]] = dict()
+    groups = list(bwise.GROUPS.values())
+    heavy_group = groups[0]
+    typical_group = groups[-1]
+
+    def drain_queue() -> None:
+        bwise.write_queue.join()
+
+    # only the serialization that happens while handling the request
+    results["save_data"] = measure(bwise.save_data, repeat)
+    drain_queue()
+
+    def changed_save() -> None:
+        # the writer thread skips versions it already wrote
+        bwise.USERS.publish(lambda state: state)
+        bwise.save_data()
+        drain_queue()
+
+    # serialization and the write done by the writer thread
+    results["save_data + write"] = measure(changed_save, repeat)
+    results["load_data"] = measure(
+        lambda: bwise.load_data(dict(), dict()), repeat
+    )
+
+    snapshot_format = bwise.CONFIG["snapshot_format"]
+    lazy_load = bwise.CONFIG["lazy_load"]
+    bwise.CONFIG["snapshot_format"] = "binary"
+    try:
+        results["write_state binary"] = measure(
+            lambda: bwise.write_state(bwise.STATE), repeat
+        )
+        results["load_data binary"] = measure(
+            lambda: bwise.load_data(dict(), dict()), repeat
+        )
+        bwise.CONFIG["lazy_load"] = True
+        results["load_data lazy"] = measure(
+            lambda: bwise.load_data(dict(), dict()), repeat
+        )
+    finally:
+        bwise.CONFIG["snapshot_format"] = snapshot_format
+        bwise.CONFIG["lazy_load"] = lazy_load
+        os.remove(bwise.SNAPSHOT_FILE)
+
+    for label, group in [("heavy", heavy_group), ("typical", typical_group)]:
+        username = group.members[0]
+        results[f"calculate_relative_debt {label} group"] = measure(
+            lambda: bwise.calculate_relative_debt(group, username), repeat
+        )
+
+        results[f"settle_up_internal {label} group"] = measure(
+            lambda: bwise.settle_up_internal(
+                group.members[0], group, group.members[1]
+            ),
+            repeat,
+        )
+
+    return results
+
+
+def bench_compression(repeat: int) -> dict[str, dict]:
+    """
+    Writes and loads the json snapshot of the installed dataset with
+    every available codec, for picking CONFIG["compression"].
+    Reports the wall and CPU seconds of a write, the size on disk,
+    the json megabytes written per second and the load times
+    """
+    codecs = [
+        codec
+        for codec in bwise.COMPRESSION_MAGIC
+        if codec != "zstd" or bwise.zstandard is not None
+    ]
+    json_bytes = len(json.dumps(list(bwise.USERS))) + len(
+        json.dumps([group.to_dict() for group in bwise.GROUPS.values()])
+    )
+    compression = bwise.CONFIG["compression"]
+    results: dict[str, dict] = dict()
+    try:
+        for codec in codecs:
+            bwise.CONFIG["compression"] = codec
+            cpu_start = time.process_time()
+            write = measure(lambda: bwise.write_state(bwise.STATE), repeat)
+            cpu = (time.process_time() - cpu_start) / repeat
+            size = os.path.getsize(bwise.USERS_FILE) + os.path.getsize(
+                bwise.GROUPS_FILE
+            )
+            results[codec] = {
+                "write": write,
+                "write_cpu_seconds": cpu,
+                "bytes": size,
+                "ratio": json_bytes / size,
+                "megabytes_per_second": json_bytes / write["median"] / 1e6,
+                "load": measure(
+                    lambda: bwise.load_data(dict(), dict()), repeat
+                ),
+            }
+    finally:
+        bwise.CONFIG["compression"] = compression
+
+    return results
+
+
+class PlainGroup:
+    """A mutable group for the plain lock design in bench_concurrent_reads"""
+
+    def __init__(self, group: bwise.Group):
+        self.members = list(group.members)
+        self.transactions = list(group.transactions)
+
+
+def bench_concurrent_reads(
+    readers: int, writers: int, duration: float, seed: int
+) -> dict[str, dict[str, float]]:
+    """
+    Read throughput while other threads keep adding transactions,
+    for the copy-on-write State of the app
+    and for a plain design where one lock guards groups modified in place.
+    A read computes one member's debts in a random group.
+    Expects the dataset to be installed
+    """
+    names = list(bwise.GROUPS.keys())
+    plain_groups = {
+        name: PlainGroup(group) for name, group in bwise.GROUPS.items()
+    }
+    plain_lock = threading.Lock()
+
+    def copy_on_write_read(name: str) -> None:
+        group = bwise.STATE.groups[name]
+        bwise.calculate_relative_debt(group, group.members[0])
+
+    def copy_on_write_write(name: str) -> None:
+        with bwise.locked_group(name) as group:
+            assert group is not None
+            transaction = bwise.Transaction(*group.members[:2], 1.0)
+            bwise.GROUPS[name] = group.replace(
+                transactions=[*group.transactions, transaction]
+            )
+
+    def plain_read(name: str) -> None:
+        with plain_lock:
+            group = plain_groups[name]
+            bwise.calculate_relative_debt(group, group.members[0])
+
+    def plain_write(name: str) -> None:
+        with plain_lock:
+            group = plain_groups[name]
+            group.transactions.append(
+                bwise.Transaction(*group.members[:2], 1.0)
+            )
+
+    designs = {
+        "copy-on-write": (copy_on_write_read, copy_on_write_write),
+        "plain lock": (plain_read, plain_write),
+    }
+    results: dict[str, dict[str, float]] = dict()
+
+    for design, (read, write) in designs.items():
+        counts = {"reads": 0, "writes": 0}
+        counts_lock = threading.Lock()
+        deadline = time.perf_counter() + duration
+
+        def worker(operation: Callable[[str], None], kind: str, i: int):
+            rng = random.Random(seed + i)
+            done = 0
+            while time.perf_counter() < deadline:
+                operation(rng.choice(names))
+                done += 1
+            with counts_lock:
+                counts[kind] += done
+
+        threads = [
+            threading.Thread(target=worker, args=(read, "reads", i))
+            for i in range(readers)
+        ] + [
+            threading.Thread(target=worker, args=(write, "writes", -i - 1))
+            for i in range(writers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        results[design] = {
+            "readers": readers,
+            "writers": writers,
+            "reads_per_second": counts["reads"] / duration,
+            "writes_per_second": counts["writes"] / duration,
+        }
+
+    return results
+
+
+def run_scale(
+    users_count: int,
+    groups_count: int,
+    repeat: int = 20,
+    seed: int = 56,
+    concurrent_reads: float = 0,
+    **dataset_options,
+) -> dict:
+    """
+    Generates one dataset and runs every benchmark on it
+    inside a temporary directory, so real data files are never touched.
+    The concurrent read benchmark runs for concurrent_reads seconds
+    per design, it is skipped when that is 0
+    """
+    users, groups = generate_dataset(
+        users_count, groups_count, seed=seed, **dataset_options
+    )
+    transactions_count = sum(len(g.transactions) for g in groups.values())
+
+    old_cwd = os.getcwd()
+    old_log = bwise.LOG
+    bwise.LOG = False
+    writer = threading.Thread(target=bwise.writer_thread)
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        writer.start()
+        try:
+            install_dataset(users, groups)
+            functions = bench_functions(repeat)
+            compression = bench_compression(repeat)
+            routes = bench_routes(repeat, seed)
+            if concurrent_reads:
+                install_dataset(users, groups)
+                reads = bench_concurrent_reads(4, 2, concurrent_reads, seed)
+        finally:
+            bwise.write_queue.put(None)
+            writer.join()
+            bwise.USERS.clear()
+            bwise.GROUPS.clear()
+            bwise.LOG = old_log
+            os.chdir(old_cwd)
+
+    result = {
+        "users": users_count,
+        "groups": groups_count,
+        "transactions": transactions_count,
+        "repeat": repeat,
+        "routes": routes,
+        "functions": functions,
+        "compression": compression,
+    }
+    if concurrent_reads:
+        result["concurrent_reads"] = reads
+    return result
+
+
+def bench_replay(operations: int, seed: int) -> dict[str, float]:
+    """
+    Replays a generated journal of operations entries from an empty
+    state, the way recover.py rebuilds the state at a point in time.
+    Run once, a replay of a million operations takes a while
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, bwise.JOURNAL_FILE)
+        generate_journal(filename, operations, seed=seed)
+        empty = bwise.State(bwise.Snapshot(), bwise.Snapshot())
+        with bwise.gc_paused():
+            start = time.perf_counter()
+            state = bwise.replay(empty, bwise.read_journal(filename))
+            seconds = time.perf_counter() - start
+
+    return {
+        "operations": operations,
+        "seconds": seconds,
+        "operations_per_second": operations / seconds,
+        "groups": len(state.groups),
+        "transactions": sum(
+            group.transaction_count for group in state.groups.values()
+        ),
+    }
+
+
+def parse_scale(scale: str) -> tuple[int, int]:
+    """Accepts a name from SCALES or USERSxGROUPS, e.g. 5000x500"""
+    if scale in SCALES:
+        return SCALES[scale]
+
+    users_count, groups_count = scale.lower().split("x")
+    return int(users_count), int(groups_count)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument(
+        "--scale",
+        action="append",
+        help=f"one of {', '.join(SCALES)} or USERSxGROUPS (repeatable)",
+    )
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--heavy-transactions", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=56)
+    parser.add_argument(
+        "--concurrent-reads",
+        type=float,
+        default=0,
+        metavar="SECONDS",
+        help="also compare read throughput under concurrent writes",
+    )
+    parser.add_argument(
+        "--replay-operations",
+        type=int,
+        default=0,
+        metavar="N",
+        help="also time the replay of a journal of N operations",
+    )
+    parser.add_argument("--output", help="file to write the json results to")
+    args = parser.parse_args()
+
+    results = []
+    for scale in args.scale or ["1k"]:
+        users_count, groups_count = parse_scale(scale)
+        result = run_scale(
+            users_count,
+            groups_count,
+            repeat=args.repeat,
+            seed=args.seed,
+            concurrent_reads=args.concurrent_reads,
+            heavy_transactions=args.heavy_transactions,
+        )
+        results.append({"scale": scale, **result})
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "results": results,
+    }
+    if args.replay_operations:
+        report["replay"] = bench_replay(args.replay_operations, args.seed)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Offline bulk import of NDJSON, in the format of /export, into the data
+of a stopped server, with the same checks as the /import route.
+
+Every batch of records is appended to the journal as one operation,
+so an interrupted import keeps the batches before it. The snapshot is
+written once at the end and a journal that was only created for the
+import is removed again.
+
+    python bulk_import.py ledger.ndjson --directory ./data
+    python bulk_import.py ledger.ndjson.gz --batch-size 50000
+    zcat ledger.ndjson.gz | python bulk_import.py -
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import app as bwise
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def run(
+    filename: str, directory: str = ".", batch_size: int | None = None
+) -> dict:
+    """Imports filename ("-" for stdin) and returns the report"""
+    if batch_size is None:
+        batch_size = int(bwise.CONFIG["import_batch"])
+    if filename == "-":
+        source = sys.stdin.buffer
+    else:
+        source = open(filename, "rb")
+
+    old_cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        bwise.load_state()
+        created_journal = not os.path.exists(bwise.JOURNAL_FILE)
+        bwise.JOURNAL = bwise.Journal(bwise.JOURNAL_FILE)
+        start = time.monotonic()
+
+        def progress(stats: dict) -> None:
+            print(
+                f"{stats['lines']} lines, {stats['transactions']} "
+                f"transactions, {stats['errors']} errors, "
+                f"{stats['lines'] / (time.monotonic() - start):.0f} lines/s",
+                file=sys.stderr,
+            )
+
+        importer = bwise.Importer(batch_size, progress, save=None)
+        compressed = source.peek(2)[:2] == GZIP_MAGIC  # type: ignore
+        for line in bwise.read_lines(source, compressed):
+            importer.feed(line)
+        importer.flush()
+
+        bwise.write_state(bwise.STATE)
+        os.close(bwise.JOURNAL.fd)
+        bwise.JOURNAL = None
+        if created_journal:
+            os.remove(bwise.JOURNAL_FILE)
+    finally:
+        os.chdir(old_cwd)
+        if source is not sys.stdin.buffer:
+            source.close()
+
+    return importer.report()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("file", help="NDJSON or gzipped NDJSON, - for stdin")
+    parser.add_argument("--directory", default=".")
+    parser.add_argument("--batch-size", type=int, default=None)
+    args = parser.parse_args()
+
+    report = run(args.file, args.directory, args.batch_size)
+    print(json.dumps(report, indent=2))
+    if report["errors"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,569 @@
+"""
+Group-sharded cluster of app.py processes behind a routing front.
+
+Every group lives on one shard, picked by consistent hashing of its
+name (HashRing), so each shard only holds and persists its share of the
+groups. The router forwards a request for a group to the shard of the
+group. Users are logged in on every shard, so every shard can check
+them, and /get_user_groups asks all shards and merges their answers,
+which each shard looks up in its index of the groups of every user.
+
+Changing the shards (Router.set_shards() or the /cluster/shards route)
+only moves the groups whose place on the ring changed. Requests for
+those groups wait until they moved, all other requests carry on.
+
+Three local shards in ./cluster/shard<N> and the router on port 5000:
+    python cluster.py --shards 3 --port 5000
+Shards that are already running somewhere else:
+    python cluster.py --shard a=http://10.0.0.1:5000 --shard b=...
+"""
+
+import argparse
+import bisect
+import collections
+import concurrent.futures
+import hashlib
+import http.client
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from typing import Iterable, Iterator, Mapping
+from urllib.parse import urlsplit
+
+import flask
+import waitress
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+# seconds to wait for a shard to answer
+SHARD_TIMEOUT = 10
+# the admin user the router moves groups with, logged in on every shard
+ADMIN_USER = "admin_cluster"
+
+# routes of a single group, forwarded to the shard of "group_name"
+GROUP_ROUTES = {
+    "/create_group",
+    "/join_group",
+    "/delete_group",
+    "/settle_up",
+    "/kick_user",
+    "/add_expense",
+    "/get_debts",
+    "/get_group_balances",
+    "/get_transactions",
+}
+
+# routes the router refuses, with the reason. broadcast() can't merge
+# their answers and a shard only knows its own groups
+UNROUTED_ROUTES = {
+    # a stream of lines
+    "/export": "Export the shards one by one",
+    # every shard would import every group, not only its own
+    "/import": "Import into the shards one by one",
+    # every shard would hold it, longer than SHARD_TIMEOUT
+    "/wait_for_changes": "Long polls are not supported by the cluster, "
+    "poll the groups instead",
+    # an endless stream, the router would wait for its end
+    "/events": "Event streams are not supported by the cluster, "
+    "poll the groups instead",
+}
+
+
+def ring_hash(key: str) -> int:
+    # stable across processes, unlike hash()
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hashing: every shard is put on the ring at points
+    positions and a key belongs to the next shard after its hash.
+    Adding or removing a shard only moves the keys next to its points
+    """
+
+    def __init__(self, shards: Iterable[str], points: int = 64):
+        self.ring = sorted(
+            (ring_hash(f"{shard}#{i}"), shard)
+            for shard in shards
+            for i in range(points)
+        )
+        self.hashes = [point for point, _ in self.ring]
+
+    def shard_for(self, key: str) -> str:
+        index = bisect.bisect(self.hashes, ring_hash(key)) % len(self.ring)
+        return self.ring[index][1]
+
+
+class ShardError(Exception):
+    def __init__(self, shard: str):
+        super().__init__(f"Shard {shard} is unavailable")
+        self.shard = shard
+
+
+class Shard:
+    """An app.py process, with one keep-alive connection per thread"""
+
+    def __init__(self, name: str, url: str):
+        self.name = name
+        self.url = url
+        parts = urlsplit(url)
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or 80
+        self.local = threading.local()
+
+    def post(
+        self, route: str, body: bytes, headers: Mapping[str, str] | None = None
+    ) -> tuple[int, bytes]:
+        """Raises ShardError when the shard can't be reached"""
+        connection = getattr(self.local, "connection", None)
+        reused = connection is not None
+
+        while True:
+            if connection is None:
+                connection = http.client.HTTPConnection(
+                    self.host, self.port, timeout=SHARD_TIMEOUT
+                )
+                self.local.connection = connection
+            try:
+                connection.request(
+                    "POST",
+                    route,
+                    body,
+                    {**(headers or {}), "Content-Type": "application/json"},
+                )
+                response = connection.getresponse()
+                return response.status, response.read()
+            except (
+                http.client.RemoteDisconnected,
+                BrokenPipeError,
+                ConnectionResetError,
+            ):
+                connection.close()
+                connection = self.local.connection = None
+                # the shard closed an idle keep-alive connection, try again
+                if reused:
+                    reused = False
+                    continue
+                raise ShardError(self.name)
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                self.local.connection = None
+                raise ShardError(self.name)
+
+    def post_json(self, route: str, payload: dict) -> tuple[int, dict]:
+        status, body = self.post(route, json.dumps(payload).encode())
+        return status, json.loads(body)
+
+
+class Router:
+    """
+    Knows the shards and forwards the requests to them.
+    While the shards change, next_ring is the ring being moved to
+    """
+
+    def __init__(self, shards: Mapping[str, str]):
+        self.shards = {name: Shard(name, url) for name, url in shards.items()}
+        self.ring = HashRing(self.shards)
+        self.next_ring: HashRing | None = None
+        # group name: requests currently forwarded for it
+        self.in_flight: collections.Counter[str] = collections.Counter()
+        self.condition = threading.Condition()
+        # one change of the shards at a time
+        self.rebalance_lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(16)
+
+    def moves(self, group_name: str) -> bool:
+        if self.next_ring is None:
+            return False
+        old_shard = self.ring.shard_for(group_name)
+        return self.next_ring.shard_for(group_name) != old_shard
+
+    @contextmanager
+    def shard_of(self, group_name: str) -> Iterator[Shard]:
+        """The shard of the group, waits while the group is being moved"""
+        with self.condition:
+            while self.moves(group_name):
+                self.condition.wait()
+            shard = self.shards[self.ring.shard_for(group_name)]
+            self.in_flight[group_name] += 1
+        try:
+            yield shard
+        finally:
+            with self.condition:
+                self.in_flight[group_name] -= 1
+                if not self.in_flight[group_name]:
+                    del self.in_flight[group_name]
+                self.condition.notify_all()
+
+    def forward(
+        self, route: str, body: bytes, headers: Mapping[str, str] | None = None
+    ) -> tuple[int, bytes]:
+        """Sends a request to the shard of its group"""
+        try:
+            group_name = str(json.loads(body).get("group_name"))
+        except (ValueError, AttributeError):
+            group_name = ""
+        with self.shard_of(group_name) as shard:
+            return shard.post(route, body, headers)
+
+    def broadcast(self, route: str, body: bytes) -> dict[str, tuple]:
+        """Sends the request to every shard at once, answers by shard"""
+        with self.condition:
+            shards = list(self.shards.values())
+        futures = {
+            shard.name: self.executor.submit(shard.post, route, body)
+            for shard in shards
+        }
+        return {name: future.result() for name, future in futures.items()}
+
+    def login(self, body: bytes) -> tuple[int, bytes]:
+        answers = list(self.broadcast("/login", body).values())
+        # a user that is new on any shard was registered now
+        for status, response in answers:
+            if status == 201:
+                return status, response
+        return answers[0]
+
+    def batch(
+        self, body: bytes, headers: Mapping[str, str] | None = None
+    ) -> tuple[int, bytes]:
+        """
+        Sends a /batch to the shard of its groups, which all have to be
+        on one shard. Its logins are run on every shard first
+        """
+        try:
+            operations = json.loads(body)["operations"]
+            group_names = {
+                str(operation["args"]["group_name"])
+                for operation in operations
+                if operation.get("op") != "login"
+            }
+            logins = [
+                operation
+                for operation in operations
+                if operation.get("op") == "login"
+            ]
+        except (ValueError, TypeError, KeyError, AttributeError):
+            # let a shard answer what is wrong with it
+            return self.forward("/batch", body, headers)
+        if not operations:
+            return self.forward("/batch", body, headers)
+
+        with ExitStack() as stack:
+            shards = {
+                stack.enter_context(self.shard_of(name))
+                for name in sorted(group_names)
+            }
+            if len(shards) > 1:
+                message = "The groups of a batch have to be on one shard"
+                return 400, json.dumps({"message": message}).encode()
+
+            if logins:
+                answers = self.broadcast(
+                    "/batch", json.dumps({"operations": logins}).encode()
+                )
+                for status, response in answers.values():
+                    if status != 200:
+                        return status, response
+            if not shards:
+                # nothing but logins
+                return next(iter(answers.values()))
+            return shards.pop().post("/batch", body, headers)
+
+    def get_user_groups(self, body: bytes) -> tuple[int, bytes]:
+        answers = self.broadcast("/get_user_groups", body).values()
+        groups: dict[str, dict] = dict()
+        for status, response in answers:
+            if status != 200:
+                return status, response
+            # a group that is being moved can be on two shards for a moment
+            for group in json.loads(response)["groups"]:
+                groups[group["name"]] = group
+
+        return (
+            200,
+            json.dumps(
+                {
+                    "message": "Groups retrieved",
+                    "groups": [groups[name] for name in sorted(groups)],
+                }
+            ).encode(),
+        )
+
+    def set_shards(self, shards: Mapping[str, str]) -> dict[str, int]:
+        """
+        Changes the shards to shards (name: url), moving the groups whose
+        shard changes. Returns how many groups moved off every shard.
+        A failed change keeps the old shards and can simply be retried
+        """
+        with self.rebalance_lock:
+            new_shards = {
+                name: self.shards.get(name) or Shard(name, url)
+                for name, url in shards.items()
+            }
+            with self.condition:
+                old_shards = dict(self.shards)
+                self.shards = {**old_shards, **new_shards}
+                self.next_ring = HashRing(new_shards)
+                # requests that are on their way to groups that move
+                while any(self.moves(name) for name in self.in_flight):
+                    self.condition.wait()
+
+            try:
+                moved = self.move_groups(old_shards, new_shards)
+                with self.condition:
+                    self.ring = self.next_ring
+                    self.shards = new_shards
+            finally:
+                with self.condition:
+                    self.next_ring = None
+                    self.condition.notify_all()
+
+        return moved
+
+    def move_groups(
+        self, old_shards: dict[str, Shard], new_shards: dict[str, Shard]
+    ) -> dict[str, int]:
+        assert self.next_ring is not None
+        admin = json.dumps({"username": ADMIN_USER}).encode()
+        for name, (status, _) in self.broadcast("/login", admin).items():
+            if status not in (200, 201):
+                raise ShardError(name)
+
+        # new shards need all the users, a single old shard has them
+        if old_shards and set(new_shards) - set(old_shards):
+            source = next(iter(old_shards.values()))
+            _, exported = source.post_json(
+                "/export_groups",
+                {
+                    "username": ADMIN_USER,
+                    "group_names": [],
+                    "users": True,
+                },
+            )
+            for name in set(new_shards) - set(old_shards):
+                new_shards[name].post_json(
+                    "/import_groups",
+                    {"username": ADMIN_USER, "users": exported["users"]},
+                )
+
+        moved: dict[str, int] = dict()
+        for name, shard in old_shards.items():
+            _, listed = shard.post_json(
+                "/export_groups",
+                {"username": ADMIN_USER, "transactions": False},
+            )
+            targets: dict[str, list[str]] = collections.defaultdict(list)
+            for group in listed["groups"]:
+                target = self.next_ring.shard_for(group["name"])
+                if target != name:
+                    targets[target].append(group["name"])
+
+            for target, group_names in targets.items():
+                _, exported = shard.post_json(
+                    "/export_groups",
+                    {"username": ADMIN_USER, "group_names": group_names},
+                )
+                status, _ = new_shards[target].post_json(
+                    "/import_groups",
+                    {"username": ADMIN_USER, "groups": exported["groups"]},
+                )
+                if status != 200:
+                    raise ShardError(target)
+                # only deleted once the new shard has them
+                for group_name in group_names:
+                    shard.post_json(
+                        "/delete_group",
+                        {"username": ADMIN_USER, "group_name": group_name},
+                    )
+
+            moved[name] = sum(len(names) for names in targets.values())
+
+        return moved
+
+
+def json_response(status: int, body: bytes) -> flask.Response:
+    return flask.Response(body, status, content_type="application/json")
+
+
+def create_app(router: Router) -> flask.Flask:
+    """The routing front, a flask app forwarding to the shards"""
+    front = flask.Flask(__name__)
+
+    @front.errorhandler(ShardError)
+    def shard_unavailable(error: ShardError) -> flask.Response:
+        return json_response(502, json.dumps({"message": str(error)}).encode())
+
+    @front.route("/cluster/shards", methods=["POST"])
+    def change_shards() -> flask.Response:
+        """
+        Admin only, changes the shards to "shards" (name: url)
+        and moves the groups that belong to another shard now
+        """
+        data: dict = flask.request.get_json()
+        username = str(data.get("username"))
+        shards = data.get("shards")
+        if not isinstance(shards, dict) or not shards:
+            body = {"message": "shards is required"}
+            return json_response(400, json.dumps(body).encode())
+
+        # only admins that exist can view the metrics of a shard
+        status, _ = router.forward(
+            "/metrics", json.dumps({"username": username}).encode()
+        )
+        if status != 200 or not username.startswith("admin"):
+            body = {"message": "Only admins can change the shards"}
+            return json_response(403, json.dumps(body).encode())
+
+        moved = router.set_shards(shards)
+        body = {"message": "Shards changed", "moved": moved}
+        return json_response(200, json.dumps(body).encode())
+
+    @front.route("/<path:route>", methods=["POST"])
+    def forward(route: str) -> flask.Response:
+        route = "/" + route
+        body = flask.request.get_data()
+        # the shard of the group keeps the responses of the keys
+        headers = {
+            name: value
+            for name, value in flask.request.headers.items()
+            if name.lower() == "idempotency-key"
+        }
+
+        if route == "/login":
+            return json_response(*router.login(body))
+        if route == "/get_user_groups":
+            return json_response(*router.get_user_groups(body))
+        if route == "/batch":
+            return json_response(*router.batch(body, headers))
+        if route in UNROUTED_ROUTES:
+            message = {"message": UNROUTED_ROUTES[route]}
+            return json_response(400, json.dumps(message).encode())
+        if route in GROUP_ROUTES:
+            return json_response(*router.forward(route, body, headers))
+
+        # everything else, like /metrics, is answered by every shard
+        answers = {
+            name: {"status": status, "body": json.loads(response)}
+            for name, (status, response) in router.broadcast(
+                route, body
+            ).items()
+        }
+        result = {"message": "Answers of all shards", "shards": answers}
+        return json_response(200, json.dumps(result).encode())
+
+    return front
+
+
+def wait_until_listening(port: int, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"nothing is listening on port {port}")
+
+
+def start_local_shards(
+    directory: str, ports: list[int], env: Mapping[str, str] | None = None
+) -> tuple[dict[str, str], list[subprocess.Popen]]:
+    """
+    Starts an app.py for every port, each in its own directory
+    <directory>/shard<N>. Returns the shards (name: url) and the processes
+    """
+    shards: dict[str, str] = dict()
+    processes: list[subprocess.Popen] = []
+
+    for i, port in enumerate(ports):
+        shard_directory = os.path.join(directory, f"shard{i}")
+        os.makedirs(shard_directory, exist_ok=True)
+        log = open(os.path.join(shard_directory, "server.log"), "a")
+        processes.append(
+            subprocess.Popen(
+                [sys.executable, APP_PATH],
+                cwd=shard_directory,
+                env={
+                    **os.environ,
+                    "BWISE_LOG": "0",
+                    **(env or {}),
+                    "BWISE_HOST": "127.0.0.1",
+                    "BWISE_PORT": str(port),
+                },
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+        )
+        log.close()
+        shards[f"shard{i}"] = f"http://127.0.0.1:{port}"
+
+    for port in ports:
+        wait_until_listening(port)
+    return shards, processes
+
+
+def stop_local_shards(processes: list[subprocess.Popen]) -> None:
+    """Stops the shards through their SIGTERM handler, so they persist"""
+    for process in processes:
+        process.send_signal(signal.SIGTERM)
+    for process in processes:
+        process.wait(30)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument(
+        "--shards", type=int, default=2, help="local shards to start"
+    )
+    parser.add_argument(
+        "--shard-port",
+        type=int,
+        default=5100,
+        help="port of the first local shard, the others follow",
+    )
+    parser.add_argument("--data-dir", default="cluster")
+    parser.add_argument(
+        "--shard",
+        action="append",
+        default=[],
+        help="name=url of a running shard, instead of local ones",
+    )
+    parser.add_argument("--threads", type=int, default=16)
+    args = parser.parse_args()
+
+    processes: list[subprocess.Popen] = []
+    if args.shard:
+        shards = dict(shard.split("=", 1) for shard in args.shard)
+    else:
+        shards, processes = start_local_shards(
+            args.data_dir,
+            [args.shard_port + i for i in range(args.shards)],
+        )
+
+    def shutdown_handler(signum, frame):
+        print(f"Received signal {signum}, stopping the shards...")
+        stop_local_shards(processes)
+        sys.exit(0)
+
+    signal.signal(signal.SIGINT, shutdown_handler)
+    signal.signal(signal.SIGTERM, shutdown_handler)
+
+    print(f"Routing to {shards}")
+    waitress.serve(
+        create_app(Router(shards)),
+        host=args.host,
+        port=args.port,
+        threads=args.threads,
+    )
+
+
+if __name__ == "__main__":
+    main()
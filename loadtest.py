@@ -0,0 +1,566 @@
+"""
+End to end load test against app.py served on a local port,
+by waitress or by the asyncio server (aioserver.py).
+
+Starts the server in a temporary directory, seeds users and groups,
+drives a mix of login/get_user_groups/get_debts/add_expense/settle_up
+requests and reports throughput, latency percentiles and errors per route.
+Afterwards the server is stopped with SIGTERM (shutdown_handler)
+and the persisted json files are checked against the state
+the server reported while it was still running.
+
+Closed loop (every worker sends its next request as soon as it can):
+    python loadtest.py --concurrency 8 --duration 10
+Open loop (requests arrive at a fixed rate no matter how slow the server is):
+    python loadtest.py --rate 500 --concurrency 32 --duration 10
+Comparing the waitress and the asyncio server while 1000 idle keep-alive
+connections are held open:
+    python loadtest.py --server both --idle-connections 1000
+Four worker processes sharing the port (BWISE_WORKERS):
+    python loadtest.py --workers 4 --concurrency 32
+"""
+
+import argparse
+import concurrent.futures
+import http.client
+import json
+import os
+import queue
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+
+import app as bwise
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+# seconds to wait for a response before counting the request as an error
+CLIENT_TIMEOUT = 10
+
+# route: relative weight in the traffic mix
+TRAFFIC_MIX: dict[str, int] = {
+    "/login": 15,
+    "/get_user_groups": 30,
+    "/get_debts": 30,
+    "/add_expense": 20,
+    "/settle_up": 5,
+}
+
+
+@dataclass
+class RouteStats:
+    latencies: list[float] = field(default_factory=list)
+    errors: int = 0
+
+
+class Server:
+    """app.py running in its own process and directory"""
+
+    def __init__(self, directory: str, port: int, env: dict[str, str]):
+        self.directory = directory
+        self.port = port
+        self.log = open(os.path.join(directory, "server.log"), "w")
+        self.process = subprocess.Popen(
+            [sys.executable, APP_PATH],
+            cwd=directory,
+            env={
+                **os.environ,
+                **env,
+                "BWISE_HOST": "127.0.0.1",
+                "BWISE_PORT": str(port),
+            },
+            stdout=self.log,
+            stderr=subprocess.STDOUT,
+        )
+
+    def wait_until_ready(self, timeout: float = 10) -> None:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("server exited during startup")
+            try:
+                socket.create_connection(("127.0.0.1", self.port), 0.1).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise TimeoutError("server did not start listening")
+
+    def stop(self, timeout: float = 30) -> int:
+        """Stops the server through its SIGTERM handler"""
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            return self.process.wait(timeout)
+        finally:
+            self.log.close()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Client:
+    """A keep-alive connection, one per worker thread"""
+
+    def __init__(self, port: int, timeout: float = CLIENT_TIMEOUT):
+        self.port = port
+        self.timeout = timeout
+        self.connection = http.client.HTTPConnection(
+            "127.0.0.1", port, timeout=timeout
+        )
+
+    def post(self, route: str, payload: dict) -> tuple[int, dict]:
+        body = json.dumps(payload)
+        try:
+            self.connection.request(
+                "POST",
+                route,
+                body,
+                {"Content-Type": "application/json"},
+            )
+            response = self.connection.getresponse()
+            return response.status, json.loads(response.read())
+        except (OSError, http.client.HTTPException):
+            # reconnect so one broken connection doesn't fail every request
+            self.connection.close()
+            self.connection = http.client.HTTPConnection(
+                "127.0.0.1", self.port, timeout=self.timeout
+            )
+            raise
+
+
+class Workload:
+    """
+    Generates requests of the traffic mix against the seeded groups
+    and remembers every username it ever sent
+    """
+
+    def __init__(self, users: int, groups: int, members: int, seed: int):
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.usernames = [f"load_user{i}" for i in range(users)]
+        self.groups: dict[str, list[str]] = {
+            f"load_group{i}": self.rng.sample(
+                self.usernames, min(members, users)
+            )
+            for i in range(groups)
+        }
+        self.group_names = list(self.groups)
+        self.new_users = 0
+        self.routes = list(TRAFFIC_MIX)
+        self.weights = list(TRAFFIC_MIX.values())
+
+    def seed(self, client: Client) -> None:
+        for username in self.usernames:
+            client.post("/login", {"username": username})
+        for group_name, members in self.groups.items():
+            client.post(
+                "/create_group",
+                {"username": members[0], "group_name": group_name},
+            )
+            for member in members[1:]:
+                client.post(
+                    "/join_group",
+                    {"username": member, "group_name": group_name},
+                )
+
+    def next_request(self) -> tuple[str, dict]:
+        with self.lock:
+            rng = self.rng
+            route = rng.choices(self.routes, self.weights)[0]
+            group_name = rng.choice(self.group_names)
+            members = self.groups[group_name]
+
+            if route == "/login":
+                # mostly returning users, sometimes a new registration
+                if rng.random() < 0.1:
+                    username = f"load_new_user{self.new_users}"
+                    self.usernames.append(username)
+                    self.new_users += 1
+                else:
+                    username = rng.choice(self.usernames)
+                return route, {"username": username}
+            if route == "/get_user_groups":
+                return route, {"username": rng.choice(members)}
+            if route == "/get_debts":
+                return route, {
+                    "username": rng.choice(members),
+                    "group_name": group_name,
+                }
+            if route == "/add_expense":
+                return route, {
+                    "username": rng.choice(members),
+                    "group_name": group_name,
+                    "amount": round(rng.uniform(1, 200), 2),
+                }
+
+            username, to_user = rng.sample(members, 2)
+            return route, {
+                "username": username,
+                "to_user": to_user,
+                "group_name": group_name,
+            }
+
+
+def run_traffic(
+    port: int,
+    workload: Workload,
+    concurrency: int,
+    duration: float,
+    rate: float | None,
+) -> tuple[dict[str, RouteStats], float]:
+    """
+    Without a rate every worker sends requests back to back (closed loop).
+    With a rate, requests are scheduled by a Poisson arrival process
+    and their latency is measured from the scheduled time,
+    so queueing delay is included (open loop)
+    """
+    stats = {route: RouteStats() for route in TRAFFIC_MIX}
+    stats_lock = threading.Lock()
+    arrivals: queue.Queue[tuple[float, str, dict] | None] = queue.Queue()
+    deadline = time.perf_counter() + duration
+
+    def send(client: Client, start: float, route: str, payload: dict) -> None:
+        try:
+            status, _ = client.post(route, payload)
+            failed = status >= 500
+        except (OSError, http.client.HTTPException, ValueError):
+            failed = True
+        latency = time.perf_counter() - start
+
+        with stats_lock:
+            if failed:
+                stats[route].errors += 1
+            else:
+                stats[route].latencies.append(latency)
+
+    def closed_loop_worker() -> None:
+        client = Client(port)
+        while time.perf_counter() < deadline:
+            route, payload = workload.next_request()
+            send(client, time.perf_counter(), route, payload)
+
+    def open_loop_worker() -> None:
+        client = Client(port)
+        while (item := arrivals.get()) is not None:
+            send(client, *item)
+
+    def scheduler() -> None:
+        assert rate is not None
+        next_arrival = time.perf_counter()
+        while next_arrival < deadline:
+            delay = next_arrival - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            route, payload = workload.next_request()
+            arrivals.put((next_arrival, route, payload))
+            next_arrival += workload.rng.expovariate(rate)
+        for _ in range(concurrency):
+            arrivals.put(None)
+
+    worker = closed_loop_worker if rate is None else open_loop_worker
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    if rate is not None:
+        threads.append(threading.Thread(target=scheduler))
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return stats, time.perf_counter() - start
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float | None:
+    """Nearest rank percentile"""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def summarize(stats: dict[str, RouteStats], elapsed: float) -> dict:
+    routes = dict()
+    for route, route_stats in stats.items():
+        latencies = sorted(route_stats.latencies)
+        routes[route] = {
+            "requests": len(latencies),
+            "errors": route_stats.errors,
+            "throughput": len(latencies) / elapsed,
+            "p50": percentile(latencies, 0.5),
+            "p99": percentile(latencies, 0.99),
+            "p999": percentile(latencies, 0.999),
+        }
+
+    return {
+        "elapsed": elapsed,
+        "requests": sum(route["requests"] for route in routes.values()),
+        "errors": sum(route["errors"] for route in routes.values()),
+        "throughput": sum(r["throughput"] for r in routes.values()),
+        "routes": routes,
+    }
+
+
+def capture_state(port: int, workload: Workload) -> dict:
+    """
+    The in-memory state of the running server as seen through the routes:
+    every user, the members of every group
+    and every member's balances within the group
+    """
+    client = Client(port)
+    users = set()
+    groups: dict[str, dict] = dict()
+
+    for username in workload.usernames:
+        status, data = client.post("/get_user_groups", {"username": username})
+        if status != 200:
+            continue
+        users.add(username)
+        for group in data["groups"]:
+            groups[group["name"]] = {"members": sorted(group["members"])}
+
+    for group_name, group in groups.items():
+        balances = dict()
+        for member in group["members"]:
+            _, data = client.post(
+                "/get_debts", {"username": member, "group_name": group_name}
+            )
+            balances[member] = {
+                debt["username"]: debt["amount"]
+                * (1 if debt["status"] == "you owe" else -1)
+                for debt in data["debts"]
+            }
+        group["balances"] = balances
+
+    return {"users": sorted(users), "groups": groups}
+
+
+def load_persisted_state(directory: str) -> dict:
+    """The same view as capture_state, built from the persisted json files"""
+    users: dict[str, bwise.User] = dict()
+    groups: dict[str, bwise.Group] = dict()
+
+    old_cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        bwise.load_data(users, groups)
+    finally:
+        os.chdir(old_cwd)
+
+    return {
+        "users": sorted(users),
+        "groups": {
+            group.name: {
+                "members": sorted(group.members),
+                "balances": {
+                    member: {
+                        other: bwise.calculate_relative_debt(
+                            group, member
+                        ).get(other, 0.0)
+                        for other in group.members
+                    }
+                    for member in group.members
+                },
+            }
+            for group in groups.values()
+        },
+    }
+
+
+def compare_states(live: dict, persisted: dict) -> list[str]:
+    """Returns a human readable list of differences"""
+    problems = []
+    missing_users = set(live["users"]) - set(persisted["users"])
+    if missing_users:
+        problems.append(f"{len(missing_users)} users were not persisted")
+
+    for group_name, group in live["groups"].items():
+        persisted_group = persisted["groups"].get(group_name)
+        if persisted_group is None:
+            problems.append(f"group {group_name} was not persisted")
+            continue
+        if group["members"] != persisted_group["members"]:
+            problems.append(f"members of {group_name} differ")
+            continue
+        for member, balances in group["balances"].items():
+            for other, amount in balances.items():
+                persisted_amount = persisted_group["balances"][member][other]
+                if abs(amount - persisted_amount) > 1e-6:
+                    problems.append(
+                        f"{member} -> {other} in {group_name}: "
+                        f"{amount} live, {persisted_amount} persisted"
+                    )
+
+    return problems
+
+
+def open_idle_connections(
+    port: int, count: int, workload: Workload
+) -> list[Client | None]:
+    """
+    Opens count keep-alive connections that send one request each
+    and then stay idle, like clients waiting to poll again.
+    Connections the server did not answer are None
+    """
+
+    def open_connection(i: int) -> Client | None:
+        client = Client(port, timeout=2)
+        username = workload.usernames[i % len(workload.usernames)]
+        try:
+            client.post("/get_user_groups", {"username": username})
+            return client
+        except (OSError, http.client.HTTPException):
+            client.connection.close()
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(64) as executor:
+        return list(executor.map(open_connection, range(count)))
+
+
+def count_open_connections(clients: list[Client | None]) -> int:
+    """How many of the idle connections the server still answers on"""
+    still_open = 0
+    for client in clients:
+        if client is None:
+            continue
+        try:
+            client.post("/login", {"username": "idle_check"})
+            still_open += 1
+        except (OSError, http.client.HTTPException):
+            pass
+        finally:
+            client.connection.close()
+    return still_open
+
+
+def run(
+    users: int,
+    groups: int,
+    members: int,
+    concurrency: int,
+    duration: float,
+    rate: float | None,
+    seed: int,
+    server_mode: str = "waitress",
+    idle_connections: int = 0,
+    env: dict[str, str] | None = None,
+    workers: int = 1,
+) -> dict:
+    env = {
+        "BWISE_LOG": "0",
+        **(env or {}),
+        "BWISE_SERVER": server_mode,
+        "BWISE_WORKERS": str(workers),
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        port = free_port()
+        server = Server(directory, port, env)
+        try:
+            server.wait_until_ready()
+            workload = Workload(users, groups, members, seed)
+            workload.seed(Client(port))
+            idle = open_idle_connections(port, idle_connections, workload)
+
+            stats, elapsed = run_traffic(
+                port, workload, concurrency, duration, rate
+            )
+            still_open = count_open_connections(idle)
+            live_state = capture_state(port, workload)
+        finally:
+            exit_code = server.stop()
+
+        problems = compare_states(live_state, load_persisted_state(directory))
+
+    return {
+        "server": server_mode,
+        "workers": workers,
+        "mode": "closed loop" if rate is None else "open loop",
+        "concurrency": concurrency,
+        "rate": rate,
+        "idle_connections": {
+            "requested": idle_connections,
+            "opened": sum(client is not None for client in idle),
+            "still_open": still_open,
+        },
+        **summarize(stats, elapsed),
+        "shutdown_exit_code": exit_code,
+        "persistence_problems": problems,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--members", type=int, default=6)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument(
+        "--rate",
+        type=float,
+        help="requests per second for an open loop run",
+    )
+    parser.add_argument(
+        "--server",
+        choices=["waitress", "async", "both"],
+        default="waitress",
+        help="BWISE_SERVER of app.py, both runs the test once with each",
+    )
+    parser.add_argument(
+        "--idle-connections",
+        type=int,
+        default=0,
+        help="keep-alive connections held open during the test",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="worker processes of app.py, see run_workers()",
+    )
+    parser.add_argument("--seed", type=int, default=56)
+    parser.add_argument("--output", help="file to write the json report to")
+    args = parser.parse_args()
+
+    servers = ["waitress", "async"] if args.server == "both" else [args.server]
+    reports = [
+        run(
+            args.users,
+            args.groups,
+            args.members,
+            args.concurrency,
+            args.duration,
+            args.rate,
+            args.seed,
+            server_mode=server_mode,
+            idle_connections=args.idle_connections,
+            workers=args.workers,
+        )
+        for server_mode in servers
+    ]
+    report = reports[0] if len(reports) == 1 else {"runs": reports}
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if any(
+        run_report["shutdown_exit_code"] != 0
+        or run_report["persistence_problems"]
+        for run_report in reports
+    ):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""
+Performance regression gate.
+
+Runs the benchmarks from benchmark.py a few times, takes the median
+of every metric across the trials and compares it with the committed
+baseline in perf_baseline.json. Every metric has its own tolerance:
+the relative increase over the baseline that is still accepted.
+Exits with 1 when any metric regressed beyond its tolerance.
+
+Durations depend on the machine, so a fixed pure Python workload is
+timed along with them. The durations are scaled by how much faster or
+slower it ran than when the baseline was recorded.
+
+Usage:
+    python perf_gate.py            # compare against the baseline
+    python perf_gate.py --update   # record a new baseline
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import app as bwise
+import benchmark
+
+BASELINE_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "perf_baseline.json"
+)
+
+# used for metrics that are missing from the baseline file
+DEFAULT_TOLERANCES: dict[str, float] = {
+    "route": 1.0,
+    "snapshot_write": 1.0,
+    "startup": 1.0,
+    "memory_per_transaction": 0.1,
+}
+# metrics that are durations, scaled by the calibration
+TIMING_METRICS = {"route", "snapshot_write", "startup"}
+
+
+def measure_calibration(repeat: int) -> float:
+    """Median seconds of a fixed workload, the speed of this machine"""
+    records = [
+        {"id": i, "name": f"user{i}", "amount": i / 7} for i in range(2_000)
+    ]
+
+    def workload() -> None:
+        loaded = json.loads(json.dumps(records))
+        sorted(loaded, key=lambda record: record["name"])
+
+    return benchmark.measure(workload, repeat)["median"]
+
+
+def measure_memory_per_transaction(config: dict) -> float:
+    """Bytes of traced memory the generated state takes per transaction"""
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+
+    before = tracemalloc.get_traced_memory()[0]
+    users, groups = benchmark.generate_dataset(
+        *config["scale"], heavy_transactions=config["heavy_transactions"]
+    )
+    used = tracemalloc.get_traced_memory()[0] - before
+    transactions = sum(len(group.transactions) for group in groups.values())
+
+    if not was_tracing:
+        tracemalloc.stop()
+
+    del users, groups
+    return used / transactions
+
+
+def measure_startup(config: dict) -> float:
+    """Median time load_data needs for a snapshot of the dataset"""
+    users, groups = benchmark.generate_dataset(
+        *config["scale"], heavy_transactions=config["heavy_transactions"]
+    )
+    old_cwd = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            with open(bwise.USERS_FILE, "w") as f:
+                json.dump(list(users), f)
+            with open(bwise.GROUPS_FILE, "w") as f:
+                json.dump([group.to_dict() for group in groups.values()], f)
+
+            timing = benchmark.measure(
+                lambda: bwise.load_data(dict(), dict()), config["repeat"]
+            )
+        finally:
+            os.chdir(old_cwd)
+
+    return timing["median"]
+
+
+def run_trial(config: dict) -> dict[str, float]:
+    result = benchmark.run_scale(
+        *config["scale"],
+        repeat=config["repeat"],
+        heavy_transactions=config["heavy_transactions"],
+    )
+
+    metrics = {
+        f"route {route}": timing["median"]
+        for route, timing in result["routes"].items()
+    }
+    metrics["snapshot_write"] = result["functions"]["save_data + write"][
+        "median"
+    ]
+    metrics["startup"] = measure_startup(config)
+    metrics["memory_per_transaction"] = measure_memory_per_transaction(config)
+    metrics["calibration"] = measure_calibration(config["repeat"])
+    return metrics
+
+
+def collect_metrics(config: dict) -> dict[str, float]:
+    """Median of every metric over config["trials"] trials"""
+    trials = [run_trial(config) for _ in range(config["trials"])]
+    return {
+        name: statistics.median(trial[name] for trial in trials)
+        for name in trials[0]
+    }
+
+
+def tolerance_for(name: str, baseline_metric: dict) -> float:
+    if "tolerance" in baseline_metric:
+        return baseline_metric["tolerance"]
+    return DEFAULT_TOLERANCES[name.split(" ")[0]]
+
+
+def compare(baseline: dict, metrics: dict[str, float]) -> list[dict]:
+    """
+    Returns one entry per metric of the baseline, durations scaled to
+    the speed of the machine the baseline was recorded on.
+    A metric regressed when it grew by more than its tolerance
+    """
+    speed = 1.0
+    if "calibration" in baseline and "calibration" in metrics:
+        speed = baseline["calibration"] / metrics["calibration"]
+
+    comparison = []
+    for name, baseline_metric in baseline["metrics"].items():
+        if name not in metrics:
+            continue
+
+        current = metrics[name]
+        if name.split(" ")[0] in TIMING_METRICS:
+            current *= speed
+        tolerance = tolerance_for(name, baseline_metric)
+        limit = baseline_metric["value"] * (1 + tolerance)
+        comparison.append(
+            {
+                "metric": name,
+                "baseline": baseline_metric["value"],
+                "current": current,
+                "limit": limit,
+                "regressed": current > limit,
+            }
+        )
+
+    return comparison
+
+
+def load_baseline(path: str = BASELINE_FILE) -> dict:
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def update_baseline(baseline: dict, metrics: dict[str, float], path: str):
+    """Stores the new values, keeping the tolerances of known metrics"""
+    metrics = dict(metrics)
+    baseline["calibration"] = metrics.pop("calibration")
+    baseline["metrics"] = {
+        name: {
+            "value": value,
+            "tolerance": tolerance_for(
+                name, baseline["metrics"].get(name, dict())
+            ),
+        }
+        for name, value in metrics.items()
+    }
+    baseline["recorded"] = time.time()
+
+    with open(path, "w") as f:
+        json.dump(baseline, f, indent=2)
+        f.write("\n")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        help="write the measured values into the baseline file",
+    )
+    parser.add_argument("--trials", type=int, help="override the trials")
+    args = parser.parse_args()
+
+    baseline = load_baseline(args.baseline)
+    if args.trials:
+        baseline["config"]["trials"] = args.trials
+
+    metrics = collect_metrics(baseline["config"])
+
+    if args.update:
+        update_baseline(baseline, metrics, args.baseline)
+        print(f"Baseline written to {args.baseline}")
+        return
+
+    comparison = compare(baseline, metrics)
+    for entry in comparison:
+        status = "REGRESSED" if entry["regressed"] else "ok"
+        print(
+            f"{status:9} {entry['metric']:32} "
+            f"baseline {entry['baseline']:.6g} "
+            f"current {entry['current']:.6g} "
+            f"limit {entry['limit']:.6g}"
+        )
+
+    if any(entry["regressed"] for entry in comparison):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""
+Offline point-in-time recovery of the data of a server from its
+snapshot and journal, without going through the routes.
+
+A point is the seq of an operation, an ISO date and time or @ and a
+unix timestamp. The state at a time is the state after the last
+operation the journal has from before it. The journal is replayed in
+bulk, see app.replay(), from the snapshot if it is not newer than the
+points and from the start of the journal otherwise.
+
+Recovery needs the journal, so the server has to run with
+"journal": true in its config or BWISE_JOURNAL=1, which are off by
+default. Without a journal only the snapshot is there and the data
+can't be recovered at any point.
+
+With one point the state is summed up, or written to --output as
+the snapshot of a new data directory. With two points the differences
+between them are printed as json.
+
+    python recover.py --at 120000 --directory ./data
+    python recover.py --at 2024-05-01T12:00 --output ./restored
+    python recover.py --at @1714557600 --at 2024-05-02 --directory ./data
+"""
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import sys
+import time
+from typing import Iterable, Iterator
+
+import app as bwise
+
+
+def parse_point(text: str) -> tuple[str, float]:
+    """("seq", seq) or ("ts", unix timestamp)"""
+    if text.isdigit():
+        return "seq", int(text)
+    if text.startswith("@"):
+        return "ts", float(text[1:])
+    try:
+        return "ts", datetime.datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        raise ValueError(f"not a seq, time or @timestamp: {text}")
+
+
+def seq_at(timestamps: list[float], filename: str) -> dict[float, int]:
+    """
+    The seq of the last operation of the journal before every timestamp,
+    0 for the ones before its first operation
+    """
+    seqs = dict.fromkeys(timestamps, 0)
+    pending = sorted(timestamps)
+    for entry in bwise.read_journal(filename):
+        while pending and entry["ts"] > pending[0]:
+            pending.pop(0)
+        if not pending:
+            break
+        for timestamp in pending:
+            seqs[timestamp] = entry["seq"]
+    return seqs
+
+
+def recover(points: list[str]) -> list[bwise.State]:
+    """The states at points, from the data in the working directory"""
+    if not os.path.exists(bwise.JOURNAL_FILE):
+        raise ValueError(
+            f"there is no journal ({bwise.JOURNAL_FILE}), the server has to "
+            'run with "journal": true or BWISE_JOURNAL=1 to recover its data'
+        )
+    parsed = [parse_point(point) for point in points]
+    timestamps = [value for kind, value in parsed if kind == "ts"]
+    seqs = dict()
+    if timestamps:
+        seqs = seq_at(timestamps, bwise.JOURNAL_FILE)
+    targets = [
+        int(value) if kind == "seq" else seqs.get(value, 0)
+        for kind, value in parsed
+    ]
+
+    users: dict[str, bwise.User] = dict()
+    groups: dict[str, bwise.Group] = dict()
+    responses: dict[str, dict] = dict()
+    with bwise.gc_paused():
+        seq = bwise.load_snapshot(users, groups, responses)
+        if seq <= min(targets):
+            state = bwise.State(
+                bwise.Snapshot().merge(users),
+                bwise.Snapshot().merge(groups),
+                seq=seq,
+                responses=bwise.Snapshot().merge(responses),
+            )
+        else:
+            # the snapshot is newer, everything comes from the journal
+            state = bwise.State(bwise.Snapshot(), bwise.Snapshot())
+
+        entries: Iterator[dict] = bwise.read_journal(bwise.JOURNAL_FILE)
+        first = next(entries, None)
+        if first is not None:
+            if first["seq"] > state.seq + 1 and max(targets) > state.seq:
+                raise ValueError(
+                    f"the journal starts at seq {first['seq']}, "
+                    f"it can't be replayed onto seq {state.seq}"
+                )
+            entries = itertools.chain([first], entries)
+
+        states: dict[int, bwise.State] = dict()
+        start = time.monotonic()
+        start_seq = state.seq
+        # every state continues where the one before it stopped
+        for target in sorted(set(targets)):
+            state = bwise.replay(state, entries, until=target)
+            states[target] = state
+        replayed = state.seq - start_seq
+        seconds = time.monotonic() - start
+        print(
+            f"replayed {replayed} operations in {seconds:.1f}s, "
+            f"{replayed / max(seconds, 1e-9):.0f} operations/s",
+            file=sys.stderr,
+        )
+    return [states[target] for target in targets]
+
+
+def summary(state: bwise.State) -> dict:
+    return {
+        "seq": state.seq,
+        "users": len(state.users),
+        "groups": len(state.groups),
+        "transactions": sum(
+            len(group.transactions) for group in state.groups.values()
+        ),
+    }
+
+
+def diff_names(old: Iterable[str], new: Iterable[str]) -> dict:
+    old, new = set(old), set(new)
+    return {"added": sorted(new - old), "removed": sorted(old - new)}
+
+
+def diff_group(old: bwise.Group, new: bwise.Group) -> dict | None:
+    """What changed in a group, None if nothing did"""
+    old_transactions = {t.id: t for t in old.transactions}
+    new_transactions = {t.id: t for t in new.transactions}
+    old_balances = bwise.calculate_balances(old)
+    new_balances = bwise.calculate_balances(new)
+    balances = dict()
+    for member in sorted(old_balances.keys() | new_balances.keys()):
+        delta = new_balances.get(member, 0.0) - old_balances.get(member, 0.0)
+        if abs(delta) > 1e-9:
+            balances[member] = round(delta, 2)
+
+    changes = {
+        "members": diff_names(old.members, new.members),
+        "transactions": {
+            "added": [
+                new_transactions[id].to_dict()
+                for id in sorted(new_transactions.keys() - old_transactions)
+            ],
+            "removed": sorted(old_transactions.keys() - new_transactions),
+        },
+        "balances": balances,
+    }
+    if (
+        any(changes["members"].values())
+        or any(changes["transactions"].values())
+        or balances
+    ):
+        return changes
+    return None
+
+
+def diff(old: bwise.State, new: bwise.State) -> dict:
+    """The differences between two states as json"""
+    changed = dict()
+    for name in sorted(old.groups.keys() & new.groups.keys()):
+        # groups nothing changed are shared by the states
+        if old.groups[name] is new.groups[name]:
+            continue
+        changes = diff_group(old.groups[name], new.groups[name])
+        if changes is not None:
+            changed[name] = changes
+    return {
+        "from": old.seq,
+        "to": new.seq,
+        "users": diff_names(old.users, new.users),
+        "groups": {**diff_names(old.groups, new.groups), "changed": changed},
+    }
+
+
+def run(
+    points: list[str], directory: str = ".", output: str | None = None
+) -> dict:
+    """
+    Recovers the data in directory at one or two points and returns
+    the summary or the diff. One state is written to output if it is given
+    """
+    if output is not None:
+        output = os.path.abspath(output)
+    old_cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        states = recover(points)
+    finally:
+        os.chdir(old_cwd)
+
+    if len(states) == 2:
+        return diff(*states)
+    if output is not None:
+        os.makedirs(output, exist_ok=True)
+        os.chdir(output)
+        try:
+            bwise.write_state(states[0])
+        finally:
+            os.chdir(old_cwd)
+    return summary(states[0])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__.split("\n")[1],
+        epilog="Needs the journal of the server, written with "
+        '"journal": true or BWISE_JOURNAL=1',
+    )
+    parser.add_argument(
+        "--at",
+        action="append",
+        required=True,
+        help="seq, ISO time or @unix timestamp, twice for a diff",
+    )
+    parser.add_argument("--directory", default=".")
+    parser.add_argument("--output", help="directory for the recovered data")
+    args = parser.parse_args()
+    if len(args.at) > 2:
+        parser.error("--at can be given once or twice")
+    if args.output is not None and len(args.at) != 1:
+        parser.error("--output needs exactly one --at")
+
+    try:
+        report = run(args.at, args.directory, args.output)
+    except ValueError as e:
+        parser.error(str(e))
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ import pytest
 from app import app
 import json
 import os
+import queue
 
 
 @pytest.fixture
@@ -192,13 +193,20 @@ def test_load_invalid_data(noisy_files):
     assert len(test_group_dict) == 0
 
 
-def test_all_have_message(client):
+def test_all_have_message(client, monkeypatch):
     """Verifies that the every endpoint return json with the key 'message'"""
+    from app import CONFIG
+
+    # /wait_for_changes would wait for the whole timeout
+    monkeypatch.setitem(CONFIG, "long_poll_timeout", 0.1)
     missing_message = []
 
     for rule in app.url_map.iter_rules():
         if "<" in rule.rule:
             continue
+        # a server-sent events stream, not json, and it never ends
+        if rule.rule == "/events":
+            continue
         response = client.post(
             rule.rule,
             json={"username": "messenger"},
@@ -1222,3 +1230,2256 @@ def test_settle_up_intertwined_transactions(client):
     user3_initial = next(d for d in initial_debts if d["username"] == "user3")
     user3_final = next(d for d in final_debts if d["username"] == "user3")
     assert user3_initial["amount"] == user3_final["amount"]
+
+
+def test_memory_stats(client):
+    for user in ["adminuser", "member1"]:
+        client.post(
+            "/login", json={"username": user}, content_type="application/json"
+        )
+    client.post(
+        "/create_group",
+        json={"username": "adminuser", "group_name": "memory_group"},
+        content_type="application/json",
+    )
+    client.post(
+        "/join_group",
+        json={"username": "member1", "group_name": "memory_group"},
+        content_type="application/json",
+    )
+    client.post(
+        "/add_expense",
+        json={
+            "username": "adminuser",
+            "group_name": "memory_group",
+            "amount": 10,
+        },
+        content_type="application/json",
+    )
+
+    response = client.post(
+        "/memory_stats",
+        json={"username": "adminuser"},
+        content_type="application/json",
+    )
+    assert response.status_code == 200
+    stats = json.loads(response.data)["stats"]
+    assert stats["users"]["count"] == 2
+    assert stats["groups"]["count"] == 1
+    assert stats["members"]["count"] == 2
+    assert stats["transactions"]["count"] == 1
+    for structure in stats.values():
+        assert structure["bytes"] > 0
+
+    # only admins can look at the memory stats
+    response = client.post(
+        "/memory_stats",
+        json={"username": "member1"},
+        content_type="application/json",
+    )
+    assert response.status_code == 403
+
+
+def test_memory_stats_tracemalloc(client):
+    client.post(
+        "/login",
+        json={"username": "adminuser"},
+        content_type="application/json",
+    )
+
+    # diffing needs a baseline snapshot
+    response = client.post(
+        "/memory_stats",
+        json={"username": "adminuser", "action": "diff"},
+        content_type="application/json",
+    )
+    assert response.status_code == 409
+
+    response = client.post(
+        "/memory_stats",
+        json={"username": "adminuser", "action": "snapshot"},
+        content_type="application/json",
+    )
+    assert response.status_code == 200
+    assert json.loads(response.data)["tracing"]
+
+    response = client.post(
+        "/memory_stats",
+        json={"username": "adminuser", "action": "diff", "limit": 5},
+        content_type="application/json",
+    )
+    assert response.status_code == 200
+    assert len(json.loads(response.data)["diff"]) <= 5
+
+    response = client.post(
+        "/memory_stats",
+        json={"username": "adminuser", "action": "stop"},
+        content_type="application/json",
+    )
+    assert not json.loads(response.data)["tracing"]
+
+
+def test_benchmark_smoke(client):
+    """The benchmark suite runs end to end on a tiny dataset"""
+    from benchmark import run_scale
+
+    result = run_scale(50, 5, repeat=2, heavy_transactions=50)
+
+    assert result["transactions"] > 0
+    assert "/add_expense" in result["routes"]
+    assert "load_data" in result["functions"]
+    for timing in [*result["routes"].values(), *result["functions"].values()]:
+        assert timing["runs"] == 2
+        assert 0 <= timing["min"] <= timing["max"]
+
+
+@pytest.mark.parametrize("server_mode", ["waitress", "async"])
+def test_loadtest_persists_live_state(server_mode):
+    """
+    Runs a short load test against a real server
+    and checks that the json persisted on shutdown matches its state
+    """
+    from loadtest import run
+
+    report = run(
+        users=20,
+        groups=4,
+        members=4,
+        concurrency=4,
+        duration=0.5,
+        rate=None,
+        seed=56,
+        server_mode=server_mode,
+        idle_connections=10,
+    )
+
+    assert report["requests"] > 0
+    assert report["errors"] == 0
+    assert report["idle_connections"]["still_open"] == 10
+    assert report["shutdown_exit_code"] == 0
+    assert report["persistence_problems"] == []
+
+
+@pytest.mark.report_duration
+@pytest.mark.skipif(
+    not os.environ.get("BWISE_PERF_GATE"),
+    reason="timings vary between machines, set BWISE_PERF_GATE=1 to run",
+)
+def test_perf_gate():
+    """Fails when a benchmark regressed beyond its tolerance in the baseline"""
+    from perf_gate import collect_metrics, compare, load_baseline
+
+    baseline = load_baseline()
+    comparison = compare(baseline, collect_metrics(baseline["config"]))
+
+    regressions = [entry for entry in comparison if entry["regressed"]]
+    assert not regressions, "Performance regressions:\n" + "\n".join(
+        f"{entry['metric']}: {entry['current']:.6g} "
+        f"(baseline {entry['baseline']:.6g}, limit {entry['limit']:.6g})"
+        for entry in regressions
+    )
+
+
+def test_perf_gate_scales_durations():
+    """A machine half as fast doesn't count as a regression"""
+    from perf_gate import compare
+
+    baseline = {
+        "calibration": 0.01,
+        "metrics": {
+            "route /login": {"value": 0.001, "tolerance": 1.0},
+            "memory_per_transaction": {"value": 100, "tolerance": 0.1},
+        },
+    }
+    comparison = compare(
+        baseline,
+        {
+            "route /login": 0.003,
+            "memory_per_transaction": 120,
+            "calibration": 0.02,
+        },
+    )
+    assert [
+        (entry["current"], entry["regressed"]) for entry in comparison
+    ] == [(0.0015, False), (120, True)]
+
+
+def test_concurrent_writes_to_one_group(client):
+    """
+    Many threads add expenses to and settle up in the same group,
+    while other threads create groups and read.
+    No update may be lost and the balances must stay consistent
+    """
+    import sys
+    import threading
+
+    members = [f"member{i}" for i in range(6)]
+    for member in members:
+        client.post(
+            "/login",
+            json={"username": member},
+            content_type="application/json",
+        )
+    client.post(
+        "/create_group",
+        json={"username": members[0], "group_name": "busy_group"},
+        content_type="application/json",
+    )
+    for member in members[1:]:
+        client.post(
+            "/join_group",
+            json={"username": member, "group_name": "busy_group"},
+            content_type="application/json",
+        )
+
+    expenses_per_thread = 30
+    settled = []
+    errors = []
+
+    def add_expenses(payer: str) -> None:
+        thread_client = app.test_client()
+        for _ in range(expenses_per_thread):
+            response = thread_client.post(
+                "/add_expense",
+                json={
+                    "username": payer,
+                    "group_name": "busy_group",
+                    "amount": 60,
+                },
+                content_type="application/json",
+            )
+            if response.status_code != 201:
+                errors.append(response.status_code)
+
+    def settle_up(username: str, to_user: str) -> None:
+        thread_client = app.test_client()
+        for _ in range(expenses_per_thread):
+            response = thread_client.post(
+                "/settle_up",
+                json={
+                    "username": username,
+                    "to_user": to_user,
+                    "group_name": "busy_group",
+                },
+                content_type="application/json",
+            )
+            settled.append(json.loads(response.data)["transactions_settled"])
+
+    def create_groups(creator: str) -> None:
+        thread_client = app.test_client()
+        for i in range(expenses_per_thread):
+            thread_client.post(
+                "/create_group",
+                json={"username": creator, "group_name": f"{creator}{i}"},
+                content_type="application/json",
+            )
+            thread_client.post(
+                "/get_user_groups",
+                json={"username": creator},
+                content_type="application/json",
+            )
+
+    threads = [
+        threading.Thread(target=add_expenses, args=(member,))
+        for member in members
+    ]
+    threads.append(
+        threading.Thread(target=settle_up, args=(members[0], members[1]))
+    )
+    threads.append(threading.Thread(target=create_groups, args=(members[2],)))
+
+    # switch threads as often as possible to provoke races
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+
+    assert not errors
+
+    from app import GROUPS, calculate_relative_debt
+
+    group = GROUPS["busy_group"]
+    added = len(members) * expenses_per_thread * (len(members) - 1)
+    assert len(group.transactions) == added - sum(settled)
+
+    # every debt is seen from both sides and all balances add up to zero
+    total = 0.0
+    for member in members:
+        debts = calculate_relative_debt(group, member)
+        for other, amount in debts.items():
+            assert calculate_relative_debt(group, other)[
+                member
+            ] == pytest.approx(-amount)
+        total += sum(debts.values())
+    assert total == pytest.approx(0)
+
+
+def test_state_snapshot_is_immutable(client):
+    """A State taken before a change still shows the state from before"""
+    import app as bwise
+
+    for user in ["payer", "member"]:
+        client.post(
+            "/login",
+            json={"username": user},
+            content_type="application/json",
+        )
+    client.post(
+        "/create_group",
+        json={"username": "payer", "group_name": "snapshot_group"},
+        content_type="application/json",
+    )
+    before_join = bwise.STATE
+
+    client.post(
+        "/join_group",
+        json={"username": "member", "group_name": "snapshot_group"},
+        content_type="application/json",
+    )
+    client.post(
+        "/add_expense",
+        json={
+            "username": "payer",
+            "group_name": "snapshot_group",
+            "amount": 4,
+        },
+        content_type="application/json",
+    )
+    client.post(
+        "/delete_group",
+        json={"username": "payer", "group_name": "snapshot_group"},
+        content_type="application/json",
+    )
+
+    old_group = before_join.groups["snapshot_group"]
+    assert old_group.members == ("payer",)
+    assert old_group.transactions == ()
+    assert "snapshot_group" not in bwise.GROUPS
+    assert bwise.STATE.version > before_join.version
+
+
+def test_snapshot_shares_unchanged_buckets():
+    from app import SNAPSHOT_BUCKETS, Snapshot
+
+    snapshot = Snapshot().merge({f"key{i}": i for i in range(1000)})
+    changed = snapshot.merge({"key1": -1}).remove("key2")
+
+    assert len(snapshot) == 1000
+    assert len(changed) == 999
+    assert snapshot["key1"] == 1 and changed["key1"] == -1
+    assert "key2" in snapshot and "key2" not in changed
+
+    # only the buckets of key1 and key2 were copied
+    shared = sum(
+        old is new for old, new in zip(snapshot._buckets, changed._buckets)
+    )
+    assert shared >= SNAPSHOT_BUCKETS - 2
+
+
+def test_load_config(tmp_path):
+    from app import DEFAULT_CONFIG, load_config
+
+    config_file = tmp_path / "config.json"
+    config_file.write_text('{"threads": 16, "backlog": 64, "log": false}')
+
+    config = load_config(
+        str(config_file),
+        {"BWISE_THREADS": "auto", "BWISE_CONNECTION_LIMIT": "1000"},
+    )
+
+    # the environment wins over the file, the file over the defaults
+    assert config["threads"] == "auto"
+    assert config["connection_limit"] == 1000
+    assert config["backlog"] == 64
+    assert config["log"] is False
+    assert config["channel_timeout"] == DEFAULT_CONFIG["channel_timeout"]
+
+    # no file is fine, defaults are used
+    assert load_config(str(tmp_path / "missing.json"), {}) == DEFAULT_CONFIG
+
+    config_file.write_text('{"thread": 16}')
+    with pytest.raises(ValueError):
+        load_config(str(config_file), {})
+
+    with pytest.raises(ValueError):
+        load_config(str(tmp_path / "missing.json"), {"BWISE_BACKLOG": "x"})
+
+    with pytest.raises(ValueError):
+        load_config(
+            str(tmp_path / "missing.json"), {"BWISE_IDEMPOTENCY_KEYS": "0"}
+        )
+    with pytest.raises(ValueError, match="snapshot_format binary"):
+        load_config(
+            str(tmp_path / "missing.json"),
+            {"BWISE_RESIDENT_TRANSACTIONS": "1000"},
+        )
+    config = load_config(
+        str(tmp_path / "missing.json"),
+        {
+            "BWISE_RESIDENT_TRANSACTIONS": "1000",
+            "BWISE_SNAPSHOT_FORMAT": "binary",
+        },
+    )
+    assert config["resident_transactions"] == 1000
+
+
+def test_waitress_autotune_reported_in_metrics(client, monkeypatch):
+    import app as bwise
+
+    monkeypatch.setitem(bwise.CONFIG, "threads", "auto")
+    monkeypatch.setitem(bwise.CONFIG, "connection_limit", 500)
+    settings = bwise.waitress_settings()
+
+    assert 2 <= settings["threads"] <= 64
+    assert settings["connection_limit"] == 500
+
+    client.post(
+        "/login",
+        json={"username": "adminuser"},
+        content_type="application/json",
+    )
+    response = client.post(
+        "/metrics",
+        json={"username": "adminuser"},
+        content_type="application/json",
+    )
+    assert response.status_code == 200
+    metrics = json.loads(response.data)["metrics"]
+    assert metrics["server"]["threads"] == settings["threads"]
+    assert metrics["server"]["connection_limit"] == 500
+    assert metrics["autotune"]["cpus"] >= 1
+    assert metrics["autotune"]["handler_latency"] > 0
+
+
+def test_journal_replays_routes(client, tmp_path, monkeypatch):
+    """The last snapshot plus the journal reproduce the live state"""
+    import app as bwise
+
+    monkeypatch.chdir(tmp_path)
+    journal = bwise.Journal(bwise.JOURNAL_FILE)
+    monkeypatch.setattr(bwise, "JOURNAL", journal)
+
+    def post(route: str, payload: dict) -> None:
+        client.post(route, json=payload, content_type="application/json")
+
+    for user in ["user1", "user2", "user3"]:
+        post("/login", {"username": user})
+    for group_name in ["journal_group", "deleted_group"]:
+        post("/create_group", {"username": "user1", "group_name": group_name})
+    for user in ["user2", "user3"]:
+        post("/join_group", {"username": user, "group_name": "journal_group"})
+    post(
+        "/add_expense",
+        {"username": "user1", "group_name": "journal_group", "amount": 30},
+    )
+
+    # everything up to here is in the snapshot, the rest only in the journal
+    bwise.write_state(bwise.STATE)
+
+    post(
+        "/add_expense",
+        {"username": "user2", "group_name": "journal_group", "amount": 9},
+    )
+    post(
+        "/settle_up",
+        {
+            "username": "user1",
+            "to_user": "user3",
+            "group_name": "journal_group",
+        },
+    )
+    post(
+        "/kick_user",
+        {
+            "username": "user1",
+            "target_username": "user2",
+            "group_name": "journal_group",
+        },
+    )
+    post("/delete_group", {"username": "user1", "group_name": "deleted_group"})
+
+    # a line cut off by a crash is ignored
+    with open(bwise.JOURNAL_FILE, "a") as f:
+        f.write('{"seq": ')
+
+    users: dict = dict()
+    groups: dict = dict()
+    assert bwise.load_data(users, groups) == bwise.STATE.seq
+
+    assert sorted(users) == sorted(bwise.USERS)
+    assert sorted(groups) == ["journal_group"]
+    live = bwise.GROUPS["journal_group"]
+    assert groups["journal_group"].members == live.members
+    assert [t.to_dict() for t in groups["journal_group"].transactions] == [
+        t.to_dict() for t in live.transactions
+    ]
+
+    # opening the journal again drops the cut off line
+    os.close(journal.fd)
+    journal = bwise.Journal(bwise.JOURNAL_FILE)
+    with open(bwise.JOURNAL_FILE, "rb") as f:
+        assert f.read().endswith(b"\n")
+    os.close(journal.fd)
+
+
+def test_loadtest_with_workers():
+    """Worker processes sharing the journal stay consistent"""
+    from loadtest import run
+
+    report = run(
+        users=20,
+        groups=4,
+        members=4,
+        concurrency=4,
+        duration=0.5,
+        rate=None,
+        seed=56,
+        workers=2,
+    )
+
+    assert report["requests"] > 0
+    assert report["errors"] == 0
+    assert report["shutdown_exit_code"] == 0
+    assert report["persistence_problems"] == []
+
+
+def test_cluster_routes_and_rebalances(tmp_path):
+    """
+    Groups are spread over the shards, users see the groups of all shards
+    and adding a shard only moves the groups that belong to it now
+    """
+    import cluster
+    from loadtest import free_port
+
+    shards, processes = cluster.start_local_shards(
+        str(tmp_path), [free_port() for _ in range(3)]
+    )
+    try:
+        router = cluster.Router({name: shards[name] for name in ["shard0"]})
+        router.set_shards(
+            {name: shards[name] for name in ["shard0", "shard1"]}
+        )
+        front = cluster.create_app(router).test_client()
+
+        def post(route: str, payload: dict):
+            response = front.post(route, json=payload)
+            return response.status_code, json.loads(response.data)
+
+        assert post("/login", {"username": "owner"})[0] == 201
+        assert post("/login", {"username": "friend"})[0] == 201
+        group_names = [f"cluster_group{i}" for i in range(12)]
+        for group_name in group_names:
+            payload = {"username": "owner", "group_name": group_name}
+            assert post("/create_group", payload)[0] == 201
+            payload["username"] = "friend"
+            assert post("/join_group", payload)[0] == 200
+            payload["amount"] = 10
+            assert post("/add_expense", payload)[0] == 201
+
+        def placement() -> dict[str, str]:
+            status, answers = post("/export_groups", {"username": "admin_x"})
+            return {
+                group["name"]: shard
+                for shard, answer in answers["shards"].items()
+                for group in answer["body"].get("groups", [])
+            }
+
+        assert post("/login", {"username": "admin_x"})[0] == 201
+        before = placement()
+        assert set(before.values()) == {"shard0", "shard1"}
+        assert all(
+            router.ring.shard_for(name) == shard
+            for name, shard in before.items()
+        )
+
+        status, body = post("/get_user_groups", {"username": "friend"})
+        assert status == 200
+        assert [group["name"] for group in body["groups"]] == sorted(
+            group_names
+        )
+
+        status, body = post(
+            "/cluster/shards", {"username": "admin_x", "shards": shards}
+        )
+        assert status == 200
+        after = placement()
+        moved = {name for name in group_names if before[name] != after[name]}
+        assert sum(body["moved"].values()) == len(moved)
+        assert all(after[name] == "shard2" for name in moved)
+        assert set(after) == set(group_names)
+
+        # the moved groups kept their transactions and users
+        for group_name in group_names:
+            status, body = post(
+                "/get_debts", {"username": "friend", "group_name": group_name}
+            )
+            assert status == 200
+            assert body["debts"][0]["amount"] == 5
+        status, body = post("/get_user_groups", {"username": "owner"})
+        assert len(body["groups"]) == len(group_names)
+
+        # a batch runs on the shard of its group, its logins on all shards
+        group_name = group_names[0]
+        status, body = post(
+            "/batch",
+            {
+                "operations": [
+                    {"op": "login", "args": {"username": "newcomer"}},
+                    {
+                        "op": "join_group",
+                        "args": {
+                            "username": "newcomer",
+                            "group_name": group_name,
+                        },
+                    },
+                ]
+            },
+        )
+        assert status == 200
+        assert [result["status"] for result in body["results"]] == [200, 200]
+        status, body = post("/get_user_groups", {"username": "newcomer"})
+        assert [group["name"] for group in body["groups"]] == [group_name]
+
+        other_group = next(
+            name for name in group_names if after[name] != after[group_name]
+        )
+        status, _ = post(
+            "/batch",
+            {
+                "operations": [
+                    {
+                        "op": "add_expense",
+                        "args": {
+                            "username": "owner",
+                            "group_name": name,
+                            "amount": 1,
+                        },
+                    }
+                    for name in [group_name, other_group]
+                ]
+            },
+        )
+        assert status == 400
+        for operations in [[], {"op": "login"}]:
+            assert post("/batch", {"operations": operations})[0] == 400
+
+        # a broadcast import would put every group on every shard
+        response = front.post("/import?username=admin_x", data=b"")
+        assert response.status_code == 400
+        status, body = post(
+            "/wait_for_changes", {"username": "owner", "timeout": 30}
+        )
+        assert status == 400
+        assert post("/events", {"username": "owner"})[0] == 400
+    finally:
+        cluster.stop_local_shards(processes)
+
+
+def test_get_group_balances(client):
+    for user in ["payer", "member1", "member2", "outsider"]:
+        client.post(
+            "/login",
+            json={"username": user},
+            content_type="application/json",
+        )
+    client.post(
+        "/create_group",
+        json={"username": "payer", "group_name": "balance_group"},
+        content_type="application/json",
+    )
+    for user in ["member1", "member2"]:
+        client.post(
+            "/join_group",
+            json={"username": user, "group_name": "balance_group"},
+            content_type="application/json",
+        )
+    client.post(
+        "/add_expense",
+        json={
+            "username": "payer",
+            "group_name": "balance_group",
+            "amount": 90,
+        },
+        content_type="application/json",
+    )
+    client.post(
+        "/add_expense",
+        json={
+            "username": "member1",
+            "group_name": "balance_group",
+            "amount": 30,
+        },
+        content_type="application/json",
+    )
+
+    response = client.post(
+        "/get_group_balances",
+        json={"username": "member2", "group_name": "balance_group"},
+        content_type="application/json",
+    )
+    assert response.status_code == 200
+    balances = {
+        entry["username"]: entry["balance"]
+        for entry in json.loads(response.data)["balances"]
+    }
+    assert balances == {"payer": 50.0, "member1": -10.0, "member2": -40.0}
+
+    response = client.post(
+        "/get_group_balances",
+        json={"username": "outsider", "group_name": "balance_group"},
+        content_type="application/json",
+    )
+    assert response.status_code == 403
+
+
+def test_replica_follows_primary_journal(tmp_path):
+    import time
+
+    import app as bwise
+    from loadtest import Client, Server, free_port
+
+    primary_directory = tmp_path / "primary"
+    replica_directory = tmp_path / "replica"
+    primary_directory.mkdir()
+    replica_directory.mkdir()
+    # data the journal doesn't have, like after a bulk import
+    bwise.write_binary_snapshot(
+        bwise.State(
+            bwise.Snapshot().merge({"archived": bwise.User("archived")}),
+            bwise.Snapshot().merge(
+                {"archive": bwise.Group("archive", "archived")}
+            ),
+        ),
+        str(primary_directory / bwise.SNAPSHOT_FILE),
+    )
+
+    primary = Server(
+        str(primary_directory),
+        free_port(),
+        {"BWISE_JOURNAL": "1", "BWISE_SNAPSHOT_FORMAT": "binary"},
+    )
+    replica = None
+    try:
+        primary.wait_until_ready()
+        writer = Client(primary.port)
+        for user in ["adminuser", "payer", "member"]:
+            writer.post("/login", {"username": user})
+        writer.post(
+            "/create_group", {"username": "payer", "group_name": "replicated"}
+        )
+
+        replica = Server(
+            str(replica_directory),
+            free_port(),
+            {"BWISE_REPLICA_OF": str(primary_directory)},
+        )
+        replica.wait_until_ready()
+        reader = Client(replica.port)
+
+        # changes made after the replica started reach it too
+        writer.post(
+            "/join_group", {"username": "member", "group_name": "replicated"}
+        )
+        writer.post(
+            "/add_expense",
+            {"username": "payer", "group_name": "replicated", "amount": 8},
+        )
+
+        deadline = time.monotonic() + 5
+        while True:
+            status, body = reader.post(
+                "/get_debts",
+                {"username": "member", "group_name": "replicated"},
+            )
+            if status == 200 and body["debts"][0]["amount"] == 4:
+                break
+            assert time.monotonic() < deadline, body
+            time.sleep(0.05)
+
+        status, body = reader.post("/get_user_groups", {"username": "member"})
+        assert [group["name"] for group in body["groups"]] == ["replicated"]
+        status, body = reader.post(
+            "/get_user_groups", {"username": "archived"}
+        )
+        assert [group["name"] for group in body["groups"]] == ["archive"]
+        status, _ = reader.post(
+            "/get_group_balances",
+            {"username": "payer", "group_name": "replicated"},
+        )
+        assert status == 200
+
+        status, _ = reader.post(
+            "/add_expense",
+            {"username": "payer", "group_name": "replicated", "amount": 8},
+        )
+        assert status == 403
+
+        time.sleep(0.2)
+        status, body = reader.post("/metrics", {"username": "adminuser"})
+        assert status == 200
+        assert body["metrics"]["replica"]["applied"] >= 2
+        assert body["metrics"]["replica"]["behind_bytes"] == 0
+    finally:
+        if replica is not None:
+            replica.stop()
+        primary.stop()
+
+
+@pytest.mark.parametrize("journal", ["0", "1"])
+def test_server_restart_keeps_state(tmp_path, journal):
+    from loadtest import Client, Server, free_port
+
+    env = {"BWISE_JOURNAL": journal, "BWISE_LOG": "0"}
+    server = Server(str(tmp_path), free_port(), env)
+    try:
+        server.wait_until_ready()
+        client = Client(server.port)
+        client.post("/login", {"username": "payer"})
+        client.post(
+            "/create_group", {"username": "payer", "group_name": "kept"}
+        )
+    finally:
+        assert server.stop() == 0
+
+    server = Server(str(tmp_path), free_port(), env)
+    try:
+        server.wait_until_ready()
+        status, body = Client(server.port).post(
+            "/get_user_groups", {"username": "payer"}
+        )
+    finally:
+        server.stop()
+
+    assert status == 200
+    assert [group["name"] for group in body["groups"]] == ["kept"]
+
+
+def test_wait_for_changes(client):
+    import threading
+    import time
+
+    for user in ["payer", "member"]:
+        client.post(
+            "/login",
+            json={"username": user},
+            content_type="application/json",
+        )
+    response = client.post(
+        "/create_group",
+        json={"username": "payer", "group_name": "polled_group"},
+        content_type="application/json",
+    )
+    version = json.loads(response.data)["group"]["version"]
+    client.post(
+        "/join_group",
+        json={"username": "member", "group_name": "polled_group"},
+        content_type="application/json",
+    )
+
+    def wait(versions: dict, timeout: float) -> dict:
+        response = app.test_client().post(
+            "/wait_for_changes",
+            json={"username": "payer", "groups": versions, "timeout": timeout},
+            content_type="application/json",
+        )
+        assert response.status_code == 200
+        return json.loads(response.data)
+
+    # the join already changed the group, so the answer is immediate
+    result = wait({"polled_group": version}, 5)
+    assert result["changed"] == ["polled_group"]
+    version = result["versions"]["polled_group"]
+
+    assert wait({"polled_group": version}, 0.1)["changed"] == []
+
+    results = []
+    waiter = threading.Thread(
+        target=lambda: results.append(wait({"polled_group": version}, 10))
+    )
+    start = time.monotonic()
+    waiter.start()
+    time.sleep(0.1)
+    client.post(
+        "/add_expense",
+        json={"username": "member", "group_name": "polled_group", "amount": 2},
+        content_type="application/json",
+    )
+    waiter.join()
+
+    assert time.monotonic() - start < 5
+    assert results[0]["changed"] == ["polled_group"]
+    assert results[0]["versions"]["polled_group"] > version
+
+
+def test_wait_for_changes_async_server_holds_no_threads(tmp_path):
+    """Many waiters on the async server cost no threads"""
+    import socket
+
+    from loadtest import Client, Server, free_port
+
+    server = Server(
+        str(tmp_path), free_port(), {"BWISE_SERVER": "async", "BWISE_LOG": "0"}
+    )
+    waiters: list[socket.socket] = []
+    try:
+        server.wait_until_ready()
+        client = Client(server.port)
+        client.post("/login", {"username": "payer"})
+        status, body = client.post(
+            "/create_group", {"username": "payer", "group_name": "watched"}
+        )
+        version = body["group"]["version"]
+
+        request = json.dumps(
+            {"username": "payer", "groups": {"watched": version}}
+        ).encode()
+        for _ in range(100):
+            waiter = socket.create_connection(("127.0.0.1", server.port), 10)
+            waiter.sendall(
+                b"POST /wait_for_changes HTTP/1.1\r\nHost: test\r\n"
+                b"Connection: close\r\n"
+                b"Content-Type: application/json\r\n"
+                b"Content-Length: %d\r\n\r\n%s" % (len(request), request)
+            )
+            waiters.append(waiter)
+
+        with open(f"/proc/{server.process.pid}/status") as f:
+            status_lines = dict(line.split(":", 1) for line in f)
+        threads = int(status_lines["Threads"])
+        assert threads < 10
+
+        client.post(
+            "/add_expense",
+            {"username": "payer", "group_name": "watched", "amount": 1},
+        )
+        for waiter in waiters:
+            response = b""
+            while chunk := waiter.recv(65536):
+                response += chunk
+            assert response.startswith(b"HTTP/1.1 200")
+            assert b'"changed": ["watched"]' in response
+    finally:
+        for waiter in waiters:
+            waiter.close()
+        server.stop()
+
+
+def test_asgi_runs_wsgi_routes_off_the_loop():
+    """A WSGI route that blocks leaves the event loop to other requests"""
+    import asyncio
+    import threading
+
+    from aioserver import asgi
+
+    release = threading.Event()
+
+    def wsgi_app(environ: dict, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        # blocks, like a route waiting for a lock, until /fast answered
+        yield b"slow" if release.wait(5) else b"timed out"
+
+    async def fast(body: bytes):
+        release.set()
+        return 200, "text/plain", b"fast"
+
+    async def request(path: str) -> bytes:
+        scope = {
+            "type": "http",
+            "method": "POST",
+            "path": path,
+            "query_string": b"",
+            "http_version": "1.1",
+            "headers": [],
+        }
+        messages = [{"type": "http.request", "body": b""}]
+        sent: list[dict] = []
+
+        async def receive():
+            return messages.pop()
+
+        async def send(message: dict):
+            sent.append(message)
+
+        await asgi(wsgi_app, {"/fast": fast})(scope, receive, send)
+        return b"".join(message.get("body", b"") for message in sent)
+
+    async def main():
+        slow = asyncio.create_task(request("/slow"))
+        await asyncio.sleep(0.1)
+        # the loop still runs while /slow blocks its thread
+        assert await asyncio.wait_for(request("/fast"), 2) == b"fast"
+        assert await asyncio.wait_for(slow, 2) == b"slow"
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("route", ["/wait_for_changes", "/events"])
+def test_waiters_leave_waitress_threads_for_other_routes(tmp_path, route):
+    """Waiters past waiting_threads are refused instead of waiting"""
+    import socket
+    import time
+
+    from loadtest import Client, Server, free_port
+
+    server = Server(str(tmp_path), free_port(), {"BWISE_LOG": "0"})
+    waiters: list[socket.socket] = []
+    try:
+        server.wait_until_ready()
+        client = Client(server.port, timeout=5)
+        client.post("/login", {"username": "payer"})
+        request = json.dumps({"username": "payer", "timeout": 30}).encode()
+        # as many as waitress has threads
+        for _ in range(4):
+            waiter = socket.create_connection(("127.0.0.1", server.port), 10)
+            waiter.sendall(
+                b"POST %s HTTP/1.1\r\nHost: test\r\n" % route.encode()
+                + b"Connection: close\r\n"
+                b"Content-Type: application/json\r\n"
+                b"Content-Length: %d\r\n\r\n%s" % (len(request), request)
+            )
+            waiters.append(waiter)
+
+        assert client.post("/login", {"username": "adminuser"})[0] == 201
+        deadline = time.monotonic() + 5
+        while True:
+            status, body = client.post("/metrics", {"username": "adminuser"})
+            waiting = body["metrics"]["waiting_threads"]
+            if waiting == {"waiting": 2, "refused": 2}:
+                break
+            assert time.monotonic() < deadline, waiting
+            time.sleep(0.05)
+
+        client.post(
+            "/create_group", {"username": "payer", "group_name": "watched"}
+        )
+        statuses = []
+        for waiter in waiters:
+            # an event stream doesn't end, only its status line is read
+            response = b""
+            while b"\r\n" not in response:
+                response += waiter.recv(65536)
+            statuses.append(response.split(b" ", 2)[1])
+        assert sorted(statuses) == [b"200", b"200", b"503", b"503"]
+    finally:
+        for waiter in waiters:
+            waiter.close()
+        server.stop()
+
+
+def test_events_stream(client, monkeypatch):
+    from app import CONFIG, EVENTS
+
+    for user in ["payer", "member", "stranger"]:
+        client.post(
+            "/login",
+            json={"username": user},
+            content_type="application/json",
+        )
+    client.post(
+        "/create_group",
+        json={"username": "payer", "group_name": "streamed_group"},
+        content_type="application/json",
+    )
+
+    def subscribe(username: str):
+        response = app.test_client().post(
+            "/events",
+            json={"username": username},
+            content_type="application/json",
+            buffered=False,
+        )
+        assert response.status_code == 200
+        assert response.mimetype == "text/event-stream"
+        stream = iter(response.response)
+        assert next(stream) == b": connected\n\n"
+        return response, stream
+
+    payer, payer_stream = subscribe("payer")
+    stranger, _ = subscribe("stranger")
+
+    client.post(
+        "/join_group",
+        json={"username": "member", "group_name": "streamed_group"},
+        content_type="application/json",
+    )
+    client.post(
+        "/add_expense",
+        json={
+            "username": "member",
+            "group_name": "streamed_group",
+            "amount": 4,
+        },
+        content_type="application/json",
+    )
+    client.post(
+        "/kick_user",
+        json={
+            "username": "payer",
+            "group_name": "streamed_group",
+            "target_username": "member",
+        },
+        content_type="application/json",
+    )
+
+    events = []
+    for _ in range(3):
+        frame = next(payer_stream).decode()
+        fields = dict(
+            line.split(": ", 1) for line in frame.strip().split("\n")
+        )
+        data = json.loads(fields["data"])
+        assert data["group_name"] == "streamed_group"
+        assert fields["id"] == str(data["seq"])
+        events.append(fields["event"])
+    assert events == ["join_group", "add_expense", "kick_user"]
+
+    # the stranger is not a member, nothing was queued for them
+    (stranger_subscriber,) = EVENTS.subscribers["stranger"]
+    assert not stranger_subscriber.frames
+
+    # a subscriber that does not keep up is dropped, not buffered forever
+    monkeypatch.setitem(CONFIG, "event_buffer", 2)
+    for amount in range(4):
+        client.post(
+            "/add_expense",
+            json={
+                "username": "payer",
+                "group_name": "streamed_group",
+                "amount": amount + 1,
+            },
+            content_type="application/json",
+        )
+    assert [next(payer_stream) for _ in range(3)][-1].startswith(
+        b"event: dropped"
+    )
+    assert next(payer_stream, None) is None
+    assert "payer" not in EVENTS.subscribers
+    assert EVENTS.stats["dropped"] >= 1
+
+    payer.close()
+    stranger.close()
+    assert "stranger" not in EVENTS.subscribers
+    assert EVENTS.stats["subscribers"] == 0
+
+
+def test_events_async_server_holds_no_threads(tmp_path):
+    """Many open event streams on the async server cost no threads"""
+    import socket
+
+    from loadtest import Client, Server, free_port
+
+    server = Server(
+        str(tmp_path), free_port(), {"BWISE_SERVER": "async", "BWISE_LOG": "0"}
+    )
+    subscribers: list[socket.socket] = []
+    try:
+        server.wait_until_ready()
+        client = Client(server.port)
+        client.post("/login", {"username": "payer"})
+        client.post(
+            "/create_group", {"username": "payer", "group_name": "watched"}
+        )
+
+        request = json.dumps({"username": "payer"}).encode()
+        for _ in range(100):
+            subscriber = socket.create_connection(
+                ("127.0.0.1", server.port), 10
+            )
+            subscriber.sendall(
+                b"POST /events HTTP/1.1\r\nHost: test\r\n"
+                b"Content-Type: application/json\r\n"
+                b"Content-Length: %d\r\n\r\n%s" % (len(request), request)
+            )
+            subscribers.append(subscriber)
+
+        for subscriber in subscribers:
+            response = b""
+            while b": connected" not in response:
+                response += subscriber.recv(65536)
+            assert response.startswith(b"HTTP/1.1 200")
+
+        with open(f"/proc/{server.process.pid}/status") as f:
+            status_lines = dict(line.split(":", 1) for line in f)
+        assert int(status_lines["Threads"]) < 10
+
+        client.post(
+            "/add_expense",
+            {"username": "payer", "group_name": "watched", "amount": 1},
+        )
+        for subscriber in subscribers:
+            response = b""
+            while b"event: add_expense" not in response:
+                response += subscriber.recv(65536)
+            assert b'"group_name": "watched"' in response
+    finally:
+        for subscriber in subscribers:
+            subscriber.close()
+        server.stop()
+
+
+def test_batch(client, tmp_path, monkeypatch):
+    import app as bwise
+
+    monkeypatch.chdir(tmp_path)
+    journal = bwise.Journal(bwise.JOURNAL_FILE)
+    monkeypatch.setattr(bwise, "JOURNAL", journal)
+
+    def batch(operations: list, **options) -> tuple[int, dict]:
+        response = client.post(
+            "/batch",
+            json={"operations": operations, **options},
+            content_type="application/json",
+        )
+        return response.status_code, json.loads(response.data)
+
+    def expense(username: str, amount) -> dict:
+        return {
+            "op": "add_expense",
+            "args": {
+                "username": username,
+                "group_name": "trip",
+                "amount": amount,
+            },
+        }
+
+    seq = bwise.STATE.seq
+    status, body = batch(
+        [
+            {"op": "login", "args": {"username": "payer"}},
+            {"op": "login", "args": {"username": "friend"}},
+            {
+                "op": "create_group",
+                "args": {"username": "payer", "group_name": "trip"},
+            },
+            {
+                "op": "join_group",
+                "args": {"username": "friend", "group_name": "trip"},
+            },
+            expense("payer", 10),
+            expense("nobody", 10),
+            expense("friend", 4),
+        ]
+    )
+    assert status == 200
+    assert [result["status"] for result in body["results"]] == [
+        201,
+        201,
+        201,
+        200,
+        201,
+        404,
+        201,
+    ]
+    assert body["succeeded"] == 6
+    assert body["results"][4]["share_per_member"] == 5
+    assert body["results"][5]["message"] == "User nobody does not exist"
+
+    # one publish, one journal write with consecutive seqs
+    assert bwise.STATE.seq == seq + 6
+    entries = list(bwise.read_journal(bwise.JOURNAL_FILE))
+    assert [entry["seq"] - seq for entry in entries] == [1, 2, 3, 4, 5, 6]
+    assert len({entry["ts"] for entry in entries}) == 1
+    transactions = bwise.GROUPS["trip"].transactions
+    assert [(t.from_user, t.to_user, t.amount) for t in transactions] == [
+        ("friend", "payer", 5),
+        ("payer", "friend", 2),
+    ]
+
+    # all or nothing: the failed expense drops the ones before it
+    version = bwise.STATE.version
+    status, body = batch(
+        [expense("payer", 2), expense("friend", "lots"), expense("payer", 2)],
+        atomic=True,
+    )
+    assert status == 400
+    assert [result["status"] for result in body["results"]] == [201, 400]
+    assert bwise.STATE.version == version
+    assert bwise.GROUPS["trip"].transactions == transactions
+    assert len(list(bwise.read_journal(bwise.JOURNAL_FILE))) == 6
+
+    assert batch([{"op": "get_debts", "args": {}}])[0] == 400
+    assert batch([])[0] == 400
+    monkeypatch.setitem(bwise.CONFIG, "batch_limit", 2)
+    assert batch([expense("payer", 1)] * 3)[0] == 413
+    os.close(journal.fd)
+
+
+def test_idempotency_key(client, tmp_path, monkeypatch):
+    import app as bwise
+
+    monkeypatch.chdir(tmp_path)
+    journal = bwise.Journal(bwise.JOURNAL_FILE)
+    monkeypatch.setattr(bwise, "JOURNAL", journal)
+
+    def post(route: str, payload: dict, key: str | None = None):
+        headers = {} if key is None else {"Idempotency-Key": key}
+        return client.post(
+            route,
+            json=payload,
+            content_type="application/json",
+            headers=headers,
+        )
+
+    for user in ["payer", "friend"]:
+        post("/login", {"username": user})
+    post("/create_group", {"username": "payer", "group_name": "retried"})
+    post("/join_group", {"username": "friend", "group_name": "retried"})
+
+    expense = {"username": "payer", "group_name": "retried", "amount": 8}
+    first = post("/add_expense", expense, "expense-1")
+    retry = post("/add_expense", expense, "expense-1")
+    assert first.status_code == retry.status_code == 201
+    assert json.loads(first.data) == json.loads(retry.data)
+    assert "Idempotent-Replayed" not in first.headers
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert len(bwise.GROUPS["retried"].transactions) == 1
+
+    # another request can't reuse the key
+    response = post("/add_expense", {**expense, "amount": 9}, "expense-1")
+    assert response.status_code == 422
+    assert len(bwise.GROUPS["retried"].transactions) == 1
+
+    # failures changed nothing and are run again
+    stranger = {**expense, "username": "stranger"}
+    assert post("/add_expense", stranger, "expense-2").status_code == 404
+    post("/login", {"username": "stranger"})
+    post("/join_group", {"username": "stranger", "group_name": "retried"})
+    assert post("/add_expense", stranger, "expense-2").status_code == 201
+    assert len(bwise.GROUPS["retried"].transactions) == 3
+
+    # the keys survive a restart, from the snapshot and the journal
+    bwise.write_state(bwise.STATE)
+    post("/add_expense", expense, "expense-3")
+    responses: dict = dict()
+    bwise.load_data(dict(), dict(), responses)
+    assert {"expense-1", "expense-2", "expense-3"} <= set(responses)
+    assert responses["expense-1"]["response"] == json.loads(first.data)
+
+    # only the newest keys are kept
+    monkeypatch.setitem(bwise.CONFIG, "idempotency_keys", 4)
+    for number in range(6):
+        post("/login", {"username": f"user{number}"}, f"login-{number}")
+    assert len(bwise.STATE.responses) <= 4
+    assert "login-5" in bwise.STATE.responses
+    monkeypatch.setitem(bwise.CONFIG, "idempotency_keys", 1)
+    for number in range(6, 9):
+        post("/login", {"username": f"user{number}"}, f"login-{number}")
+    assert list(bwise.STATE.responses) == ["login-8"]
+    os.close(journal.fd)
+
+
+def test_idempotent_change_and_response_together(
+    client, tmp_path, monkeypatch
+):
+    import app as bwise
+
+    monkeypatch.chdir(tmp_path)
+    journal = bwise.Journal(bwise.JOURNAL_FILE)
+    monkeypatch.setattr(bwise, "JOURNAL", journal)
+
+    def post(route: str, payload: dict, key: str | None = None):
+        headers = {} if key is None else {"Idempotency-Key": key}
+        return client.post(route, json=payload, headers=headers)
+
+    for user in ["payer", "friend"]:
+        post("/login", {"username": user})
+    post("/create_group", {"username": "payer", "group_name": "together"})
+    post("/join_group", {"username": "friend", "group_name": "together"})
+
+    # every state that is published and every write of the journal
+    published: list = []
+    writes: list[int] = []
+    notify = bwise.CHANGES.notify
+    monkeypatch.setattr(
+        bwise.CHANGES,
+        "notify",
+        lambda keys: (published.append(bwise.STATE), notify(keys)),
+    )
+    append_all = journal.append_all
+    monkeypatch.setattr(
+        journal,
+        "append_all",
+        lambda entries: (writes.append(len(entries)), append_all(entries)),
+    )
+    monkeypatch.setattr(
+        journal, "append", lambda *entry: pytest.fail("written alone")
+    )
+    saves: queue.Queue = queue.Queue()
+    monkeypatch.setattr(bwise, "write_queue", saves)
+
+    expense = {"username": "payer", "group_name": "together", "amount": 4}
+    assert post("/add_expense", expense, "one").status_code == 201
+    operations = [
+        {"op": "add_expense", "args": expense},
+        {"op": "add_expense", "args": {**expense, "username": "stranger"}},
+    ]
+    # a failed atomic batch leaves nothing behind, not even its response
+    response = post("/batch", {"operations": operations, "atomic": True}, "b")
+    assert response.status_code == 404
+    response = post("/batch", {"operations": operations[:1]}, "b")
+    assert response.status_code == 200
+    assert post("/add_expense", expense, "one").status_code == 201
+
+    assert writes == [2, 2]
+    assert saves.qsize() == 2
+    assert len(published) == 2
+    for state, key, count in zip(published, ["one", "b"], [1, 2]):
+        assert len(state.groups["together"].transactions) == count
+        assert key in state.responses
+    assert bwise.STATE.seq == published[-1].seq
+    os.close(journal.fd)
+
+
+def test_get_transactions(client):
+    from app import GROUPS
+
+    def post(route: str, payload: dict):
+        response = client.post(
+            route, json=payload, content_type="application/json"
+        )
+        return response.status_code, json.loads(response.data)
+
+    for user in ["payer", "friend", "other"]:
+        post("/login", {"username": user})
+    status, body = post(
+        "/create_group", {"username": "payer", "group_name": "paged"}
+    )
+    assert "transactions" not in body["group"]
+    status, body = post(
+        "/create_group",
+        {"username": "payer", "group_name": "embedded", "transactions": True},
+    )
+    assert body["group"]["transactions"] == []
+    for user in ["friend", "other"]:
+        post("/join_group", {"username": user, "group_name": "paged"})
+    for amount in range(1, 11):
+        post(
+            "/add_expense",
+            {"username": "payer", "group_name": "paged", "amount": amount},
+        )
+    post(
+        "/add_expense",
+        {"username": "friend", "group_name": "paged", "amount": 3},
+    )
+
+    def pages(limit: int, **filters) -> list[list[dict]]:
+        result = []
+        cursor = None
+        while True:
+            status, body = post(
+                "/get_transactions",
+                {
+                    "username": "payer",
+                    "group_name": "paged",
+                    "cursor": cursor,
+                    "limit": limit,
+                    **filters,
+                },
+            )
+            assert status == 200
+            result.append(body["transactions"])
+            cursor = body["next_cursor"]
+            if cursor is None:
+                return result
+
+    result = pages(7)
+    assert [len(page) for page in result] == [7, 7, 7, 1]
+    ids = [t["id"] for page in result for t in page]
+    assert ids == list(range(1, 23))
+    assert [t["amount"] for t in result[0][:2]] == [1 / 3, 1 / 3]
+
+    other = [t for page in pages(4, member="other") for t in page]
+    assert len(other) == 11
+    assert all("other" in (t["from_user"], t["to_user"]) for t in other)
+
+    # settling up between two pages doesn't move the cursor
+    status, body = post(
+        "/get_transactions",
+        {"username": "payer", "group_name": "paged", "limit": 5},
+    )
+    post(
+        "/settle_up",
+        {"username": "payer", "to_user": "friend", "group_name": "paged"},
+    )
+    status, body = post(
+        "/get_transactions",
+        {
+            "username": "payer",
+            "group_name": "paged",
+            "cursor": body["next_cursor"],
+        },
+    )
+    assert all(t["id"] > 5 for t in body["transactions"])
+    assert len(body["transactions"]) == 9
+    assert body["next_cursor"] is None
+
+    # new transactions get new ids, even after the last ones were settled
+    post(
+        "/add_expense",
+        {"username": "payer", "group_name": "paged", "amount": 2},
+    )
+    assert GROUPS["paged"].transactions[-1].id == 24
+
+    for limit in [0, 100000, "many"]:
+        status, _ = post(
+            "/get_transactions",
+            {"username": "payer", "group_name": "paged", "limit": limit},
+        )
+        assert status == 400
+    status, _ = post(
+        "/get_transactions", {"username": "payer", "group_name": "missing"}
+    )
+    assert status == 404
+
+
+def test_export_streams_ndjson(client):
+    import gzip
+    import tracemalloc
+
+    from app import GROUPS, USERS, Group, Transaction, User
+
+    USERS.update({name: User(name) for name in ["admin_x", "a", "b"]})
+    GROUPS.update(
+        {
+            f"exported{i}": Group(
+                f"exported{i}",
+                "a",
+                ["a", "b"],
+                [Transaction("b", "a", 1.5) for _ in range(100)],
+            )
+            for i in range(200)
+        }
+    )
+
+    assert client.post("/export", json={"username": "a"}).status_code == 403
+
+    response = client.post(
+        "/export", json={"username": "admin_x"}, buffered=False
+    )
+    assert response.mimetype == "application/x-ndjson"
+    chunks = iter(response.response)
+    first = next(chunks)
+    # changes after the export started are not part of it
+    client.post("/login", json={"username": "late"})
+    data = first + b"".join(chunks)
+
+    lines = [json.loads(line) for line in data.splitlines()]
+    assert lines[0]["type"] == "export"
+    assert lines[0]["users"] == 3
+    assert lines[0]["groups"] == 200
+    assert sorted(
+        line["username"] for line in lines if line["type"] == "user"
+    ) == ["a", "admin_x", "b"]
+    groups = [line for line in lines if line["type"] == "group"]
+    transactions = [line for line in lines if line["type"] == "transaction"]
+    assert len(groups) == 200
+    assert len(transactions) == 20000
+    assert transactions[0] == {
+        "type": "transaction",
+        "group_name": groups[0]["name"],
+        "id": 1,
+        "from_user": "b",
+        "to_user": "a",
+        "amount": 1.5,
+    }
+
+    response = client.post(
+        "/export",
+        json={"username": "admin_x"},
+        headers={"Accept-Encoding": "gzip"},
+    )
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert len(response.data) < len(data) / 10
+    lines = gzip.decompress(response.data).splitlines()
+    assert len(lines) == 1 + 4 + 200 + 20000
+
+    # only one chunk is in memory at a time, not the whole export
+    tracemalloc.start()
+    try:
+        response = client.post(
+            "/export", json={"username": "admin_x"}, buffered=False
+        )
+        size = sum(len(chunk) for chunk in response.response)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < size / 4
+
+
+def test_import(client, monkeypatch):
+    import gzip
+
+    from app import CONFIG, GROUPS, USERS
+
+    client.post("/login", json={"username": "admin_x"})
+    monkeypatch.setitem(CONFIG, "import_batch", 3)
+    records = [
+        {"type": "export", "seq": 7},
+        {"type": "user", "username": "a"},
+        {"type": "user", "username": "b"},
+        {"type": "group", "name": "imported", "creator": "a"},
+        {
+            "type": "group",
+            "name": "shared",
+            "creator": "a",
+            "members": ["a", "b"],
+        },
+        {"type": "group", "name": "shared", "creator": "b"},
+        {"type": "group", "name": "ghost", "creator": "nobody"},
+        *(
+            {
+                "type": "transaction",
+                "group_name": "shared",
+                "from_user": "b",
+                "to_user": "a",
+                "amount": amount,
+            }
+            for amount in range(1, 6)
+        ),
+        {
+            "type": "transaction",
+            "group_name": "imported",
+            "from_user": "b",
+            "to_user": "a",
+            "amount": 1,
+        },
+        {
+            "type": "transaction",
+            "group_name": "shared",
+            "from_user": "b",
+            "to_user": "a",
+            "amount": "lots",
+        },
+    ]
+    body = "\n".join(json.dumps(record) for record in records) + "\n{oops\n"
+
+    def post(body: bytes, username: str = "admin_x", **headers):
+        response = client.post(
+            f"/import?username={username}", data=body, headers=headers
+        )
+        return response.status_code, json.loads(response.data)
+
+    assert post(body.encode(), "a")[0] == 404
+    status, report = post(body.encode())
+    assert status == 200
+    assert report["users"] == 2
+    assert report["groups"] == 2
+    assert report["transactions"] == 5
+    assert report["batches"] == 5
+    assert report["errors"] == 5
+    assert [error["line"] for error in report["error_list"]] == [
+        6,
+        7,
+        13,
+        14,
+        15,
+    ]
+    assert report["error_list"][0]["message"] == "Group shared already exists"
+    assert report["error_list"][2]["message"] == (
+        "User b is not a member of imported"
+    )
+
+    assert {"a", "b"} <= set(USERS)
+    shared = GROUPS["shared"]
+    assert shared.members == ("a", "b")
+    assert [(t.id, t.amount) for t in shared.transactions] == [
+        (number, float(number)) for number in range(1, 6)
+    ]
+
+    # appends to groups that exist, gzipped
+    transaction = json.dumps(records[7]).encode()
+    status, report = post(
+        gzip.compress(transaction + b"\n"),
+        **{"Content-Encoding": "gzip"},
+    )
+    assert report["transactions"] == 1
+    assert GROUPS["shared"].transactions[-1].id == 6
+
+    # the body is streamed, there is no single answer to replay
+    status, report = post(transaction + b"\n", **{"Idempotency-Key": "k"})
+    assert status == 400
+    assert GROUPS["shared"].transactions[-1].id == 6
+
+    # the creator is always a member, and every member only once
+    groups = [
+        {"name": "no_creator", "creator": "a", "members": ["b"]},
+        {"name": "twice", "creator": "a", "members": ["b", "a", "b"]},
+        {"name": "not_a_list", "creator": "a", "members": "ab"},
+    ]
+    body = "\n".join(json.dumps({"type": "group", **g}) for g in groups)
+    status, report = post(body.encode())
+    assert report["groups"] == 2
+    assert report["error_list"][0]["message"] == "members must be a list"
+    assert GROUPS["no_creator"].members == ("a", "b")
+    assert GROUPS["twice"].members == ("b", "a")
+
+
+def test_bulk_import_cli(client, tmp_path, monkeypatch):
+    import bulk_import
+    from app import (
+        Group,
+        Snapshot,
+        State,
+        Transaction,
+        User,
+        export_lines,
+        load_data,
+    )
+
+    state = State(
+        Snapshot().merge({name: User(name) for name in ["a", "b", "c"]}),
+        Snapshot().merge(
+            {
+                f"group{i}": Group(
+                    f"group{i}",
+                    "a",
+                    ["a", "b", "c"],
+                    [Transaction("b", "a", i + 0.5) for _ in range(10)],
+                )
+                for i in range(20)
+            }
+        ),
+    )
+    ledger = tmp_path / "ledger.ndjson"
+    ledger.write_text("".join(export_lines(state)))
+
+    report = bulk_import.run(str(ledger), str(tmp_path), batch_size=50)
+    assert report["errors"] == 0
+    assert report["users"] == 3
+    assert report["groups"] == 20
+    assert report["transactions"] == 200
+    assert report["batches"] == 5
+    # the journal was only there for the import
+    assert not (tmp_path / "journal.ndjson").exists()
+
+    monkeypatch.chdir(tmp_path)
+    users: dict = dict()
+    groups: dict = dict()
+    load_data(users, groups)
+    assert sorted(users) == ["a", "b", "c"]
+    assert len(groups) == 20
+    assert [t.amount for t in groups["group3"].transactions] == [3.5] * 10
+
+
+def test_binary_snapshot(client, tmp_path, monkeypatch):
+    """The binary snapshot loads the same state as the json files"""
+    import app as bwise
+
+    monkeypatch.chdir(tmp_path)
+    journal = bwise.Journal(bwise.JOURNAL_FILE)
+    monkeypatch.setattr(bwise, "JOURNAL", journal)
+    monkeypatch.setitem(bwise.CONFIG, "snapshot_format", "binary")
+
+    def post(route: str, payload: dict, **kwargs) -> None:
+        client.post(route, json=payload, **kwargs)
+
+    # a lone surrogate is a valid username too
+    for user in ["user1", "usér2", "user3", "bad\ud800"]:
+        post("/login", {"username": user})
+    for group_name in ["binary_group", "grüppe", "empty_group"]:
+        post("/create_group", {"username": "user1", "group_name": group_name})
+    for group_name in ["binary_group", "grüppe"]:
+        for user in ["usér2", "user3"]:
+            post("/join_group", {"username": user, "group_name": group_name})
+        post(
+            "/add_expense",
+            {"username": "usér2", "group_name": group_name, "amount": 0.1},
+            headers={"Idempotency-Key": group_name},
+        )
+    post(
+        "/settle_up",
+        {"username": "user1", "to_user": "usér2", "group_name": "grüppe"},
+    )
+
+    bwise.write_state(bwise.STATE)
+    assert os.path.exists(bwise.SNAPSHOT_FILE)
+    # the rest only in the journal
+    post(
+        "/add_expense",
+        {"username": "user3", "group_name": "binary_group", "amount": 7},
+    )
+
+    def loaded() -> tuple:
+        users: dict = dict()
+        groups: dict = dict()
+        responses: dict = dict()
+        seq = bwise.load_data(users, groups, responses)
+        return (
+            seq,
+            sorted(users),
+            {name: group.to_dict() for name, group in groups.items()},
+            responses,
+        )
+
+    binary = loaded()
+    assert binary[0] == bwise.STATE.seq
+    assert binary[1] == sorted(bwise.USERS)
+    assert binary[2] == {
+        name: group.to_dict() for name, group in bwise.GROUPS.items()
+    }
+    assert sorted(binary[3]) == ["binary_group", "grüppe"]
+
+    # the json files are used again, and nothing changes
+    monkeypatch.setitem(bwise.CONFIG, "snapshot_format", "json")
+    bwise.write_state(bwise.STATE)
+    assert not os.path.exists(bwise.SNAPSHOT_FILE)
+    assert loaded() == binary
+
+    with open(bwise.SNAPSHOT_FILE, "wb") as f:
+        f.write(b"garbage")
+    assert bwise.load_binary_snapshot(bwise.SNAPSHOT_FILE, {}, {}, {}) == 0
+    os.close(journal.fd)
+
+
+def test_writer_thread_survives_failed_writes(client, monkeypatch):
+    """A write that fails is reported and the next save writes again"""
+    import dataclasses
+    import threading
+
+    import app as bwise
+
+    written = []
+
+    def write_state(state) -> None:
+        if not written:
+            written.append(None)
+            raise OSError("disk full")
+        written.append(state.version)
+
+    monkeypatch.setattr(bwise, "write_state", write_state)
+    writer = threading.Thread(target=bwise.writer_thread)
+    writer.start()
+    # newer than whatever other tests left in the queue
+    for version in [10**9, 10**9 + 1]:
+        bwise.write_queue.put(
+            dataclasses.replace(bwise.STATE, version=version)
+        )
+        bwise.write_queue.join()
+    bwise.write_queue.put(None)
+    writer.join()
+
+    assert written[0] is None
+    assert written[-1] == 10**9 + 1
+    assert bwise.METRICS["writer"] == {
+        "count": 1,
+        "last": "OSError('disk full')",
+    }
+
+
+def test_lazy_load(client, tmp_path, monkeypatch):
+    """Groups read their transactions from the snapshot on first use"""
+    import app as bwise
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(bwise.CONFIG, "snapshot_format", "binary")
+    monkeypatch.setitem(bwise.CONFIG, "lazy_load", True)
+
+    for user in ["admin", "user1", "user2"]:
+        client.post("/login", json={"username": user})
+    for group_name in ["group1", "group2", "group3"]:
+        client.post(
+            "/create_group",
+            json={"username": "user1", "group_name": group_name},
+        )
+        client.post(
+            "/join_group", json={"username": "user2", "group_name": group_name}
+        )
+        for amount in [10, 20, 30]:
+            client.post(
+                "/add_expense",
+                json={
+                    "username": "user2",
+                    "group_name": group_name,
+                    "amount": amount,
+                },
+            )
+    expected = {name: group.to_dict() for name, group in bwise.GROUPS.items()}
+    bwise.write_state(bwise.STATE)
+
+    bwise.load_state()
+    assert not any(g.transactions_loaded for g in bwise.GROUPS.values())
+    response = client.post(
+        "/memory_stats", json={"username": "admin"}
+    ).get_json()
+    assert response["stats"]["groups"]["unloaded"] == 3
+    assert response["stats"]["transactions"]["unloaded"] == 9
+
+    # exported and written again without reading any of them
+    exported = b"".join(
+        bwise.export_chunks(bwise.export_lines(bwise.STATE), False)
+    )
+    assert exported.count(b'"type": "transaction"') == 9
+    bwise.write_state(bwise.STATE)
+    assert not any(g.transactions_loaded for g in bwise.GROUPS.values())
+
+    response = client.post(
+        "/get_debts",
+        json={"username": "user1", "group_name": "group1"},
+    )
+    assert response.status_code == 200
+    client.post(
+        "/add_expense",
+        json={"username": "user1", "group_name": "group2", "amount": 4},
+    )
+    assert sorted(
+        name for name, g in bwise.GROUPS.items() if g.transactions_loaded
+    ) == ["group1", "group2"]
+    expected["group2"] = bwise.GROUPS["group2"].to_dict()
+    assert expected["group2"]["transaction_count"] == 4
+
+    bwise.write_state(bwise.STATE)
+    monkeypatch.setitem(bwise.CONFIG, "lazy_load", False)
+    groups: dict = dict()
+    bwise.load_data(dict(), groups)
+    assert {name: group.to_dict() for name, group in groups.items()} == (
+        expected
+    )
+
+
+def test_group_cache_evicts_idle_groups(client, tmp_path, monkeypatch):
+    """Only the groups used last keep their transactions in memory"""
+    import app as bwise
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(bwise.CONFIG, "snapshot_format", "binary")
+
+    for user in ["admin", "user1", "user2"]:
+        client.post("/login", json={"username": user})
+    for group_name in ["group1", "group2", "group3"]:
+        client.post(
+            "/create_group",
+            json={"username": "user1", "group_name": group_name},
+        )
+        client.post(
+            "/join_group", json={"username": "user2", "group_name": group_name}
+        )
+        for amount in [10, 20, 30]:
+            client.post(
+                "/add_expense",
+                json={
+                    "username": "user2",
+                    "group_name": group_name,
+                    "amount": amount,
+                },
+            )
+    bwise.write_state(bwise.STATE)
+
+    cache = bwise.GroupCache(6)
+    monkeypatch.setattr(bwise, "GROUP_CACHE", cache)
+    bwise.load_state()
+
+    def use(group_name: str) -> None:
+        response = client.post(
+            "/get_debts", json={"username": "user1", "group_name": group_name}
+        )
+        assert response.status_code == 200
+
+    def loaded() -> list[str]:
+        return sorted(
+            name for name, g in bwise.GROUPS.items() if g.transactions_loaded
+        )
+
+    for group_name in ["group1", "group2", "group3"]:
+        use(group_name)
+    assert loaded() == ["group2", "group3"]
+    assert cache.stats["misses"] == 3
+    assert cache.stats["evictions"] == 1
+    assert cache.stats["transactions"] == 6
+
+    # changed since the snapshot, so it can't be evicted until the next one
+    client.post(
+        "/add_expense",
+        json={"username": "user1", "group_name": "group2", "amount": 4},
+    )
+    use("group1")
+    assert loaded() == ["group1", "group2"]
+    assert cache.stats["transactions"] == 7
+
+    bwise.write_state(bwise.STATE)
+    use("group3")
+    assert loaded() == ["group1", "group3"]
+    assert cache.stats["evictions"] == 3
+
+    # read again from the snapshot when used
+    response = client.post(
+        "/get_transactions",
+        json={"username": "user1", "group_name": "group2"},
+    )
+    assert [t["amount"] for t in response.get_json()["transactions"]] == [
+        5.0,
+        10.0,
+        15.0,
+        2.0,
+    ]
+    assert cache.stats["misses"] == 6
+    response = client.post("/metrics", json={"username": "admin"})
+    assert response.get_json()["metrics"]["group_cache"] == cache.stats
+
+
+def test_names_are_interned(client, tmp_path, monkeypatch):
+    """All references to one user share a single string"""
+    import app as bwise
+
+    monkeypatch.chdir(tmp_path)
+    for user in ["user1", "user2"]:
+        client.post("/login", json={"username": user})
+    client.post(
+        "/create_group", json={"username": "user1", "group_name": "group"}
+    )
+    client.post(
+        "/join_group", json={"username": "user2", "group_name": "group"}
+    )
+    for amount in [10, 20]:
+        client.post(
+            "/add_expense",
+            json={
+                "username": "user1",
+                "group_name": "group",
+                "amount": amount,
+            },
+        )
+
+    def check(usernames: list[str], group: "bwise.Group") -> None:
+        names = {name: name for name in usernames}
+        assert all(names[member] is member for member in group.members)
+        for transaction in group.transactions:
+            assert names[transaction.from_user] is transaction.from_user
+            assert names[transaction.to_user] is transaction.to_user
+
+    check(list(bwise.USERS), bwise.GROUPS["group"])
+    bwise.write_state(bwise.STATE)
+    users: dict = dict()
+    groups: dict = dict()
+    bwise.load_data(users, groups)
+    check(list(users), groups["group"])
+
+
+def test_compressed_snapshots(client, tmp_path, monkeypatch):
+    import app as bwise
+
+    monkeypatch.chdir(tmp_path)
+    for user in ["user1", "user2"]:
+        client.post("/login", json={"username": user})
+    client.post(
+        "/create_group", json={"username": "user1", "group_name": "group"}
+    )
+    client.post(
+        "/join_group", json={"username": "user2", "group_name": "group"}
+    )
+    for amount in range(1, 200):
+        client.post(
+            "/add_expense",
+            json={
+                "username": "user1",
+                "group_name": "group",
+                "amount": amount,
+            },
+        )
+    expected = bwise.GROUPS["group"].to_dict()
+
+    monkeypatch.setitem(bwise.CONFIG, "compression", "none")
+    bwise.write_state(bwise.STATE)
+    plain_size = os.path.getsize(bwise.GROUPS_FILE)
+
+    for codec in ["gzip", "zlib", "none"]:
+        monkeypatch.setitem(bwise.CONFIG, "compression", codec)
+        bwise.write_state(bwise.STATE)
+        with open(bwise.GROUPS_FILE, "rb") as f:
+            head = f.read(2)
+        if codec == "none":
+            assert head == b'{"'
+        else:
+            assert head in bwise.COMPRESSION_MAGIC[codec]
+            assert os.path.getsize(bwise.GROUPS_FILE) < plain_size / 4
+
+        # whatever wrote it, the files are recognized when loading
+        users: dict = dict()
+        groups: dict = dict()
+        bwise.load_data(users, groups)
+        assert sorted(users) == ["user1", "user2"]
+        assert groups["group"].to_dict() == expected
+
+    with pytest.raises(ValueError):
+        bwise.load_config(
+            str(tmp_path / "missing.json"), {"BWISE_COMPRESSION": "lz4"}
+        )
+
+
+def test_groups_file_read_line_by_line(client, tmp_path, monkeypatch):
+    import app as bwise
+
+    monkeypatch.chdir(tmp_path)
+    client.post("/login", json={"username": "user1"})
+    for group_name in ["group1", "group2", "group3"]:
+        client.post(
+            "/create_group",
+            json={"username": "user1", "group_name": group_name},
+        )
+        client.post(
+            "/add_expense",
+            json={"username": "user1", "group_name": group_name, "amount": 3},
+        )
+    expected = {name: group.to_dict() for name, group in bwise.GROUPS.items()}
+
+    def loaded() -> dict:
+        groups: dict = dict()
+        assert bwise.load_groups(groups) == bwise.STATE.seq
+        return {name: group.to_dict() for name, group in groups.items()}
+
+    bwise.write_state(bwise.STATE)
+    with open(bwise.GROUPS_FILE, "rb") as f:
+        lines = f.read().split(b"\n")
+    # a line for the header, every group and the end
+    assert len(lines) == 5
+    assert lines[0].endswith(bwise.GROUPS_FILE_HEADER_END.rstrip(b"\n"))
+    assert loaded() == expected
+
+    # compressed, read in chunks that cut through the lines
+    monkeypatch.setitem(bwise.CONFIG, "compression", "gzip")
+    monkeypatch.setattr(bwise, "COMPRESSED_CHUNK_SIZE", 7)
+    bwise.write_state(bwise.STATE)
+    assert list(bwise.read_file_lines(bwise.GROUPS_FILE)) == [
+        line + b"\n" for line in lines[:-1]
+    ] + [lines[-1]]
+    assert loaded() == expected
+
+    # snapshots written on a single line still load
+    monkeypatch.setitem(bwise.CONFIG, "compression", "none")
+    with open(bwise.GROUPS_FILE, "w") as f:
+        json.dump(
+            {"seq": bwise.STATE.seq, "groups": list(expected.values())}, f
+        )
+    assert loaded() == expected
+
+
+def test_groups_file_without_groups(client, tmp_path, monkeypatch):
+    """The seq and the stored responses load back without any groups"""
+    import dataclasses
+
+    import app as bwise
+
+    monkeypatch.chdir(tmp_path)
+    state = dataclasses.replace(
+        bwise.STATE,
+        seq=7,
+        responses=bwise.Snapshot().merge({"key": {"status": 201}}),
+    )
+    assert not state.groups
+
+    def loaded() -> tuple[int, dict, dict]:
+        groups: dict = dict()
+        responses: dict = dict()
+        seq = bwise.load_groups(groups, responses)
+        return seq, groups, responses
+
+    bwise.write_state(state)
+    assert loaded() == (7, {}, {"key": {"status": 201}})
+
+    # as the first version of the line by line format wrote it
+    with open(bwise.GROUPS_FILE, "w") as f:
+        f.write("".join(bwise.groups_file_lines(state)).replace("]}", "\n]}"))
+    assert loaded() == (7, {}, {"key": {"status": 201}})
+
+
+def test_recover_point_in_time(client, tmp_path, monkeypatch):
+    """recover.py rebuilds the state at a seq or a time from the journal"""
+    import dataclasses
+
+    import app as bwise
+    import recover
+
+    monkeypatch.chdir(tmp_path)
+    journal = bwise.Journal(bwise.JOURNAL_FILE)
+    monkeypatch.setattr(bwise, "JOURNAL", journal)
+    # a journal from the first operation on
+    monkeypatch.setattr(
+        bwise, "STATE", dataclasses.replace(bwise.STATE, seq=0)
+    )
+
+    def post(route: str, payload: dict) -> None:
+        client.post(route, json=payload, content_type="application/json")
+
+    def expense(username: str, group_name: str, amount: float) -> None:
+        post(
+            "/add_expense",
+            {"username": username, "group_name": group_name, "amount": amount},
+        )
+
+    def groups(state) -> dict:
+        return {
+            name: (group.version, group.members, group.to_dict())
+            for name, group in state.groups.items()
+        }
+
+    for user in ["user1", "user2", "user3"]:
+        post("/login", {"username": user})
+    for group_name in ["pitr_group", "other_group"]:
+        post("/create_group", {"username": "user1", "group_name": group_name})
+        post("/join_group", {"username": "user2", "group_name": group_name})
+    for amount in [10, 20, 30]:
+        expense("user1", "pitr_group", amount)
+    expense("user2", "other_group", 5)
+    bwise.write_state(bwise.STATE)
+    middle = bwise.STATE
+
+    post("/join_group", {"username": "user3", "group_name": "pitr_group"})
+    expense("user3", "pitr_group", 60)
+    expense("user2", "pitr_group", 6)
+    post(
+        "/settle_up",
+        {"username": "user1", "to_user": "user2", "group_name": "pitr_group"},
+    )
+    expense("user1", "pitr_group", 3)
+    post("/delete_group", {"username": "user1", "group_name": "other_group"})
+
+    # the expenses added at once come out the same as one at a time
+    end = bwise.replay(
+        bwise.State(bwise.Snapshot(), bwise.Snapshot()),
+        bwise.read_journal(bwise.JOURNAL_FILE),
+    )
+    assert end.seq == bwise.STATE.seq
+    assert groups(end) == groups(bwise.STATE)
+
+    # before the snapshot everything comes from the journal
+    at_logins, at_middle = recover.recover(["3", str(middle.seq)])
+    assert sorted(at_logins.users) == ["user1", "user2", "user3"]
+    assert len(at_logins.groups) == 0
+    assert groups(at_middle) == groups(middle)
+
+    entries = list(bwise.read_journal(bwise.JOURNAL_FILE))
+    timestamp = entries[middle.seq - 1]["ts"]
+    (at_time,) = recover.recover([f"@{timestamp}"])
+    assert at_time.seq == middle.seq
+
+    changes = recover.run([str(middle.seq), str(end.seq)])
+    assert changes["from"] == middle.seq
+    assert changes["groups"]["removed"] == ["other_group"]
+    changed = changes["groups"]["changed"]["pitr_group"]
+    assert changed["members"] == {"added": ["user3"], "removed": []}
+    assert len(changed["transactions"]["added"]) == 5
+    assert changed["balances"]["user3"] == 37
+
+    report = recover.run([str(middle.seq)], output=str(tmp_path / "restored"))
+    assert report["groups"] == 2
+    assert report["transactions"] == 4
+    monkeypatch.chdir(tmp_path / "restored")
+    restored_groups: dict = dict()
+    assert bwise.load_data(dict(), restored_groups) == middle.seq
+    assert sorted(restored_groups) == ["other_group", "pitr_group"]
+
+    # the transactions there are, not the ones a settle-up cleared
+    monkeypatch.chdir(tmp_path)
+    report = recover.run([str(end.seq)])
+    assert report["transactions"] == len(
+        bwise.STATE.groups["pitr_group"].transactions
+    )
+
+    # the snapshot alone can't be recovered from
+    os.remove(bwise.JOURNAL_FILE)
+    with pytest.raises(ValueError, match="BWISE_JOURNAL=1"):
+        recover.run([str(middle.seq)])